@@ -1,4 +1,8 @@
+import json
+from typing import Iterator
+
 from fastapi import APIRouter
+from fastapi.responses import StreamingResponse
 from app.core.config import settings
 from fastapi import APIRouter
 from uuid import uuid4
@@ -20,9 +24,38 @@ class Questionary(BaseModel):
     options: dict | None = None
 
 
+class QuestionaryBatch(BaseModel):
+    text: str
+    questions: list[str]
+    issuer: str | None = None
+    options: dict | None = None
+
+
 router = APIRouter()
 
 
+def stream_events(events: Iterator[dict]) -> StreamingResponse:
+    """
+    Send the events of a streaming service as server-sent events.
+    """
+
+    def format_events():
+        try:
+            for event in events:
+                yield f"event: {event['event']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            # the status code is already sent, the error is the last event
+            print(f"Stream failed: {e}")
+            yield f"event: error\ndata: {json.dumps({'event': 'error', 'error': str(e)})}\n\n"
+
+    return StreamingResponse(
+        format_events(),
+        media_type="text/event-stream",
+        # proxies must not buffer the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.post(
     "/questionary",
     tags=["service"],
@@ -39,13 +72,56 @@ def text_questionary(data: Questionary):
 
     print(f"Questionary: {question} - {text[:50]}...")
 
-    response = questionary.initiate(question, text)
+    response = questionary.initiate(question, text, options)
 
     print("Questionary done!")
 
     return response
 
 
+@router.post(
+    "/questionary/stream",
+    tags=["service"],
+    summary="Questionary Stream",
+    operation_id=f"questionary-stream-{str(uuid4())}",
+)
+def text_questionary_stream(data: Questionary):
+
+    text = data.text
+    question = data.question
+
+    issuer = data.issuer
+    options = data.options
+
+    print(f"Questionary Stream: {question} - {text[:50]}...")
+
+    # the answers of the chunks are sent as they are done, the final answer token by token
+    return stream_events(questionary.stream_answer(question, text, options))
+
+
+@router.post(
+    "/questionary/batch",
+    tags=["service"],
+    summary="Questionary Batch",
+    operation_id=f"questionary-batch-{str(uuid4())}",
+)
+def text_questionary_batch(data: QuestionaryBatch):
+
+    text = data.text
+    questions = data.questions
+
+    issuer = data.issuer
+    options = data.options
+
+    print(f"Questionary Batch: {len(questions)} questions - {text[:50]}...")
+
+    response = questionary.initiate_batch(questions, text, options)
+
+    print("Questionary Batch done!")
+
+    return response
+
+
 @router.post(
     "/summarize",
     tags=["service"],
@@ -62,11 +138,31 @@ def text_summarize(data: Summarize):
 
     print(f"Summarize: {text[:50]}...")
 
-    response = summarize.initiate(text, title)
+    response = summarize.initiate(text, title, options)
 
     print("Summarize done!")
 
     return response
 
 
+@router.post(
+    "/summarize/stream",
+    tags=["service"],
+    summary="Summarize Stream",
+    operation_id=f"summarize-stream-{str(uuid4())}",
+)
+def text_summarize_stream(data: Summarize):
+
+    text = data.text
+    title = data.title
+
+    issuer = data.issuer
+    options = data.options
+
+    print(f"Summarize Stream: {text[:50]}...")
+
+    # section summaries are sent as they are done, the final summary token by token
+    return stream_events(summarize.stream_summary(text, title, options))
+
+
 __all__ = ["router"]
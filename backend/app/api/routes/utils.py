@@ -2,6 +2,9 @@ from fastapi import APIRouter
 from app.core.config import settings
 from fastapi import APIRouter
 from app.utils.system import get_system_metrics
+from app.utils.result_cache import result_cache, section_cache
+from app.utils.single_flight import flights
+from app.services.budget import generation_stats
 
 router = APIRouter()
 
@@ -24,6 +27,12 @@ def health():
 @router.get("/capacity", tags=["utils"])
 def measure_system_capacity():
     metrics = get_system_metrics()
+    # hit and miss counters of the result caches of this worker
+    metrics["result_cache"] = result_cache.stats()
+    metrics["section_cache"] = section_cache.stats()
+    metrics["single_flight"] = flights.stats()
+    # budgeted against generated tokens per stage, to tune the generation budgets
+    metrics["generation_budgets"] = generation_stats.stats()
     return metrics
 
 
@@ -79,5 +79,79 @@ class Settings(BaseSettings):
 
     LLM_MODEL_ID: str = os.getenv("LLM_MODEL_ID", "")
 
+    # "auto", "bfloat16", "float16" or "float32"
+    LLM_TORCH_DTYPE: str = os.getenv("LLM_TORCH_DTYPE", "auto")
+
+    # "local" loads the model inside every api worker, "remote" sends all
+    # generations to the inference engine process (python -m app.services.engine),
+    # scripts/start.sh of the image defaults to "remote" and starts the engine
+    LLM_ENGINE_MODE: Literal["local", "remote"] = "local"
+    LLM_ENGINE_SOCKET: str = os.getenv("LLM_ENGINE_SOCKET", "/tmp/llm-engine.sock")
+    # shared secret of the engine and the workers, required in "remote" mode since
+    # the socket messages are pickled (scripts/start.sh generates one if not set)
+    LLM_ENGINE_AUTHKEY: str = os.getenv("LLM_ENGINE_AUTHKEY", "")
+    # seconds a worker waits for the engine socket while the model is loading
+    LLM_ENGINE_CONNECT_TIMEOUT: int = 600
+
+    # dynamic batching of concurrent generations (see app/services/batching.py)
+    LLM_MAX_BATCH_SIZE: int = 8
+    LLM_BATCH_WAIT_MS: int = 20
+    # past-key-values of shared prompt prefixes (the system instructions) kept per
+    # model, 0 disables the cache, shorter prefixes are prefilled as before
+    LLM_PREFIX_CACHE_MB: int = 512
+    LLM_PREFIX_CACHE_MIN_TOKENS: int = 16
+    # past-key-values of document chunks, used by the document first prompt layout
+    LLM_DOCUMENT_CACHE_MB: int = 1024
+    # stop every generation once its JSON object is closed, instead of decoding
+    # until eos or max_new_tokens
+    LLM_STOP_AT_JSON_END: bool = True
+    # constrain the generations to the JSON schema of their response, so every
+    # output is a valid object with the expected keys
+    LLM_CONSTRAINED_JSON: bool = True
+    # the outputs are only the generated text, for debugging the prompt can be
+    # put in front of every output again
+    LLM_ECHO_PROMPT: bool = False
+    # context size of the prompts (see app/services/budget.py): the context of the
+    # model, capped by LLM_MAX_CONTEXT_TOKENS (0 = no cap) and by the memory the
+    # key/value states of a full batch may use (0 = a quarter of the free memory
+    # when the engine loads the model, rounded down to a power of two tokens)
+    LLM_MAX_CONTEXT_TOKENS: int = 0
+    LLM_KV_CACHE_MB: int = 0
+    # sections submitted together in the summarize map phase, 0 submits all at once
+    SUMMARIZE_MAP_BATCH_SIZE: int = 0
+    # summaries merged into one per reduce level and the maximum number of levels
+    SUMMARIZE_REDUCE_FAN_IN: int = 4
+    SUMMARIZE_REDUCE_MAX_DEPTH: int = 8
+    # extractive pre-compression of texts longer than one section, keeps the best
+    # ranked sentences up to this share of the tokens (see app/utils/extractive.py)
+    # (overridable per request with options["compress"], true/false or a ratio)
+    SUMMARIZE_COMPRESS: bool = False
+    SUMMARIZE_COMPRESS_RATIO: float = 0.5
+    # chunks sent to the model per question after bm25 ranking, 0 sends all chunks
+    # as without retrieval (opt in per request with options["top_k"])
+    QUESTIONARY_TOP_K: int = 0
+    # put the chunk before the question instructions, so the chunk states are cached
+    # and follow-up questions only prefill the instructions. The chunk prompts are
+    # still generated in one batch, but every chunk takes its own prefix cache entry,
+    # so it only pays off for repeated questions on the same text
+    # (overridable per request with options["document_first"])
+    QUESTIONARY_DOCUMENT_FIRST: bool = False
+
+    # on disk store of preprocessed documents (see app/utils/docstore.py)
+    DOCSTORE_ENABLED: bool = True
+    DOCSTORE_PATH: str = os.getenv("DOCSTORE_PATH", "/tmp/summarize-ai/docstore")
+    DOCSTORE_MAX_DOCUMENTS: int = 1000
+
+    # cache of complete summarize and questionary results (see app/utils/result_cache.py),
+    # an empty RESULT_CACHE_PATH keeps the results in memory only
+    # (bypassed per request with options["cache"] = False)
+    RESULT_CACHE_ENABLED: bool = True
+    RESULT_CACHE_MAX_ENTRIES: int = 1024
+    RESULT_CACHE_TTL: int = 60 * 60 * 24
+    RESULT_CACHE_PATH: str = os.getenv("RESULT_CACHE_PATH", "")
+    # summaries of single sections and reduce groups, so edited documents only
+    # summarize the sections which changed (same ttl and sqlite tier)
+    SUMMARIZE_SECTION_CACHE_MAX_ENTRIES: int = 8192
+
 
 settings = Settings()  # type: ignore
@@ -0,0 +1,551 @@
+# Dynamic batching of generation requests.
+#
+# Concurrent requests (threads of the local engine or connections of the
+# inference engine) put their prompts into one queue. A single worker thread
+# collects the pending prompts for a short window or until the batch is full,
+# left pads them, runs one model.generate for the whole batch and hands every
+# caller back its own generated tokens.
+#
+# Requests can mark a leading part of their prompt as a shared prefix (the
+# system instructions). Its past-key-values are computed once, kept in the
+# PrefixCache and every batch of requests with that prefix only prefills the
+# rest of its prompts. Rows with different prefixes (or none) still share one
+# generate call: the cached states of their prefixes are padded and stacked. The
+# instruction prefixes and the document chunks (see the document first layout of
+# the questionary) have their own caches, so the many different chunks can not
+# evict the few instructions.
+#
+# Identical requests which are queued or generating at the same time (the same
+# document posted to several api workers) share one generation.
+#
+# The tokens of every row are collected step by step while the batch generates.
+# A request can stream them (on_tokens) and every request is resolved as soon
+# as its own row is done, not only when the whole batch is finished. A row also
+# stops as soon as its decoded tokens contain one of the stop strings of its
+# request (e.g. "NOANSWER") or, if requested, as soon as the JSON object it
+# generates is closed.
+#
+# Requests with a response schema (json_keys) are decoded constrained: every
+# step only the tokens which keep the output of the row a valid object of its
+# schema can be generated (see app/services/json_stream.py).
+
+import functools
+import queue
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+
+import torch
+from transformers import (
+    DynamicCache,
+    LogitsProcessor,
+    LogitsProcessorList,
+    PreTrainedModel,
+    StoppingCriteria,
+    StoppingCriteriaList,
+)
+
+from app.core.config import settings
+from app.services.json_stream import JsonObjectTracker, JsonSchemaGrammar, TokenMasks
+from app.services.kv_cache import PrefixCache, cache_layers
+
+
+@dataclass
+class GenerationRequest:
+    input_ids: list[int]
+    max_new_tokens: int
+    eos_token_ids: list[int]
+    # leading input_ids shared with other requests, 0 if nothing is cached
+    prefix_length: int = 0
+    # the prefix cache the prefix is kept in, "instruction" or "document"
+    prefix_cache: str = "instruction"
+    # called from the batcher thread with every new token of the request
+    on_tokens: Callable[[list[int]], None] | None = None
+    # the row stops once the decoded tokens contain one of the strings
+    stop_strings: tuple[str, ...] = ()
+    # the row stops once its first top level JSON object is closed
+    stop_at_json_end: bool = False
+    # the keys of the JSON object the row is constrained to, empty for free text
+    json_keys: tuple[str, ...] = ()
+    decode: Callable[[list[int]], str] | None = None
+    future: Future = field(default_factory=Future)
+
+
+class BatchStoppingCriteria(StoppingCriteria):
+    """
+    Per row stopping and streaming for a batched generate call.
+
+    Every row stops at its first eos token, at one of its stop strings, at the end of
+    its JSON object or when its own max_new_tokens are reached, the batch runs until
+    the last row is done. The new token of every running row is collected (and
+    streamed) each step and a request is resolved with its tokens as soon as its row
+    is done.
+    """
+
+    def __init__(self, requests: list[GenerationRequest]):
+        self.requests = requests
+        self.eos_token_ids = [set(request.eos_token_ids) for request in requests]
+        self.generated: list[list[int]] = [[] for _ in requests]
+        self.done = [False] * len(requests)
+        self.json_trackers = [
+            JsonObjectTracker()
+            if request.stop_at_json_end and request.decode is not None
+            else None
+            for request in requests
+        ]
+
+    def finish(self, row: int):
+        self.done[row] = True
+        future = self.requests[row].future
+        if not future.done():
+            future.set_result(self.generated[row])
+
+    def hits_stop_string(
+        self, request: GenerationRequest, token_ids: list[int]
+    ) -> bool:
+        if not request.stop_strings or request.decode is None:
+            return False
+
+        # only the tail can contain a stop string which was not there the step before,
+        # every token is at least one character long
+        window = max(len(stop_string) for stop_string in request.stop_strings) + 2
+        tail = request.decode(token_ids[-window:])
+
+        return any(stop_string in tail for stop_string in request.stop_strings)
+
+    def closes_json_object(self, row: int, token_id: int) -> bool:
+        tracker = self.json_trackers[row]
+        if tracker is None:
+            return False
+
+        # braces, quotes and backslashes are single byte characters, they are
+        # never split across tokens, so every token can be decoded on its own
+        return tracker.feed(self.requests[row].decode([token_id]))
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ) -> torch.BoolTensor:
+        for row, token_id in enumerate(input_ids[:, -1].tolist()):
+            if self.done[row]:
+                continue
+
+            request = self.requests[row]
+
+            if token_id in self.eos_token_ids[row]:
+                self.finish(row)
+                continue
+
+            self.generated[row].append(token_id)
+
+            if request.on_tokens is not None:
+                try:
+                    request.on_tokens([token_id])
+                except Exception as e:
+                    print(f"Failed to stream token of row {row}: {e}")
+
+            if (
+                len(self.generated[row]) >= request.max_new_tokens
+                or self.closes_json_object(row, token_id)
+                or self.hits_stop_string(request, self.generated[row])
+            ):
+                self.finish(row)
+
+        return torch.tensor(self.done, dtype=torch.bool, device=input_ids.device)
+
+
+@functools.lru_cache(maxsize=64)
+def schema_grammar(json_keys: tuple[str, ...]) -> JsonSchemaGrammar:
+    return JsonSchemaGrammar(list(json_keys))
+
+
+class JsonSchemaLogitsProcessor(LogitsProcessor):
+    """
+    Per row constrained decoding for a batched generate call.
+
+    Rows with a response schema only get the tokens which keep their output a valid
+    object of the schema. When the max_new_tokens of a row are about to run out, the
+    open value is closed and the missing keys are filled in empty, so the object is
+    always complete. Rows without schema are not touched.
+
+    Args:
+        requests (list[GenerationRequest]): The requests of the rows.
+        token_masks (list[TokenMasks | None]): The masks of every row, None for rows without schema.
+    """
+
+    def __init__(
+        self, requests: list[GenerationRequest], token_masks: list[TokenMasks | None]
+    ):
+        self.requests = requests
+        self.token_masks = token_masks
+        self.grammars = [
+            schema_grammar(request.json_keys) if masks is not None else None
+            for request, masks in zip(requests, token_masks, strict=True)
+        ]
+        self.states = [
+            grammar.initial_state if grammar is not None else None
+            for grammar in self.grammars
+        ]
+        self.steps = 0
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        if self.steps > 0:
+            for row, token_id in enumerate(input_ids[:, -1].tolist()):
+                state = self.states[row]
+                if state is None:
+                    continue
+
+                token_texts = self.token_masks[row].token_texts
+                text = token_texts[token_id] if token_id < len(token_texts) else ""
+                # a row which left its schema anyway (e.g. sampled from a row
+                # without allowed tokens) is generated freely from here on
+                self.states[row] = self.grammars[row].advance(state, text)
+
+        size = scores.shape[-1]
+        allowed = torch.ones_like(scores, dtype=torch.bool)
+        for row, state in enumerate(self.states):
+            if state is None:
+                continue
+
+            grammar = self.grammars[row]
+            # the literal rest of the object needs at most one token per character
+            tokens_left = self.requests[row].max_new_tokens - self.steps
+            close = tokens_left <= grammar.remaining_literal(state) + 1
+
+            mask = self.token_masks[row].mask(
+                grammar, state, size, scores.device, close
+            )
+            if mask is not None:
+                allowed[row] = mask
+
+        self.steps += 1
+        return scores.masked_fill(~allowed, float("-inf"))
+
+
+class DynamicBatcher:
+    """
+    Collects generation requests for one model and runs them batched.
+
+    Args:
+        model (PreTrainedModel): The model used for all batches.
+        pad_token_id (int): The token used to left pad the prompts of a batch.
+        max_batch_size (int): The maximum number of prompts per generate call.
+        max_wait_ms (int): How long the first request of a batch waits for more requests.
+        prefix_caches (dict[str, PrefixCache] | None): The past-key-values of the shared prompt prefixes by cache name.
+    """
+
+    def __init__(
+        self,
+        model: PreTrainedModel,
+        pad_token_id: int,
+        max_batch_size: int = settings.LLM_MAX_BATCH_SIZE,
+        max_wait_ms: int = settings.LLM_BATCH_WAIT_MS,
+        prefix_caches: dict[str, PrefixCache] | None = None,
+    ):
+        self.model = model
+        self.pad_token_id = pad_token_id
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_ms = max(0, max_wait_ms)
+        self.prefix_caches = prefix_caches or {
+            "instruction": PrefixCache(settings.LLM_PREFIX_CACHE_MB * 1024 * 1024),
+            "document": PrefixCache(settings.LLM_DOCUMENT_CACHE_MB * 1024 * 1024),
+        }
+        self.__queue: queue.Queue[GenerationRequest] = queue.Queue()
+        self.__in_flight: dict[tuple, Future] = {}
+        self.__in_flight_lock = threading.Lock()
+        self.coalesced = 0
+        # the decoded text of every token and the grammar masks, built with the first schema request
+        self.__token_texts: list[str] | None = None
+        self.__token_masks: dict[tuple[int, ...], TokenMasks] = {}
+        self.__worker: threading.Thread | None = None
+        self.__worker_lock = threading.Lock()
+
+    def __ensure_worker(self):
+        if self.__worker is not None and self.__worker.is_alive():
+            return
+
+        with self.__worker_lock:
+            if self.__worker is not None and self.__worker.is_alive():
+                return
+
+            self.__worker = threading.Thread(
+                target=self.__run, name="generation-batcher", daemon=True
+            )
+            self.__worker.start()
+
+    def submit(
+        self,
+        input_ids: list[int],
+        max_new_tokens: int,
+        eos_token_ids: list[int],
+        prefix_length: int = 0,
+        prefix_cache: str = "instruction",
+        on_tokens: Callable[[list[int]], None] | None = None,
+        stop_strings: list[str] | None = None,
+        stop_at_json_end: bool = False,
+        json_keys: list[str] | None = None,
+        decode: Callable[[list[int]], str] | None = None,
+    ) -> Future:
+        """
+        Queue one prompt for the next batch.
+
+        Args:
+            input_ids (list[int]): The token ids of the complete prompt.
+            max_new_tokens (int): The maximum number of generated tokens.
+            eos_token_ids (list[int]): The tokens which end the generation.
+            prefix_length (int): The number of leading input_ids shared with other prompts.
+            prefix_cache (str): The cache of the prefix, "instruction" or "document".
+            on_tokens (Callable | None): Receives the new tokens of every step, called from the batcher thread.
+            stop_strings (list[str] | None): Stop the generation once the output contains one of them.
+            stop_at_json_end (bool): Stop the generation once the first JSON object of the output is closed.
+            json_keys (list[str] | None): Constrain the output to a JSON object of these string keys.
+            decode (Callable | None): Decodes token ids to text, required for the stops and the schema.
+
+        Returns:
+            Future: Resolves to the generated token ids.
+        """
+        # at least one token has to be prefilled, short prefixes are not worth a cache entry
+        prefix_length = min(prefix_length, len(input_ids) - 1)
+        if (
+            not self.prefix_caches[prefix_cache].enabled
+            or prefix_length < settings.LLM_PREFIX_CACHE_MIN_TOKENS
+        ):
+            prefix_length = 0
+
+        request = GenerationRequest(
+            input_ids=list(input_ids),
+            max_new_tokens=max_new_tokens,
+            eos_token_ids=list(eos_token_ids),
+            prefix_length=prefix_length,
+            prefix_cache=prefix_cache,
+            on_tokens=on_tokens,
+            stop_strings=tuple(stop_strings or ()),
+            stop_at_json_end=stop_at_json_end,
+            json_keys=tuple(json_keys or ()) if decode is not None else (),
+            decode=decode,
+        )
+
+        # streamed requests need their own tokens, the others are coalesced.
+        # the prefix only changes how the prompt is prefilled, not the result
+        if on_tokens is None:
+            key = (
+                tuple(input_ids),
+                max_new_tokens,
+                tuple(eos_token_ids),
+                request.stop_strings,
+                stop_at_json_end,
+                request.json_keys,
+            )
+
+            with self.__in_flight_lock:
+                future = self.__in_flight.get(key)
+                if future is not None:
+                    self.coalesced += 1
+                    return future
+
+                self.__in_flight[key] = request.future
+
+            request.future.add_done_callback(lambda _: self.__forget(key))
+
+        self.__ensure_worker()
+        self.__queue.put(request)
+        return request.future
+
+    def __forget(self, key: tuple):
+        with self.__in_flight_lock:
+            self.__in_flight.pop(key, None)
+
+    def __collect_batch(self) -> list[GenerationRequest]:
+        batch = [self.__queue.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout <= 0:
+                    # take what is already waiting, but dont wait any longer
+                    batch.append(self.__queue.get_nowait())
+                else:
+                    batch.append(self.__queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def __run(self):
+        while True:
+            batch = self.__collect_batch()
+            try:
+                self.__generate_batch(batch)
+            except Exception as e:
+                print(f"Failed to generate batch of {len(batch)} requests: {e}")
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+    def __get_token_masks(self, request: GenerationRequest) -> TokenMasks | None:
+        if not request.json_keys:
+            return None
+
+        eos_token_ids = tuple(request.eos_token_ids)
+        if eos_token_ids in self.__token_masks:
+            return self.__token_masks[eos_token_ids]
+
+        if self.__token_texts is None:
+            print("Decoding the vocabulary for the response schemas...")
+            vocab_size = self.model.get_output_embeddings().weight.shape[0]
+            token_texts = []
+            for token_id in range(vocab_size):
+                try:
+                    token_texts.append(request.decode([token_id]))
+                except Exception:
+                    # ids of the embedding without a token
+                    token_texts.append("")
+            self.__token_texts = token_texts
+
+        self.__token_masks[eos_token_ids] = TokenMasks(
+            self.__token_texts, list(eos_token_ids)
+        )
+        return self.__token_masks[eos_token_ids]
+
+    def __prefix_past_key_values(
+        self, prefix_ids: tuple[int, ...], prefix_cache: PrefixCache
+    ) -> DynamicCache:
+        past_key_values = prefix_cache.get(prefix_ids)
+
+        if past_key_values is None:
+            print(f"Prefilling prefix of {len(prefix_ids)} tokens...")
+            with torch.inference_mode():
+                past_key_values = self.model(
+                    input_ids=torch.tensor(
+                        [list(prefix_ids)], device=self.model.device
+                    ),
+                    past_key_values=DynamicCache(),
+                    use_cache=True,
+                ).past_key_values
+            prefix_cache.put(prefix_ids, past_key_values)
+
+        return past_key_values
+
+    def __stack_past_key_values(
+        self, batch: list[GenerationRequest], prefix_length: int
+    ) -> DynamicCache | None:
+        # every distinct prefix of the batch is looked up (or prefilled) once
+        caches: dict[tuple[str, tuple[int, ...]], DynamicCache] = {}
+        for request in batch:
+            prefix_ids = tuple(request.input_ids[: request.prefix_length])
+            key = (request.prefix_cache, prefix_ids)
+            if prefix_ids and key not in caches:
+                caches[key] = self.__prefix_past_key_values(
+                    prefix_ids, self.prefix_caches[request.prefix_cache]
+                )
+
+        if not caches:
+            return None
+
+        # the rows are stacked into one new cache, the cached entries stay untouched.
+        # shorter prefixes are left padded with zeros, rows without prefix are all
+        # padding, the attention mask hides these positions
+        layers = {key: cache_layers(cache) for key, cache in caches.items()}
+        template = next(iter(layers.values()))
+
+        stacked = DynamicCache()
+        for layer_idx, (keys, values) in enumerate(template):
+            row_keys = []
+            row_values = []
+            for request in batch:
+                prefix_ids = tuple(request.input_ids[: request.prefix_length])
+                key = (request.prefix_cache, prefix_ids)
+                if key in layers:
+                    row_key, row_value = layers[key][layer_idx]
+                else:
+                    row_key, row_value = keys[:, :, :0], values[:, :, :0]
+
+                padding = prefix_length - row_key.shape[-2]
+                row_keys.append(torch.nn.functional.pad(row_key, (0, 0, padding, 0)))
+                row_values.append(
+                    torch.nn.functional.pad(row_value, (0, 0, padding, 0))
+                )
+
+            stacked.update(torch.cat(row_keys), torch.cat(row_values), layer_idx)
+
+        return stacked
+
+    def __generate_batch(self, batch: list[GenerationRequest]):
+        prefix_length = max(request.prefix_length for request in batch)
+        prefixes = {
+            (request.prefix_cache, tuple(request.input_ids[: request.prefix_length]))
+            for request in batch
+            if request.prefix_length
+        }
+        print(
+            f"Generating batch of {len(batch)} requests"
+            + (f" with {len(prefixes)} cached prefixes..." if prefixes else "...")
+        )
+
+        suffix_length = max(
+            len(request.input_ids) - request.prefix_length for request in batch
+        )
+
+        # every row is prefix and suffix, both left padded: the prefixes line up with
+        # the stacked cache and every row still continues directly after its own
+        # prompt (the positions are counted from the attention mask). Without any
+        # prefix this is plain left padding
+        input_ids = []
+        attention_mask = []
+        for request in batch:
+            prefix = request.input_ids[: request.prefix_length]
+            suffix = request.input_ids[request.prefix_length :]
+            prefix_padding = prefix_length - len(prefix)
+            suffix_padding = suffix_length - len(suffix)
+            input_ids.append(
+                [self.pad_token_id] * prefix_padding
+                + prefix
+                + [self.pad_token_id] * suffix_padding
+                + suffix
+            )
+            attention_mask.append(
+                [0] * prefix_padding
+                + [1] * len(prefix)
+                + [0] * suffix_padding
+                + [1] * len(suffix)
+            )
+
+        # generate ends every row at these tokens, so only the ones all rows share,
+        # the criteria stops every row at its own eos tokens
+        eos_token_ids = sorted(
+            set.intersection(*(set(request.eos_token_ids) for request in batch))
+        )
+
+        past_key_values = self.__stack_past_key_values(batch, prefix_length)
+
+        # collects the tokens of every row and resolves the requests whose row is done
+        criteria = BatchStoppingCriteria(batch)
+
+        logits_processor = LogitsProcessorList()
+        token_masks = [self.__get_token_masks(request) for request in batch]
+        if any(masks is not None for masks in token_masks):
+            logits_processor.append(JsonSchemaLogitsProcessor(batch, token_masks))
+
+        with torch.inference_mode():
+            self.model.generate(
+                input_ids=torch.tensor(input_ids, device=self.model.device),
+                attention_mask=torch.tensor(attention_mask, device=self.model.device),
+                past_key_values=past_key_values,
+                max_new_tokens=max(request.max_new_tokens for request in batch),
+                num_return_sequences=1,
+                pad_token_id=self.pad_token_id,
+                eos_token_id=eos_token_ids,
+                stopping_criteria=StoppingCriteriaList([criteria]),
+                logits_processor=logits_processor,
+            )
+
+        # rows generate can end without the criteria noticing (e.g. the maximum length of the model)
+        for row in range(len(batch)):
+            criteria.finish(row)
+
+
+__all__ = ["DynamicBatcher"]
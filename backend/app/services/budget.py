@@ -0,0 +1,260 @@
+# Context budgets of the generation stages.
+#
+# The context size is read from the config of the model (max_position_embeddings)
+# instead of a fixed 2048, and capped by the deployment: LLM_MAX_CONTEXT_TOKENS
+# and the memory the key/value states of a full batch may use on the device of
+# the engine (see app/services/kv_cache.py), fixed by the engine once the model
+# is loaded. Every stage asks for its budget here, so the input and output tokens
+# of all prompts are planned in one place.
+#
+# Within the budget of a stage, the tokens a prompt may generate scale with the
+# tokens of its input: a short tail chunk does not get the decode budget of a full
+# one. The generated tokens (counted by the batcher) are recorded against the
+# budget, so the policy can be tuned from real traffic (see /utils/capacity).
+
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+
+from app.services.engine import engine
+from app.services.json_stream import empty_json_object
+from app.services.llms import llama
+
+# the tokens every stage may generate
+STAGE_MAX_NEW_TOKENS = {
+    # summary of one section of the text (map phase)
+    "summarize_section": 300,
+    # summary of several summaries (reduce phase)
+    "summarize_reduce": 500,
+    # answer of the question within one chunk
+    "questionary_chunk": 600,
+    # final answer from the answers of the chunks
+    "questionary_final": 500,
+}
+
+# the stages whose prompts are chat messages, the chat template adds its tokens
+# around them. The questionary stages send raw prompts
+CHAT_TEMPLATE_STAGES = {"summarize_section", "summarize_reduce"}
+
+# (minimum, tokens per input token) of the generated tokens of every stage, the
+# result is capped by the budget of the stage
+STAGE_NEW_TOKENS_POLICY = {
+    "summarize_section": (64, 0.25),
+    "summarize_reduce": (96, 0.35),
+    # the answers quote a text excerpt of the chunk
+    "questionary_chunk": (96, 0.5),
+    "questionary_final": (96, 0.5),
+}
+
+
+@dataclass(frozen=True)
+class StageBudget:
+    stage: str
+    # tokens of the whole prompt including the generated tokens
+    context_tokens: int
+    # tokens left for the text (chunk, summaries or answers) of one prompt
+    max_input_tokens: int
+    max_new_tokens: int
+    # False if the generated tokens are fixed by the request options
+    scaled: bool = True
+    # the tokens the response schema needs to be closed, no prompt gets less
+    min_new_tokens: int = 1
+
+
+@lru_cache(maxsize=1)
+def context_tokens() -> int:
+    """
+    The context size of every prompt. The engine fixes it when it loads the model,
+    so the chunks of a text (and their cache keys) are the same in every worker.
+    """
+    return engine.context_tokens()
+
+
+@lru_cache(maxsize=1)
+def prompt_overhead_tokens() -> int:
+    """
+    The tokens the chat template adds around the messages of a prompt.
+    """
+    try:
+        # the template only needs the tokenizer, the model is not loaded for it
+        tokenizer = llama.get_chat_template_tokenizer()
+        prompt = tokenizer.apply_chat_template(
+            [{"role": "system", "content": ""}, {"role": "user", "content": ""}],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+        return len(tokenizer(prompt)["input_ids"])
+    except Exception as e:
+        print(f"Failed to count the tokens of the chat template: {e}")
+        return 0
+
+
+def max_new_tokens_option(stage: str, options: dict | None) -> int | None:
+    """
+    The generated tokens of the stage fixed by options["max_new_tokens"], either one
+    number for every stage or a dict by stage. None if the option is not set.
+    """
+    value = (options or {}).get("max_new_tokens")
+    if isinstance(value, dict):
+        value = value.get(stage)
+
+    if value is None:
+        return None
+
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        print(f"Invalid max_new_tokens option: {value}")
+        return None
+
+    return value if value > 0 else None
+
+
+def schema_new_tokens(json_keys: list[str] | None) -> int:
+    """
+    The generated tokens which always fit the empty object of the response schema.
+
+    The constrained decoding closes the object once the tokens left are just enough
+    for the rest of it, at one token per character (see app/services/batching.py).
+    """
+    if not json_keys:
+        return 1
+
+    return len(empty_json_object(json_keys)) + 1
+
+
+def plan_stage(
+    stage: str,
+    instructions_tokens: int,
+    options: dict | None = None,
+    json_keys: list[str] | None = None,
+) -> StageBudget:
+    """
+    The budget of one prompt of a stage.
+
+    Args:
+        stage (str): A key of STAGE_MAX_NEW_TOKENS.
+        instructions_tokens (int): The tokens of the instructions of the prompt.
+        options (dict | None): The request options, "max_new_tokens" overrides the policy.
+        json_keys (list[str] | None): The keys of the response schema of the stage.
+
+    Returns:
+        StageBudget: max_input_tokens is <= 0 if the instructions and the generated
+        tokens dont fit into the context.
+    """
+    context = context_tokens()
+    fixed = max_new_tokens_option(stage, options)
+    min_new_tokens = schema_new_tokens(json_keys)
+    max_new_tokens = max(fixed or STAGE_MAX_NEW_TOKENS[stage], min_new_tokens)
+    overhead = prompt_overhead_tokens() if stage in CHAT_TEMPLATE_STAGES else 0
+    max_input_tokens = context - overhead - instructions_tokens - max_new_tokens
+
+    return StageBudget(
+        stage=stage,
+        context_tokens=context,
+        max_input_tokens=max_input_tokens,
+        max_new_tokens=max_new_tokens,
+        scaled=fixed is None,
+        min_new_tokens=min_new_tokens,
+    )
+
+
+def scale_max_new_tokens(budget: StageBudget, input_tokens: int) -> int:
+    """
+    The tokens one prompt of the stage may generate for its input tokens.
+    """
+    if not budget.scaled:
+        return budget.max_new_tokens
+
+    minimum, ratio = STAGE_NEW_TOKENS_POLICY[budget.stage]
+    scaled = min(budget.max_new_tokens, int(minimum + ratio * input_tokens))
+    return max(budget.min_new_tokens, scaled)
+
+
+class GenerationStats:
+    """
+    Budgeted against actually generated tokens per stage, counted in this worker.
+    """
+
+    def __init__(self):
+        self.__stages: dict[str, dict] = {}
+        self.__lock = threading.Lock()
+
+    def record(
+        self,
+        stage: str,
+        input_tokens: list[int],
+        budgeted: list[int],
+        generated: list[int],
+    ):
+        """
+        Record the generations of a stage, one entry per prompt in every list.
+        """
+        with self.__lock:
+            stats = self.__stages.setdefault(
+                stage,
+                {
+                    "calls": 0,
+                    "input_tokens": 0,
+                    "budgeted_tokens": 0,
+                    "generated_tokens": 0,
+                    # calls which used at least 90% of their budget, likely cut off
+                    "near_budget": 0,
+                },
+            )
+            for inputs, budget, tokens in zip(
+                input_tokens, budgeted, generated, strict=True
+            ):
+                stats["calls"] += 1
+                stats["input_tokens"] += inputs
+                stats["budgeted_tokens"] += budget
+                stats["generated_tokens"] += tokens
+                stats["near_budget"] += int(tokens >= 0.9 * budget)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                stage: {
+                    **stats,
+                    "utilization": round(
+                        stats["generated_tokens"] / max(1, stats["budgeted_tokens"]), 3
+                    ),
+                }
+                for stage, stats in self.__stages.items()
+            }
+
+
+generation_stats = GenerationStats()
+
+
+def record_outputs(
+    stage: str,
+    input_tokens: list[int],
+    budgeted: list[int],
+    generated: list[int | None],
+):
+    """
+    Record the generated tokens of a stage against their budgets, the counts come
+    from the batcher with the outputs. Failed outputs (None) are skipped.
+    """
+    done = [i for i, tokens in enumerate(generated) if tokens is not None]
+    if not done:
+        return
+
+    generation_stats.record(
+        stage,
+        [input_tokens[i] for i in done],
+        [budgeted[i] for i in done],
+        [generated[i] for i in done],
+    )
+
+
+__all__ = [
+    "GenerationStats",
+    "StageBudget",
+    "context_tokens",
+    "generation_stats",
+    "plan_stage",
+    "record_outputs",
+    "scale_max_new_tokens",
+]
@@ -0,0 +1,482 @@
+# Inference engine: one process owns the model and every api worker talks to it
+# through a unix socket, so the http workers can be scaled without loading
+# additional copies of the weights.
+#
+# Run the engine with:
+#   python -m app.services.engine
+# and start the api with LLM_ENGINE_MODE="remote" (see scripts/start.sh).
+
+import os
+import threading
+import time
+from collections.abc import Iterator
+from multiprocessing.connection import Client, Connection, Listener
+
+from app.core.config import settings
+from app.services.kv_cache import model_context_tokens
+from app.services.llms import llama, utils
+
+
+class LocalEngine:
+    """
+    Runs the generations in the current process, used when LLM_ENGINE_MODE is "local"
+    and by the InferenceServer itself.
+
+    Every output comes with the number of tokens the batcher generated for it, so
+    the budgets can be checked without tokenizing the outputs again.
+    """
+
+    def __init__(self):
+        self.__context_tokens: int | None = None
+        self.__context_lock = threading.Lock()
+
+    def generate_from_messages(
+        self,
+        messages: list[dict[str, str]],
+        max_new_tokens: int = 150,
+        json_keys: list[str] | None = None,
+    ) -> tuple[str, int]:
+        model = llama.get_model()
+        tokenizer = llama.get_chat_tokenizer()
+
+        # concurrent calls are batched by the DynamicBatcher of the model
+        return utils.generate_output_from_model(
+            model=model,
+            tokenizer=tokenizer,
+            messages=messages,
+            max_new_tokens=max_new_tokens,
+            json_keys=json_keys,
+        )
+
+    def generate_many_from_messages(
+        self,
+        messages_list: list[list[dict[str, str]]],
+        max_new_tokens: int | list[int] = 150,
+        json_keys: list[str] | None = None,
+    ) -> tuple[list[str | None], list[int | None]]:
+        model = llama.get_model()
+        tokenizer = llama.get_chat_tokenizer()
+
+        return utils.generate_outputs_from_model(
+            model=model,
+            tokenizer=tokenizer,
+            messages_list=messages_list,
+            max_new_tokens=max_new_tokens,
+            json_keys=json_keys,
+        )
+
+    def generate_from_prompt(
+        self,
+        complete_prompt: str,
+        max_new_tokens: int = 150,
+        prefix: str | None = None,
+        prefix_cache: str = "instruction",
+        stop_strings: list[str] | None = None,
+        json_keys: list[str] | None = None,
+    ) -> tuple[str, int]:
+        pipe = llama.get_pipe()
+        tokenizer = llama.get_tokenizer()
+
+        return utils.generate_output_from_pipe(
+            pipe=pipe,
+            tokenizer=tokenizer,
+            complete_prompt=complete_prompt,
+            max_new_tokens=max_new_tokens,
+            prefix=prefix,
+            prefix_cache=prefix_cache,
+            stop_strings=stop_strings,
+            json_keys=json_keys,
+        )
+
+    def generate_many_from_prompt(
+        self,
+        complete_prompts: list[str],
+        max_new_tokens: int | list[int] = 150,
+        prefixes: list[str | None] | None = None,
+        prefix_cache: str = "instruction",
+        stop_strings: list[str] | None = None,
+        json_keys: list[str] | None = None,
+    ) -> tuple[list[str | None], list[int | None]]:
+        pipe = llama.get_pipe()
+        tokenizer = llama.get_tokenizer()
+
+        return utils.generate_outputs_from_pipe(
+            pipe=pipe,
+            tokenizer=tokenizer,
+            complete_prompts=complete_prompts,
+            max_new_tokens=max_new_tokens,
+            prefixes=prefixes,
+            prefix_cache=prefix_cache,
+            stop_strings=stop_strings,
+            json_keys=json_keys,
+        )
+
+    def stream_many_from_messages(
+        self,
+        messages_list: list[list[dict[str, str]]],
+        max_new_tokens: int | list[int] = 150,
+        json_keys: list[str] | None = None,
+    ) -> Iterator[dict]:
+        model = llama.get_model()
+        tokenizer = llama.get_chat_tokenizer()
+
+        yield from utils.stream_outputs_from_model(
+            model=model,
+            tokenizer=tokenizer,
+            messages_list=messages_list,
+            max_new_tokens=max_new_tokens,
+            json_keys=json_keys,
+        )
+
+    def stream_many_from_prompt(
+        self,
+        complete_prompts: list[str],
+        max_new_tokens: int | list[int] = 150,
+        prefixes: list[str | None] | None = None,
+        prefix_cache: str = "instruction",
+        stop_strings: list[str] | None = None,
+        json_keys: list[str] | None = None,
+    ) -> Iterator[dict]:
+        pipe = llama.get_pipe()
+        tokenizer = llama.get_tokenizer()
+
+        yield from utils.stream_outputs_from_pipe(
+            pipe=pipe,
+            tokenizer=tokenizer,
+            complete_prompts=complete_prompts,
+            max_new_tokens=max_new_tokens,
+            prefixes=prefixes,
+            prefix_cache=prefix_cache,
+            stop_strings=stop_strings,
+            json_keys=json_keys,
+        )
+
+    def context_tokens(self) -> int:
+        # depends on the free memory of the device of the model, so it is computed
+        # once by the process which owns the model and then fixed: every worker and
+        # every later request chunk the texts the same way
+        with self.__context_lock:
+            if self.__context_tokens is None:
+                self.__context_tokens = model_context_tokens(llama.get_config())
+            return self.__context_tokens
+
+
+def engine_authkey() -> bytes:
+    """
+    The authkey of the engine socket. Messages on the socket are pickled, so an
+    unauthenticated socket would run the code of any local user who can connect.
+    """
+    if not settings.LLM_ENGINE_AUTHKEY:
+        raise Exception("LLM_ENGINE_AUTHKEY must be set to use the inference engine.")
+
+    return settings.LLM_ENGINE_AUTHKEY.encode()
+
+
+class InferenceServer:
+    """
+    Owns the model and serves the generation requests of all api workers.
+
+    Every connection is handled by its own thread, the generations of all
+    connections are batched by the DynamicBatcher of the model. Stream operations
+    answer with one message per event and a final {"ok": True, "done": True}.
+    """
+
+    operations = [
+        "generate_from_messages",
+        "generate_many_from_messages",
+        "generate_from_prompt",
+        "generate_many_from_prompt",
+        "context_tokens",
+    ]
+
+    stream_operations = [
+        "stream_many_from_messages",
+        "stream_many_from_prompt",
+    ]
+
+    def __init__(self, address: str = settings.LLM_ENGINE_SOCKET):
+        self.address = address
+        self.engine = LocalEngine()
+
+    def __handle_connection(self, conn: Connection):
+        try:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    break
+
+                op = request.get("op") if isinstance(request, dict) else None
+
+                if op in self.stream_operations:
+                    try:
+                        events = getattr(self.engine, op)(**request.get("kwargs", {}))
+                        for event in events:
+                            conn.send({"ok": True, "event": event})
+                        conn.send({"ok": True, "done": True})
+                    except (EOFError, OSError) as e:
+                        # the client went away while streaming, nobody to answer
+                        print(f"Client disconnected during {op}: {e}")
+                        break
+                    except Exception as e:
+                        print(f"Engine failed on {op}: {e}")
+                        if not self.__send_error(conn, str(e)):
+                            break
+                    continue
+
+                if op not in self.operations:
+                    if not self.__send_error(conn, f"Unknown operation: {op}"):
+                        break
+                    continue
+
+                try:
+                    result = getattr(self.engine, op)(**request.get("kwargs", {}))
+                except Exception as e:
+                    print(f"Engine failed on {op}: {e}")
+                    if not self.__send_error(conn, str(e)):
+                        break
+                    continue
+
+                try:
+                    conn.send({"ok": True, "result": result})
+                except (EOFError, OSError) as e:
+                    print(f"Client disconnected during {op}: {e}")
+                    break
+                except Exception as e:
+                    print(f"Failed to send the result of {op}: {e}")
+                    if not self.__send_error(conn, str(e)):
+                        break
+        finally:
+            conn.close()
+
+    def __send_error(self, conn: Connection, error: str) -> bool:
+        """
+        Answer a request with an error, False if the client is gone.
+        """
+        try:
+            conn.send({"ok": False, "error": error})
+            return True
+        except (EOFError, OSError) as e:
+            print(f"Failed to send error to the client: {e}")
+            return False
+
+    def serve_forever(self):
+        print("Loading model for the inference engine...")
+        # load the weights and the chat format and fix the context size (with the
+        # memory left by the weights) before accepting any connection
+        llama.get_pipe()
+        llama.get_chat_tokenizer()
+        self.engine.context_tokens()
+
+        authkey = engine_authkey()
+
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+        # only the user of the engine may connect to the socket (0600)
+        umask = os.umask(0o177)
+        try:
+            listener = Listener(self.address, family="AF_UNIX", authkey=authkey)
+        finally:
+            os.umask(umask)
+
+        with listener:
+            print(f"Inference engine listening on {self.address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    print(f"Failed to accept connection: {e}")
+                    continue
+
+                threading.Thread(
+                    target=self.__handle_connection, args=(conn,), daemon=True
+                ).start()
+
+
+class InferenceClient:
+    """
+    Thin client used by the api workers, mirrors the LocalEngine interface.
+
+    Connections are not thread safe, so every thread of the worker (fastapi runs
+    sync endpoints in a threadpool) keeps its own connection to the engine.
+    """
+
+    def __init__(self, address: str = settings.LLM_ENGINE_SOCKET):
+        self.address = address
+        self.__local = threading.local()
+
+    def __connect(self) -> Connection:
+        conn = getattr(self.__local, "conn", None)
+        if conn is not None:
+            return conn
+
+        self.__local.conn = self.__open()
+        return self.__local.conn
+
+    def __open(self) -> Connection:
+        authkey = engine_authkey()
+        deadline = time.monotonic() + settings.LLM_ENGINE_CONNECT_TIMEOUT
+
+        while True:
+            try:
+                conn = Client(self.address, family="AF_UNIX", authkey=authkey)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                # the engine is still loading the model
+                if time.monotonic() > deadline:
+                    raise Exception(f"Inference engine not reachable on {self.address}")
+                time.sleep(1)
+
+        return conn
+
+    def __call(self, op: str, **kwargs):
+        for attempt in range(2):
+            conn = self.__connect()
+            try:
+                conn.send({"op": op, "kwargs": kwargs})
+                response = conn.recv()
+                break
+            except (EOFError, OSError) as e:
+                # engine restarted, reconnect once
+                print(f"Lost connection to the inference engine: {e}")
+                conn.close()
+                self.__local.conn = None
+                if attempt:
+                    raise Exception("Lost connection to the inference engine.")
+
+        if not response.get("ok"):
+            raise Exception(response.get("error", "Inference engine failed."))
+
+        return response["result"]
+
+    def __stream(self, op: str, **kwargs) -> Iterator[dict]:
+        # a stream is consumed step by step (possibly from different threads of the
+        # threadpool), so it gets its own connection instead of the thread local one
+        conn = self.__open()
+        try:
+            conn.send({"op": op, "kwargs": kwargs})
+            while True:
+                try:
+                    response = conn.recv()
+                except (EOFError, OSError) as e:
+                    print(f"Lost connection to the inference engine: {e}")
+                    raise Exception("Lost connection to the inference engine.")
+
+                if not response.get("ok"):
+                    raise Exception(response.get("error", "Inference engine failed."))
+
+                if response.get("done"):
+                    return
+
+                yield response["event"]
+        finally:
+            conn.close()
+
+    def generate_from_messages(
+        self,
+        messages: list[dict[str, str]],
+        max_new_tokens: int = 150,
+        json_keys: list[str] | None = None,
+    ) -> tuple[str, int]:
+        return self.__call(
+            "generate_from_messages",
+            messages=messages,
+            max_new_tokens=max_new_tokens,
+            json_keys=json_keys,
+        )
+
+    def generate_many_from_messages(
+        self,
+        messages_list: list[list[dict[str, str]]],
+        max_new_tokens: int | list[int] = 150,
+        json_keys: list[str] | None = None,
+    ) -> tuple[list[str | None], list[int | None]]:
+        return self.__call(
+            "generate_many_from_messages",
+            messages_list=messages_list,
+            max_new_tokens=max_new_tokens,
+            json_keys=json_keys,
+        )
+
+    def generate_from_prompt(
+        self,
+        complete_prompt: str,
+        max_new_tokens: int = 150,
+        prefix: str | None = None,
+        prefix_cache: str = "instruction",
+        stop_strings: list[str] | None = None,
+        json_keys: list[str] | None = None,
+    ) -> tuple[str, int]:
+        return self.__call(
+            "generate_from_prompt",
+            complete_prompt=complete_prompt,
+            max_new_tokens=max_new_tokens,
+            prefix=prefix,
+            prefix_cache=prefix_cache,
+            stop_strings=stop_strings,
+            json_keys=json_keys,
+        )
+
+    def generate_many_from_prompt(
+        self,
+        complete_prompts: list[str],
+        max_new_tokens: int | list[int] = 150,
+        prefixes: list[str | None] | None = None,
+        prefix_cache: str = "instruction",
+        stop_strings: list[str] | None = None,
+        json_keys: list[str] | None = None,
+    ) -> tuple[list[str | None], list[int | None]]:
+        return self.__call(
+            "generate_many_from_prompt",
+            complete_prompts=complete_prompts,
+            max_new_tokens=max_new_tokens,
+            prefixes=prefixes,
+            prefix_cache=prefix_cache,
+            stop_strings=stop_strings,
+            json_keys=json_keys,
+        )
+
+    def stream_many_from_messages(
+        self,
+        messages_list: list[list[dict[str, str]]],
+        max_new_tokens: int | list[int] = 150,
+        json_keys: list[str] | None = None,
+    ) -> Iterator[dict]:
+        return self.__stream(
+            "stream_many_from_messages",
+            messages_list=messages_list,
+            max_new_tokens=max_new_tokens,
+            json_keys=json_keys,
+        )
+
+    def stream_many_from_prompt(
+        self,
+        complete_prompts: list[str],
+        max_new_tokens: int | list[int] = 150,
+        prefixes: list[str | None] | None = None,
+        prefix_cache: str = "instruction",
+        stop_strings: list[str] | None = None,
+        json_keys: list[str] | None = None,
+    ) -> Iterator[dict]:
+        return self.__stream(
+            "stream_many_from_prompt",
+            complete_prompts=complete_prompts,
+            max_new_tokens=max_new_tokens,
+            prefixes=prefixes,
+            prefix_cache=prefix_cache,
+            stop_strings=stop_strings,
+            json_keys=json_keys,
+        )
+
+    def context_tokens(self) -> int:
+        return self.__call("context_tokens")
+
+
+engine = InferenceClient() if settings.LLM_ENGINE_MODE == "remote" else LocalEngine()
+
+__all__ = ["engine"]
+
+
+if __name__ == "__main__":
+    InferenceServer().serve_forever()
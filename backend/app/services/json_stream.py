@@ -0,0 +1,287 @@
+# Tracking and constraining of the JSON object the model is generating.
+#
+# Every prompt asks for a single JSON object and everything the model writes
+# after it is thrown away by extract_and_validate_json_objects. The tracker
+# follows the decoded tokens of one row (brace depth, strings and escapes) so
+# the batcher can stop the row as soon as the top level object is closed.
+#
+# The response schemas of the services are fixed, flat objects of string values
+# (e.g. {"Title":"","Summary":""}). A JsonSchemaGrammar describes one of them as
+# a sequence of literal parts and free string values, TokenMasks turns a state
+# of the grammar into the mask of the tokens the model may generate next. The
+# masks are computed once per state and reused by every step and every row.
+
+import json
+
+import torch
+
+
+class JsonObjectTracker:
+    """
+    Follows the generated text of one row until its first top level JSON object is closed.
+
+    Text before the first "{" is skipped, braces inside of strings are not counted.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.closed = False
+
+    def feed(self, text: str) -> bool:
+        """
+        Follow the next piece of the generated text.
+
+        Args:
+            text (str): The decoded text of the new tokens.
+
+        Returns:
+            bool: Whether the top level object is closed.
+        """
+        for char in text:
+            if self.closed:
+                break
+
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+
+            if char == "{":
+                self.depth += 1
+            elif self.depth == 0:
+                # quotes and braces before the object are not part of it
+                continue
+            elif char == '"':
+                self.in_string = True
+            elif char == "}":
+                self.depth -= 1
+                self.closed = self.depth == 0
+
+        return self.closed
+
+
+def empty_json_object(keys: list[str]) -> str:
+    """
+    The empty JSON object of the keys, as shown to the model in the prompts.
+    """
+    return json.dumps(
+        dict.fromkeys(keys, ""), ensure_ascii=False, separators=(",", ":")
+    )
+
+
+# the characters which may follow a backslash in a JSON string
+JSON_ESCAPES = '"\\/bfnrt'
+
+
+class JsonSchemaGrammar:
+    """
+    A flat JSON object of string values with fixed keys in a fixed order, without whitespace.
+
+    A state is (part, position, escaped): the part of the object which is generated,
+    the position within it if it is a literal part and whether the last character of
+    a string value was a backslash. Every string value is followed by a literal part
+    which starts with its closing quote.
+
+    Args:
+        keys (list[str]): The keys of the object, in order.
+    """
+
+    def __init__(self, keys: list[str]):
+        self.keys = tuple(keys)
+        # literal parts are strings, the string values are None
+        self.parts: list[str | None] = []
+        for i, key in enumerate(self.keys):
+            opening = "{" if i == 0 else '",'
+            self.parts.append(f'{opening}{json.dumps(key, ensure_ascii=False)}:"')
+            self.parts.append(None)
+        self.parts.append('"}' if self.keys else "{}")
+
+        # literal characters from the start of every part to the end of the object
+        self.__literal_after = [0] * (len(self.parts) + 1)
+        for i in range(len(self.parts) - 1, -1, -1):
+            self.__literal_after[i] = self.__literal_after[i + 1] + len(
+                self.parts[i] or ""
+            )
+
+    @property
+    def initial_state(self) -> tuple[int, int, bool]:
+        return (0, 0, False)
+
+    def is_complete(self, state: tuple[int, int, bool]) -> bool:
+        return state[0] == len(self.parts)
+
+    def remaining_literal(self, state: tuple[int, int, bool]) -> int:
+        """
+        The number of literal characters which are still to be generated.
+        """
+        part, position, _ = state
+        return self.__literal_after[part] - position
+
+    def advance(self, state: tuple[int, int, bool], text: str):
+        """
+        Follow the text from the state.
+
+        Returns:
+            (tuple[int, int, bool] | None): The new state, None if the text breaks the schema.
+        """
+        part, position, escaped = state
+
+        for char in text:
+            if part == len(self.parts):
+                # nothing may follow the object
+                return None
+
+            literal = self.parts[part]
+
+            if literal is not None:
+                if char != literal[position]:
+                    return None
+                position += 1
+                if position == len(literal):
+                    part, position = part + 1, 0
+            elif escaped:
+                if char not in JSON_ESCAPES:
+                    return None
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                # the closing quote is the first character of the next literal part
+                part, position = part + 1, 1
+                if position == len(self.parts[part]):
+                    part, position = part + 1, 0
+            elif ord(char) < 0x20:
+                return None
+
+        return (part, position, escaped)
+
+
+class TokenMasks:
+    """
+    The tokens allowed in every state of a grammar, computed once per state.
+
+    Args:
+        token_texts (list[str]): The decoded text of every token id, empty for special tokens.
+        eos_token_ids (list[int]): The tokens which end the generation once the object is complete.
+    """
+
+    def __init__(self, token_texts: list[str], eos_token_ids: list[int]):
+        self.token_texts = token_texts
+        self.eos_token_ids = [
+            token_id for token_id in eos_token_ids if token_id < len(token_texts)
+        ]
+        # a trie of depth one: the candidates of a literal part are only the tokens
+        # which start with its next character
+        self.__by_first_char: dict[str, list[int]] = {}
+        for token_id, text in enumerate(token_texts):
+            if text:
+                self.__by_first_char.setdefault(text[0], []).append(token_id)
+
+        # tokens which stay inside of a string value (no quote, valid escapes),
+        # the same for every string value of every grammar
+        string_grammar = JsonSchemaGrammar(["_"])
+        string_state = (1, 0, False)
+        self.__string_tokens = [
+            token_id
+            for token_id, text in enumerate(token_texts)
+            if text
+            and '"' not in text
+            and string_grammar.advance(string_state, text) is not None
+        ]
+        self.__quote_tokens = [
+            token_id for token_id, text in enumerate(token_texts) if '"' in text
+        ]
+        self.__masks: dict[tuple, torch.Tensor] = {}
+
+    def __candidates(self, grammar: JsonSchemaGrammar, state: tuple[int, int, bool]):
+        part, position, escaped = state
+
+        if grammar.parts[part] is not None:
+            return self.__by_first_char.get(grammar.parts[part][position], [])
+
+        if escaped:
+            return [
+                token_id
+                for char in JSON_ESCAPES
+                for token_id in self.__by_first_char.get(char, [])
+            ]
+
+        return self.__quote_tokens
+
+    def __allowed(
+        self, grammar: JsonSchemaGrammar, state: tuple[int, int, bool], close: bool
+    ) -> list[int]:
+        if grammar.is_complete(state):
+            return self.eos_token_ids
+
+        allowed = []
+        remaining = grammar.remaining_literal(state)
+        for token_id in self.__candidates(grammar, state):
+            text = self.token_texts[token_id]
+            new_state = grammar.advance(state, text)
+            if new_state is None:
+                continue
+            # closing: only literal characters, the values are not extended anymore
+            if close and grammar.remaining_literal(new_state) != remaining - len(text):
+                continue
+            allowed.append(token_id)
+
+        in_string = grammar.parts[state[0]] is None
+        if in_string and not state[2] and not close:
+            allowed.extend(self.__string_tokens)
+
+        return allowed
+
+    def mask(
+        self,
+        grammar: JsonSchemaGrammar,
+        state: tuple[int, int, bool],
+        size: int,
+        device: torch.device,
+        close: bool = False,
+    ) -> torch.Tensor | None:
+        """
+        The allowed tokens of the state as bool mask.
+
+        Args:
+            grammar (JsonSchemaGrammar): The schema of the row.
+            state (tuple[int, int, bool]): The state of the row.
+            size (int): The size of the vocabulary of the model output.
+            device (torch.device): The device of the scores.
+            close (bool): Only allow tokens which close the object, the values are not extended.
+
+        Returns:
+            (torch.Tensor | None): True for every allowed token id, None if no token fits.
+        """
+        key = (grammar.keys, state, size, str(device), close)
+        if key in self.__masks:
+            return self.__masks[key]
+
+        allowed = self.__allowed(grammar, state, close)
+        if close and not allowed:
+            # e.g. an escape has to be finished first
+            allowed = self.__allowed(grammar, state, False)
+
+        allowed = [token_id for token_id in allowed if token_id < size]
+        mask = None
+        if allowed:
+            mask = torch.zeros(size, dtype=torch.bool)
+            mask[allowed] = True
+            mask = mask.to(device)
+
+        self.__masks[key] = mask
+        return mask
+
+
+__all__ = [
+    "JsonObjectTracker",
+    "JsonSchemaGrammar",
+    "TokenMasks",
+    "empty_json_object",
+]
@@ -0,0 +1,192 @@
+# Cache of computed past-key-values for prompt prefixes.
+#
+# Most prompts start with the same long instruction (or chat template prefix),
+# which would otherwise be prefilled again by every generate call. The batcher
+# computes the key/value states of such a prefix once, keeps them here and
+# continues every prompt with that prefix from the cached states.
+
+import threading
+from collections import OrderedDict
+
+import psutil
+import torch
+
+from app.core.config import settings
+
+DTYPE_BYTES = {"float32": 4, "float16": 2, "bfloat16": 2}
+
+# context size used if the config of the model does not name one
+DEFAULT_CONTEXT_TOKENS = 2048
+
+
+def cache_layers(past_key_values) -> list[tuple]:
+    """
+    The (keys, values) tensors of every layer of a cache.
+    """
+    if hasattr(past_key_values, "layers"):
+        return [(layer.keys, layer.values) for layer in past_key_values.layers]
+
+    return list(
+        zip(past_key_values.key_cache, past_key_values.value_cache, strict=True)
+    )
+
+
+def cache_nbytes(past_key_values) -> int:
+    """
+    The memory used by the key/value tensors of a cache.
+    """
+    tensors = [
+        tensor
+        for layer in cache_layers(past_key_values)
+        for tensor in layer
+        if tensor is not None
+    ]
+
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def kv_bytes_per_token(config) -> int:
+    """
+    The memory of the key/value states of one token over all layers.
+    """
+    layers = getattr(config, "num_hidden_layers", None)
+    heads = getattr(config, "num_attention_heads", None)
+    hidden_size = getattr(config, "hidden_size", None)
+    if not layers or not heads or not hidden_size:
+        return 0
+
+    kv_heads = getattr(config, "num_key_value_heads", None) or heads
+    head_dim = getattr(config, "head_dim", None) or hidden_size // heads
+
+    dtype = settings.LLM_TORCH_DTYPE
+    if dtype not in DTYPE_BYTES:
+        dtype = getattr(config, "dtype", None) or getattr(config, "torch_dtype", None)
+        dtype = str(dtype or "bfloat16").replace("torch.", "")
+
+    return 2 * layers * kv_heads * head_dim * DTYPE_BYTES.get(dtype, 2)
+
+
+def kv_cache_bytes() -> int:
+    """
+    The memory the key/value states of one batch may use, LLM_KV_CACHE_MB or a
+    quarter of the free memory of the device.
+    """
+    if settings.LLM_KV_CACHE_MB > 0:
+        return settings.LLM_KV_CACHE_MB * 1024**2
+
+    if torch.cuda.is_available():
+        free, _ = torch.cuda.mem_get_info()
+    else:
+        free = psutil.virtual_memory().available
+
+    return free // 4
+
+
+def memory_context_tokens(config) -> int:
+    """
+    The context every row of a full batch can keep in the key/value memory, 0 if
+    the config does not describe the attention layers.
+
+    Only meaningful in the process which owns the model (the device memory is
+    read here), the api workers of a remote engine ask the engine for it.
+    """
+    per_token = kv_bytes_per_token(config)
+    if not per_token:
+        return 0
+
+    return kv_cache_bytes() // (per_token * max(1, settings.LLM_MAX_BATCH_SIZE))
+
+
+def model_context_tokens(config) -> int:
+    """
+    The context size of every prompt: the context of the model, capped by
+    LLM_MAX_CONTEXT_TOKENS and by the key/value memory of a full batch.
+
+    The memory cap is rounded down to a power of two, engines which start with a bit
+    more or less free memory still chunk the texts the same way.
+    """
+    limit = getattr(config, "max_position_embeddings", None) or DEFAULT_CONTEXT_TOKENS
+    print(f"Context size of the model: {limit}")
+
+    if settings.LLM_MAX_CONTEXT_TOKENS > 0:
+        limit = min(limit, settings.LLM_MAX_CONTEXT_TOKENS)
+
+    # every row of a full batch keeps the states of its whole context
+    memory_limit = memory_context_tokens(config)
+    if memory_limit:
+        memory_limit = 1 << (memory_limit.bit_length() - 1)
+        limit = min(limit, max(memory_limit, DEFAULT_CONTEXT_TOKENS))
+
+    print(f"Context size of the prompts: {limit}")
+    return limit
+
+
+class PrefixCache:
+    """
+    LRU cache of past-key-values keyed by the token ids of the prefix.
+
+    Args:
+        max_bytes (int): The memory budget of all cached entries, 0 disables the cache.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.__entries: OrderedDict[tuple[int, ...], tuple[object, int]] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, prefix_ids: tuple[int, ...]):
+        with self.__lock:
+            entry = self.__entries.get(prefix_ids)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.__entries.move_to_end(prefix_ids)
+            return entry[0]
+
+    def put(self, prefix_ids: tuple[int, ...], past_key_values):
+        nbytes = cache_nbytes(past_key_values)
+
+        if not self.enabled or nbytes > self.max_bytes:
+            return
+
+        with self.__lock:
+            if prefix_ids in self.__entries:
+                return
+
+            # evict the least recently used prefixes until the new one fits
+            while self.__entries and self.current_bytes + nbytes > self.max_bytes:
+                _, (_, evicted_bytes) = self.__entries.popitem(last=False)
+                self.current_bytes -= evicted_bytes
+
+            self.__entries[prefix_ids] = (past_key_values, nbytes)
+            self.current_bytes += nbytes
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "entries": len(self.__entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+__all__ = [
+    "PrefixCache",
+    "cache_layers",
+    "cache_nbytes",
+    "kv_bytes_per_token",
+    "memory_context_tokens",
+    "model_context_tokens",
+]
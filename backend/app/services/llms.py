@@ -1,9 +1,12 @@
+import copy
 import os
 
 os.environ["CUDA_LAUNCH_BLOCKING"] = "1"
 
-import nltk, torch
+import nltk, torch, threading, queue
+from typing import Callable, Iterator
 from trl import setup_chat_format
+from trl.models.utils import ChatMlSpecialTokens
 from transformers import (
     AutoTokenizer,
     pipeline,
@@ -16,6 +19,7 @@ from transformers import (
     PreTrainedModel,
 )
 from app.core.config import settings
+from app.services.batching import DynamicBatcher
 
 
 # nltk.download("punkt")
@@ -126,10 +130,19 @@ class LLamaModel:
         self.pipe: Pipeline | None = None
         self.tokenizer: (PreTrainedTokenizer | PreTrainedTokenizerFast) | None = None
         self.config: PretrainedConfig | None = None
+        # the single copy of the weights per process, shared by the raw prompt
+        # pipeline (self.pipe) and the chat template path (self.chat_tokenizer)
+        self.model: PreTrainedModel | None = None
+        self.chat_tokenizer: (
+            PreTrainedTokenizer | PreTrainedTokenizerFast
+        ) | None = None
+        self.__model_lock = threading.RLock()
         self.occurred_errors = []
         self.last_error = None
         self.current_pipe_setting = "text-generation"
-        self.__initiate()
+        # with a dedicated inference engine (LLM_ENGINE_MODE="remote") the api
+        # workers only need the tokenizer, the engine process owns the weights
+        self.__initiate(load_model=settings.LLM_ENGINE_MODE != "remote")
 
     def __handle_errors(self, e: Exception, step: str, custom_message: str = None):
         print(f"An error occurred in step {step}: {e}")
@@ -139,10 +152,13 @@ class LLamaModel:
         self.last_error = e
         return "An error occurred."
 
-    def __initiate(self):
+    def __initiate(self, load_model: bool = True):
         if self.pipe and self.tokenizer and self.config:
             return print("Model already initiated.")
 
+        if not load_model and self.tokenizer and self.config:
+            return print("Tokenizer already initiated.")
+
         print("Loading nltk...")
         nltk.download("punkt")
         nltk.download("punkt_tab")
@@ -154,10 +170,20 @@ class LLamaModel:
         exception = self.__load_config()
         if exception:
             raise Exception(self.last_error)
+
+        if not load_model:
+            return print("Tokenizer initiated, model weights are served by the engine.")
+
         exception = self.__load_pipe()
         if exception:
             raise Exception(self.last_error)
 
+        # setup_chat_format resizes the embeddings of the shared model, done before
+        # any generation instead of on the first chat request
+        exception = self.__load_chat_tokenizer()
+        if exception:
+            raise Exception(self.last_error)
+
         print("Model initiated.")
 
         self.current_pipe_setting = "text-generation"
@@ -213,22 +239,123 @@ class LLamaModel:
                     "Failed to load pipeline, because cant load config...",
                 )
 
+        exception = self.__load_model()
+        if exception:
+            return self.__handle_errors(
+                self.last_error,
+                "loading_pipe",
+                "Failed to load pipeline, because cant load model...",
+            )
+
         print("Loading pipeline...")
         try:
+            # the pipeline wraps the already loaded model instead of loading
+            # its own copy of the weights
             self.pipe = pipeline(
                 task,
                 tokenizer=self.tokenizer,
-                model=settings.LLM_MODEL_ID,
+                model=self.model,
                 framework="pt",
-                torch_dtype=torch.bfloat16,
-                device_map="auto",
-                token=settings.HF_TKN,
-                config=self.config,
             )
             return print("Pipeline loaded.")
         except Exception as e:
             return self.__handle_errors(e, "loading_pipe", "Failed to load pipeline.")
 
+    def __resolve_torch_dtype(self) -> torch.dtype:
+        # one dtype policy for every generation path, LLM_TORCH_DTYPE="auto"
+        # picks bf16 where supported and falls back to fp16 on older gpus
+        dtypes = {
+            "bfloat16": torch.bfloat16,
+            "float16": torch.float16,
+            "float32": torch.float32,
+        }
+        if settings.LLM_TORCH_DTYPE in dtypes:
+            return dtypes[settings.LLM_TORCH_DTYPE]
+
+        if torch.cuda.is_available() and not torch.cuda.is_bf16_supported():
+            return torch.float16
+
+        return torch.bfloat16
+
+    def __load_model(self):
+        if self.model is not None:
+            return None
+
+        with self.__model_lock:
+            if self.model is not None:
+                return None
+
+            try:
+                if torch.cuda.is_available():
+                    print("Setting device...")
+                    device_index = torch.cuda.current_device()
+                    torch.cuda.set_device(device_index)
+
+                torch_dtype = self.__resolve_torch_dtype()
+                print(f"Loading model weights as {torch_dtype}...")
+                model = AutoModelForCausalLM.from_pretrained(
+                    settings.LLM_MODEL_ID,
+                    low_cpu_mem_usage=True,
+                    return_dict=True,
+                    torch_dtype=torch_dtype,
+                    device_map="auto",
+                    token=settings.HF_TKN,
+                )
+
+                # sampling settings belong to the generation config of the model,
+                # so both generation paths use the same ones
+                sampling_keys = [
+                    "top_p",
+                    "top_k",
+                    "temperature",
+                    "repetition_penalty",
+                    "typical_p",
+                ]
+                for key in sampling_keys:
+                    value = getattr(self.config, key, None) if self.config else None
+                    if value is not None:
+                        setattr(model.generation_config, key, value)
+
+                self.model = model
+                return print("Model loaded.")
+
+            except Exception as e:
+                return self.__handle_errors(e, "loading_model", "Failed to load model.")
+
+    def __load_chat_tokenizer(self):
+        if self.chat_tokenizer is not None:
+            return None
+
+        with self.__model_lock:
+            if self.chat_tokenizer is not None:
+                return None
+
+            exception = self.__load_model()
+            if exception:
+                return exception
+
+            try:
+                print("Loading chat tokenizer...")
+                # own tokenizer instance, setup_chat_format adds the chat special tokens
+                # in place and the raw prompt pipeline keeps using the original one
+                tokenizer = AutoTokenizer.from_pretrained(
+                    settings.LLM_MODEL_ID, token=settings.HF_TKN
+                )
+
+                print("applying chat format configurations...")
+                # resizes the embeddings of the shared model for the added tokens,
+                # the ids of the original vocabulary stay the same
+                model, tokenizer = setup_chat_format(self.model, tokenizer)
+
+                self.model = model
+                self.chat_tokenizer = tokenizer
+                return print("Chat tokenizer loaded.")
+
+            except Exception as e:
+                return self.__handle_errors(
+                    e, "loading_chat_tokenizer", "Failed to load chat tokenizer."
+                )
+
     def __initiate_custom_pipe_without_configs(self, task: str):
         raise Exception("Not implemented yet.")
         if not self.tokenizer:
@@ -317,6 +444,39 @@ class LLamaModel:
 
         return self.config
 
+    def get_model(self):
+        if self.model is None:
+            self.__initiate()
+
+        return self.model
+
+    def get_chat_tokenizer(self):
+        if self.chat_tokenizer is None:
+            if self.__load_chat_tokenizer():
+                raise Exception(self.last_error)
+
+        return self.chat_tokenizer
+
+    def get_chat_template_tokenizer(self):
+        """
+        A tokenizer with the chat format of the chat tokenizer, for counting tokens.
+
+        setup_chat_format adds the chat tokens to the tokenizer and resizes the
+        embeddings of the model for them. Without the model in this process (api
+        workers of a remote engine) only the tokenizer half is applied to a copy.
+        """
+        if self.chat_tokenizer is not None:
+            return self.chat_tokenizer
+
+        tokenizer = copy.deepcopy(self.get_tokenizer())
+        chat_format = ChatMlSpecialTokens()
+        tokenizer.add_special_tokens(
+            {"additional_special_tokens": [chat_format.bos_token, chat_format.eos_token]}
+        )
+        tokenizer.chat_template = chat_format.chat_template
+
+        return tokenizer
+
     def generate_chat_based_assistant(
         self, instruction: str
     ) -> tuple[PreTrainedModel, PreTrainedTokenizer, list[dict[str, str]]] | str:
@@ -344,37 +504,20 @@ class LLamaModel:
         try:
             print("Generating chat-based assistant...")
 
-            print("Loading model...")
-            tokenizer = AutoTokenizer.from_pretrained(
-                settings.LLM_MODEL_ID, token=settings.HF_TKN
-            )
-
-            print("Setting device...")
-            device_index = torch.cuda.current_device()
-            torch.cuda.set_device(device_index)
-
-            print("initiating model...")
-            model = AutoModelForCausalLM.from_pretrained(
-                settings.LLM_MODEL_ID,
-                low_cpu_mem_usage=True,
-                return_dict=True,
-                torch_dtype=torch.float16,
-                device_map="auto",
-            )
-
-            print("applying chat format configurations...")
-            model, tokenizer = setup_chat_format(model, tokenizer)
+            exception = self.__load_chat_tokenizer()
+            if exception:
+                return exception
 
             print("prepare template messages using the provided system instructions...")
-            # template messages
+            # every request gets its own message list, the model and tokenizer are shared
             messages = [
                 {"role": "system", "content": instruction},
             ]
 
             print("done!")
             return (
-                model,
-                tokenizer,
+                self.model,
+                self.chat_tokenizer,
                 messages,
             )
 
@@ -387,6 +530,57 @@ class LLamaModel:
 
 
 class LLMUtils:
+    def __init__(self):
+        # one batcher per model, all concurrent generations of the process go through it
+        self.__batchers: dict[int, DynamicBatcher] = {}
+        self.__batchers_lock = threading.Lock()
+
+    def __get_batcher(
+        self, model: PreTrainedModel, tokenizer: PreTrainedTokenizer
+    ) -> DynamicBatcher:
+        batcher = self.__batchers.get(id(model))
+        if batcher is not None:
+            return batcher
+
+        with self.__batchers_lock:
+            if id(model) not in self.__batchers:
+                pad_token_id = tokenizer.pad_token_id
+                if pad_token_id is None:
+                    pad_token_id = tokenizer.eos_token_id
+                self.__batchers[id(model)] = DynamicBatcher(model, pad_token_id)
+
+            return self.__batchers[id(model)]
+
+    def __eos_token_ids(
+        self, model: PreTrainedModel, tokenizer: PreTrainedTokenizer
+    ) -> list[int]:
+        eos_token_ids = model.generation_config.eos_token_id
+        if eos_token_ids is None:
+            eos_token_ids = []
+        elif isinstance(eos_token_ids, int):
+            eos_token_ids = [eos_token_ids]
+
+        if tokenizer.eos_token_id is not None:
+            eos_token_ids = [*eos_token_ids, tokenizer.eos_token_id]
+
+        return list(dict.fromkeys(eos_token_ids))
+
+    def __prefix_length(
+        self, tokenizer: PreTrainedTokenizer, input_ids: list[int], prefix: str | None
+    ) -> int:
+        # the number of leading prompt tokens which are the tokens of the prefix,
+        # compared on the ids because the tokens at the boundary can merge differently
+        if not prefix:
+            return 0
+
+        prefix_ids = tokenizer(prefix)["input_ids"]
+        length = 0
+        for token_id, prefix_token_id in zip(input_ids, prefix_ids):
+            if token_id != prefix_token_id:
+                break
+            length += 1
+
+        return length
 
     def __check_messages(self, messages: list[dict[str, str]]):
         try:
@@ -403,13 +597,34 @@ class LLMUtils:
 
         return None
 
+    def __max_new_tokens_per_output(
+        self, max_new_tokens: int | list[int], count: int
+    ) -> list[int]:
+        # one budget for every output, or one per output (scaled with its input)
+        if isinstance(max_new_tokens, int):
+            return [max_new_tokens] * count
+
+        if len(max_new_tokens) != count:
+            raise Exception("Expected one max_new_tokens per output.")
+
+        return [int(tokens) for tokens in max_new_tokens]
+
+    def __decode_output(
+        self, tokenizer: PreTrainedTokenizer, prompt: str, generated: list[int]
+    ) -> str:
+        # only the generated tokens are decoded, the prompt is echoed in front of
+        # them for debugging only
+        text = tokenizer.decode(generated, skip_special_tokens=True)
+        return prompt + text if settings.LLM_ECHO_PROMPT else text
+
     def generate_output_from_model(
         self,
         model: PreTrainedModel,
         tokenizer: PreTrainedTokenizer,
         messages: list[dict[str, str]],
         max_new_tokens: int = 150,
-    ):
+        json_keys: list[str] | None = None,
+    ) -> tuple[str, int]:
         print("validate messages...")
 
         if self.__check_messages(messages):
@@ -417,28 +632,201 @@ class LLMUtils:
 
         print("Generating output from model...")
 
-        print("applying chat template...")
+        prompt, future = self.__submit_chat_prompt(
+            model, tokenizer, messages, max_new_tokens, json_keys=json_keys
+        )
 
+        print("decoding outputs...")
+        generated = future.result()
+        text = self.__decode_output(tokenizer, prompt, generated)
+
+        print("done!")
+        return text, len(generated)
+
+    def generate_outputs_from_model(
+        self,
+        model: PreTrainedModel,
+        tokenizer: PreTrainedTokenizer,
+        messages_list: list[list[dict[str, str]]],
+        max_new_tokens: int | list[int] = 150,
+        json_keys: list[str] | None = None,
+    ) -> tuple[list[str | None], list[int | None]]:
+        """
+        Generate the outputs for many independent message lists at once.
+
+        All prompts are submitted to the batcher before waiting on the first result,
+        so they are generated in as few batches as possible.
+
+        Args:
+            messages_list (list[list[dict[str, str]]]): One message list per output.
+            max_new_tokens (int | list[int]): The maximum number of generated tokens, for every output or one per output.
+            json_keys (list[str] | None): The keys of the JSON object every output is constrained to.
+
+        Returns:
+            tuple[list[str | None], list[int | None]]: The outputs in the order of
+            messages_list and the tokens generated for each, None if the generation failed.
+        """
+        for messages in messages_list:
+            if self.__check_messages(messages):
+                raise Exception("Invalid messages")
+
+        print(f"Generating {len(messages_list)} outputs from model...")
+
+        max_new_tokens = self.__max_new_tokens_per_output(
+            max_new_tokens, len(messages_list)
+        )
+        submitted = [
+            self.__submit_chat_prompt(
+                model, tokenizer, messages, output_tokens, json_keys=json_keys
+            )
+            for messages, output_tokens in zip(messages_list, max_new_tokens)
+        ]
+
+        outputs, generated_tokens = [], []
+        for i, (prompt, future) in enumerate(submitted):
+            try:
+                generated = future.result()
+                outputs.append(self.__decode_output(tokenizer, prompt, generated))
+                generated_tokens.append(len(generated))
+            except Exception as e:
+                print(f"Failed to generate output {i+1}: {e}")
+                outputs.append(None)
+                generated_tokens.append(None)
+
+        print("done!")
+        return outputs, generated_tokens
+
+    def __submit_chat_prompt(
+        self,
+        model: PreTrainedModel,
+        tokenizer: PreTrainedTokenizer,
+        messages: list[dict[str, str]],
+        max_new_tokens: int,
+        on_tokens: Callable[[list[int]], None] | None = None,
+        json_keys: list[str] | None = None,
+    ):
+        print("applying chat template...")
         prompt = tokenizer.apply_chat_template(
             messages, tokenize=False, add_generation_prompt=True
         )
 
         print("tokenizing prompt...")
-        inputs = tokenizer(
-            prompt, return_tensors="pt", padding=True, truncation=True
-        ).to("cuda")
-        
-        
-        print("generating outputs...")
-        outputs = model.generate(
-            **inputs, max_new_tokens=max_new_tokens, num_return_sequences=1
+        input_ids = tokenizer(prompt, truncation=True)["input_ids"]
+
+        # the templated system message is the same for every chunk of a request,
+        # its past-key-values are reused from the prefix cache of the batcher
+        prefix = None
+        if messages and messages[0].get("role") == "system":
+            prefix = tokenizer.apply_chat_template(messages[:1], tokenize=False)
+
+        # batched together with the other pending requests of this model
+        future = self.__get_batcher(model, tokenizer).submit(
+            input_ids=input_ids,
+            max_new_tokens=max_new_tokens,
+            eos_token_ids=self.__eos_token_ids(model, tokenizer),
+            prefix_length=self.__prefix_length(tokenizer, input_ids, prefix),
+            on_tokens=on_tokens,
+            # every prompt asks for one JSON object, nothing after it is used
+            stop_at_json_end=settings.LLM_STOP_AT_JSON_END,
+            json_keys=json_keys if settings.LLM_CONSTRAINED_JSON else None,
+            decode=lambda token_ids: tokenizer.decode(
+                token_ids, skip_special_tokens=True
+            ),
         )
+        return prompt, future
 
-        print("decoding outputs...")
-        text = tokenizer.decode(outputs[0], skip_special_tokens=True)
+    def stream_outputs_from_model(
+        self,
+        model: PreTrainedModel,
+        tokenizer: PreTrainedTokenizer,
+        messages_list: list[list[dict[str, str]]],
+        max_new_tokens: int | list[int] = 150,
+        json_keys: list[str] | None = None,
+    ) -> Iterator[dict]:
+        """
+        Generate the outputs for many message lists and stream them while they are generated.
 
-        print("done!")
-        return text.split("assistant")[1]
+        Args:
+            messages_list (list[list[dict[str, str]]]): One message list per output.
+            max_new_tokens (int | list[int]): The maximum number of generated tokens, for every output or one per output.
+            json_keys (list[str] | None): The keys of the JSON object every output is constrained to.
+
+        Yields:
+            dict: {"index", "text"} with the new text of one output and
+            {"index", "output", "generated_tokens"} once that output is complete
+            (None if it failed).
+        """
+        for messages in messages_list:
+            if self.__check_messages(messages):
+                raise Exception("Invalid messages")
+
+        print(f"Streaming {len(messages_list)} outputs from model...")
+
+        max_new_tokens = self.__max_new_tokens_per_output(
+            max_new_tokens, len(messages_list)
+        )
+        events = queue.Queue()
+        submitted = [
+            self.__submit_chat_prompt(
+                model,
+                tokenizer,
+                messages,
+                max_new_tokens[i],
+                on_tokens=lambda token_ids, i=i: events.put((i, token_ids)),
+                json_keys=json_keys,
+            )
+            for i, messages in enumerate(messages_list)
+        ]
+
+        def output(i: int, generated: list[int]) -> str:
+            return self.__decode_output(tokenizer, submitted[i][0], generated)
+
+        yield from self.__stream_events(
+            tokenizer, events, [future for _, future in submitted], output
+        )
+
+    def __stream_events(
+        self,
+        tokenizer: PreTrainedTokenizer,
+        events: queue.Queue,
+        futures: list,
+        output: Callable[[int, list[int]], str],
+    ) -> Iterator[dict]:
+        # the batcher puts the new tokens of every output into the queue, the done
+        # callbacks put None after the last token of an output
+        for i, future in enumerate(futures):
+            future.add_done_callback(lambda _, i=i: events.put((i, None)))
+
+        token_ids = [[] for _ in futures]
+        texts = ["" for _ in futures]
+        remaining = len(futures)
+
+        while remaining:
+            i, new_token_ids = events.get()
+
+            if new_token_ids is None:
+                remaining -= 1
+                try:
+                    generated = futures[i].result()
+                    yield {
+                        "index": i,
+                        "output": output(i, generated),
+                        "generated_tokens": len(generated),
+                    }
+                except Exception as e:
+                    print(f"Failed to generate output {i+1}: {e}")
+                    yield {"index": i, "output": None, "generated_tokens": None}
+                continue
+
+            token_ids[i].extend(new_token_ids)
+            text = tokenizer.decode(token_ids[i], skip_special_tokens=True)
+
+            # wait for the rest of a character which is split over several tokens
+            if text.endswith("\ufffd") or len(text) <= len(texts[i]):
+                continue
+
+            yield {"index": i, "text": text[len(texts[i]) :]}
+            texts[i] = text
 
     def generate_output_from_pipe(
         self,
@@ -446,18 +834,186 @@ class LLMUtils:
         tokenizer: PreTrainedTokenizer,
         complete_prompt: str,
         max_new_tokens: int = 150,
-    ):
+        prefix: str | None = None,
+        prefix_cache: str = "instruction",
+        stop_strings: list[str] | None = None,
+        json_keys: list[str] | None = None,
+    ) -> tuple[str, int]:
         print("Generating output from pipe...")
 
-        streamed = pipe(
+        _, future = self.__submit_raw_prompt(
+            pipe,
+            tokenizer,
             complete_prompt,
-            max_new_tokens=max_new_tokens,
-            pad_token_id=tokenizer.pad_token_id,
-            eos_token_id=tokenizer.eos_token_id,
-        )[-1]["generated_text"]
+            max_new_tokens,
+            prefix,
+            prefix_cache,
+            stop_strings=stop_strings,
+            json_keys=json_keys,
+        )
+
+        generated = future.result()
+        streamed = self.__decode_output(tokenizer, complete_prompt, generated)
+
+        print("done!")
+        return streamed, len(generated)
+
+    def generate_outputs_from_pipe(
+        self,
+        pipe: Pipeline,
+        tokenizer: PreTrainedTokenizer,
+        complete_prompts: list[str],
+        max_new_tokens: int | list[int] = 150,
+        prefixes: list[str | None] | None = None,
+        prefix_cache: str = "instruction",
+        stop_strings: list[str] | None = None,
+        json_keys: list[str] | None = None,
+    ) -> tuple[list[str | None], list[int | None]]:
+        """
+        Generate the outputs for many independent raw prompts at once.
+
+        Args:
+            complete_prompts (list[str]): One complete prompt per output.
+            max_new_tokens (int | list[int]): The maximum number of generated tokens, for every output or one per output.
+            prefixes (list[str | None] | None): The shared instruction each prompt starts with, cached between the prompts.
+            prefix_cache (str): "instruction", or "document" if the prefixes are document chunks.
+            stop_strings (list[str] | None): An output ends as soon as it contains one of them.
+            json_keys (list[str] | None): The keys of the JSON object every output is constrained to.
+
+        Returns:
+            tuple[list[str | None], list[int | None]]: The outputs in the order of
+            complete_prompts and the tokens generated for each, None if the generation failed.
+        """
+        print(f"Generating {len(complete_prompts)} outputs from pipe...")
+
+        if prefixes is None:
+            prefixes = [None] * len(complete_prompts)
+
+        max_new_tokens = self.__max_new_tokens_per_output(
+            max_new_tokens, len(complete_prompts)
+        )
+        submitted = [
+            self.__submit_raw_prompt(
+                pipe,
+                tokenizer,
+                complete_prompt,
+                output_tokens,
+                prefix,
+                prefix_cache,
+                stop_strings=stop_strings,
+                json_keys=json_keys,
+            )
+            for complete_prompt, prefix, output_tokens in zip(
+                complete_prompts, prefixes, max_new_tokens
+            )
+        ]
+
+        outputs, generated_tokens = [], []
+        for i, (complete_prompt, (_, future)) in enumerate(
+            zip(complete_prompts, submitted)
+        ):
+            try:
+                generated = future.result()
+                outputs.append(
+                    self.__decode_output(tokenizer, complete_prompt, generated)
+                )
+                generated_tokens.append(len(generated))
+            except Exception as e:
+                print(f"Failed to generate output {i+1}: {e}")
+                outputs.append(None)
+                generated_tokens.append(None)
 
         print("done!")
-        return streamed
+        return outputs, generated_tokens
+
+    def __submit_raw_prompt(
+        self,
+        pipe: Pipeline,
+        tokenizer: PreTrainedTokenizer,
+        complete_prompt: str,
+        max_new_tokens: int,
+        prefix: str | None = None,
+        prefix_cache: str = "instruction",
+        on_tokens: Callable[[list[int]], None] | None = None,
+        stop_strings: list[str] | None = None,
+        json_keys: list[str] | None = None,
+    ):
+        # the raw prompt path shares the batcher of the pipeline model
+        input_ids = tokenizer(complete_prompt)["input_ids"]
+
+        future = self.__get_batcher(pipe.model, tokenizer).submit(
+            input_ids=input_ids,
+            max_new_tokens=max_new_tokens,
+            eos_token_ids=[tokenizer.eos_token_id],
+            prefix_length=self.__prefix_length(tokenizer, input_ids, prefix),
+            prefix_cache=prefix_cache,
+            on_tokens=on_tokens,
+            stop_strings=stop_strings,
+            stop_at_json_end=settings.LLM_STOP_AT_JSON_END,
+            json_keys=json_keys if settings.LLM_CONSTRAINED_JSON else None,
+            decode=lambda token_ids: tokenizer.decode(
+                token_ids, skip_special_tokens=True
+            ),
+        )
+        return input_ids, future
+
+    def stream_outputs_from_pipe(
+        self,
+        pipe: Pipeline,
+        tokenizer: PreTrainedTokenizer,
+        complete_prompts: list[str],
+        max_new_tokens: int | list[int] = 150,
+        prefixes: list[str | None] | None = None,
+        prefix_cache: str = "instruction",
+        stop_strings: list[str] | None = None,
+        json_keys: list[str] | None = None,
+    ) -> Iterator[dict]:
+        """
+        Generate the outputs for many raw prompts and stream them while they are generated.
+
+        Args:
+            complete_prompts (list[str]): One complete prompt per output.
+            max_new_tokens (int | list[int]): The maximum number of generated tokens, for every output or one per output.
+            prefixes (list[str | None] | None): The shared instruction each prompt starts with.
+            prefix_cache (str): "instruction", or "document" if the prefixes are document chunks.
+            stop_strings (list[str] | None): An output ends as soon as it contains one of them.
+            json_keys (list[str] | None): The keys of the JSON object every output is constrained to.
+
+        Yields:
+            dict: {"index", "text"} with the new text of one output and
+            {"index", "output", "generated_tokens"} once that output is complete
+            (None if it failed).
+        """
+        print(f"Streaming {len(complete_prompts)} outputs from pipe...")
+
+        if prefixes is None:
+            prefixes = [None] * len(complete_prompts)
+
+        max_new_tokens = self.__max_new_tokens_per_output(
+            max_new_tokens, len(complete_prompts)
+        )
+        events = queue.Queue()
+        submitted = [
+            self.__submit_raw_prompt(
+                pipe,
+                tokenizer,
+                complete_prompt,
+                max_new_tokens[i],
+                prefix,
+                prefix_cache,
+                on_tokens=lambda token_ids, i=i: events.put((i, token_ids)),
+                stop_strings=stop_strings,
+                json_keys=json_keys,
+            )
+            for i, (complete_prompt, prefix) in enumerate(zip(complete_prompts, prefixes))
+        ]
+
+        def output(i: int, generated: list[int]) -> str:
+            return self.__decode_output(tokenizer, complete_prompts[i], generated)
+
+        yield from self.__stream_events(
+            tokenizer, events, [future for _, future in submitted], output
+        )
 
 
 llama = LLamaModel()
@@ -1,31 +1,50 @@
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+from app.core.config import settings
+from app.services.budget import plan_stage, record_outputs, scale_max_new_tokens
+from app.services.engine import engine
+from app.services.json_stream import empty_json_object
 from app.services.llms import llama
+from app.utils.docstore import docstore
 from app.utils.general import (
+    count_tokens,
     extract_and_validate_json_objects,
+    plan_merge_tree,
     split_text_into_chunks,
+    split_text_into_token_chunks,
 )
+from app.utils.result_cache import result_cache, result_key, use_result_cache
+from app.utils.retrieval import BM25Index
+from app.utils.single_flight import flights
 
+# the response schemas of the prompts, the generations are constrained to them
+ANSWER_KEYS = ["Answer", "Explanation", "Text Excerpt"]
+FINAL_ANSWER_KEYS = ["Final Answer", "Final Explanation"]
 
-def resolve_the_final_answer(
-    answers: list[str],
-    question: str,
-    resolve_as_json=False,
-):
-    pipe = llama.get_pipe()
-    tokenizer = llama.get_tokenizer()
-    print(f"\n--- Resolving the Final Answer ---\n")
-    max_context_size = 2048  # Maximum context size of the model
-    max_generated_tokens = 500  # Adjust as needed
-    # Join all answers into a single string
-    section_marker = "[SEP]"
-
-    summarized_answers = (
-        section_marker.join(answers) if len(answers) > 1 else answers[0]
-    )
-    summarized_answers = summarized_answers
+# part of the error of outputs which are no JSON at all
+NO_JSON_ERROR = "No valid JSON objects found"
 
-    answers_tokens = len(tokenizer.encode(summarized_answers))
 
-    json_strc = '{"Final Answer":"","Final Explanation":""}'
+def plan_final_answer(answers: list[str], question: str, options: dict | None = None):
+    """
+    Merge the answers of the single text chunks until they fit into the prompt of the root.
+
+    The merge tree is planned up front from the token counts of the answers, all nodes
+    of one level are generated together in one batched step.
+
+    Args:
+        answers (list[str]): The answers found in the text chunks.
+        question (str): The question the answers are responding to.
+        options (dict | None): The request options, e.g. "max_new_tokens".
+
+    Returns:
+        (dict | str): {"prompt", "prefix", "input_tokens", "max_new_tokens"} of the root,
+        "NOANSWER" or an "ERROR: ..." message.
+    """
+    tokenizer = llama.get_tokenizer()
+    print("\n--- Resolving the Final Answer ---\n")
+    json_strc = empty_json_object(FINAL_ANSWER_KEYS)
 
     finalising_instruction = f"""
     Prompt: Analyse carefully the provided answers, which all responding to this question: {question}. 
@@ -37,195 +56,291 @@ def resolve_the_final_answer(
     # Tokenize the system instruction
     system_instructions_tokens = len(tokenizer.encode(finalising_instruction))
 
-    max_input_tokens = (
-        max_context_size - system_instructions_tokens - max_generated_tokens
+    budget = plan_stage(
+        "questionary_final", system_instructions_tokens, options, FINAL_ANSWER_KEYS
     )
+    # the upper bound of one merged node, every prompt scales its own budget below it
+    max_generated_tokens = budget.max_new_tokens
+    max_input_tokens = budget.max_input_tokens
 
     if max_input_tokens <= 0:
         print(
             "The system instructions and the maximum generated tokens exceed the context window size."
         )
-        return f"ERROR: The system instructions and the maximum generated tokens exceed the context window size."
-
-    # If the combined tokens exceed the context window, split answers into chunks
-    if answers_tokens > max_input_tokens and section_marker in summarized_answers:
-        # in case the answers joined to one text, are too long for the model to handle it at once,
-        # it will split the answers by the split marker and recursively call this func with the new splitted answers
-        # (which does it 2 times per run, it calls 2 times this func recursivly, each call takes the half of the spltted answers).
-        # the shortend answers will be concated into one array and repassed into this function.
-        #
-        # ---> this logic loops recursivly until the answers, joined to one txt, fit into the context window,
-        # to resolve a final answer. (Which is the last else case of this statement chain)
+        return "ERROR: The system instructions and the maximum generated tokens exceed the context window size."
+
+    # the leaves of the tree, answers which are too long on their own are split into
+    # chunks. Every token count is computed only once.
+    nodes = []
+    token_counts = []
+    for answer, answer_tokens in zip(
+        answers, count_tokens(answers, tokenizer=tokenizer), strict=True
+    ):
+        if answer_tokens <= max_input_tokens:
+            nodes.append(answer)
+            token_counts.append(answer_tokens)
+            continue
+
+        print(
+            "\nSummarized answer exceeds the maximum input tokens, splitting into smaller chunks.\n"
+        )
+        for chunk, chunk_token_ids in split_text_into_token_chunks(
+            answer, max_input_tokens, tokenizer=tokenizer
+        ):
+            nodes.append(chunk)
+            token_counts.append(len(chunk_token_ids))
+
+    try:
+        levels = plan_merge_tree(token_counts, max_input_tokens, max_generated_tokens)
+    except Exception as e:
+        print(e)
+        return f"ERROR: {str(e)}"
+
+    print(f"Merge tree planned with {len(levels)} levels for {len(nodes)} answers.")
+
+    # every level except the root, "None" marks a node without answer
+    for depth, groups in enumerate(levels[:-1]):
+        merged_nodes = []
+        # the counts of the nodes passed through are carried forward, nodes without
+        # answer count 0 tokens and only the generated nodes are counted
+        merged_counts = []
+        prompts = []
+        prompt_tokens = []
+        for group in groups:
+            members = [idx for idx in group if nodes[idx] is not None]
+            inputs = [nodes[idx] for idx in members]
+
+            if not inputs:
+                merged_nodes.append(None)
+                merged_counts.append(0)
+            elif len(inputs) == 1 and token_counts[members[0]] <= max_generated_tokens:
+                # small enough already, passed through to the next level
+                merged_nodes.append(inputs[0])
+                merged_counts.append(token_counts[members[0]])
+            else:
+                merged_counts.append(None)
+                merged_nodes.append(len(prompts))
+                prompts.append(f"{finalising_instruction}\n" + "\n".join(inputs))
+                prompt_tokens.append(sum(token_counts[idx] for idx in members))
 
         print(
-            "\nSummarized answers exceed, joined to one text, the maximum window ctx tokens, splitting into smaller chunks.\n"
+            f"\n--- Merge level {depth+1}/{len(levels)-1}: {len(prompts)} prompts in one batch ---\n"
         )
-        # recursively split input array by half, until it fits into the context window
 
-        splitted_answers = summarized_answers.split(section_marker)
+        max_new_tokens = [
+            scale_max_new_tokens(budget, tokens) for tokens in prompt_tokens
+        ]
 
-        middle = len(splitted_answers) // 2 + len(splitted_answers) % 2
+        try:
+            outputs, generated_tokens = (
+                engine.generate_many_from_prompt(
+                    complete_prompts=prompts,
+                    max_new_tokens=max_new_tokens,
+                    prefixes=[finalising_instruction] * len(prompts),
+                    json_keys=FINAL_ANSWER_KEYS,
+                )
+                if prompts
+                else ([], [])
+            )
+        except Exception as e:
+            print("Failed to generate the merge level")
+            print(e)
+            return f"ERROR: Failed to generate the merge level {depth+1} {str(e)}"
 
-        first_half = resolve_the_final_answer(
-            splitted_answers[:middle], question, resolve_as_json=False
-        )
-        second_half = resolve_the_final_answer(
-            splitted_answers[middle:], question, resolve_as_json=False
+        record_outputs(
+            "questionary_final", prompt_tokens, max_new_tokens, generated_tokens
         )
 
-        if first_half == "NOANSWER" and second_half == "NOANSWER":
-            return "NOANSWER"
+        new_nodes = []
+        for node in merged_nodes:
+            if not isinstance(node, int):
+                new_nodes.append(node)
+                continue
 
-        concated_list = []
+            streamed = outputs[node]
+            if streamed is None:
+                return f"ERROR: Failed to process chunk {node+1}"
 
-        if not first_half == "NOANSWER":
-            concated_list.append(first_half)
-        if not second_half == "NOANSWER":
-            concated_list.append(second_half)
+            data = extract_and_validate_json_objects(streamed)
 
-        return resolve_the_final_answer(
-            concated_list, question, resolve_as_json=resolve_as_json
-        )
+            if len(data) == 0:
+                print(streamed)
+                return f"ERROR: Failed to process chunk {node+1} {NO_JSON_ERROR} in the final answer."
 
-    elif answers_tokens > max_input_tokens:
-        # runs only if a single answer is passed and its too long for the model.
-        #
-        # The single Answer will joined to one tagless text and chunked with the tokenizer in smaller passable text chunks.
-        # The resolving answers, for each chunkm, will be XML formatted and repassed to this func.
-        print(
-            "\nSummarized answer exceeds the maximum input tokens, splitting into smaller chunks.\n"
-        )
+            data = data[-1]
 
-        # removing tags from single answer and pass it as text content to the model
-        sanitized_summarized_answers = summarized_answers
+            response = ""
+            for key, value in data.items():
+                if "NOANSWER" in value or value.strip() == "":
+                    continue
+                response += f"\n{key}: {value}"
 
-        answer_chunks = split_text_into_chunks(
-            sanitized_summarized_answers,
-            max_input_tokens,
-            tokenizer=tokenizer,
-        )
+            new_nodes.append(response if response != "" else None)
+
+        generated = [
+            i
+            for i, node in enumerate(merged_nodes)
+            if isinstance(node, int) and new_nodes[i] is not None
+        ]
+        for i, tokens in zip(
+            generated,
+            count_tokens([new_nodes[i] for i in generated], tokenizer=tokenizer),
+            strict=True,
+        ):
+            merged_counts[i] = tokens
+
+        nodes = new_nodes
+        token_counts = [tokens or 0 for tokens in merged_counts]
+
+    # the root resolves the final answer
+    answers = [node for node in nodes if node is not None]
+    input_tokens = sum(
+        tokens
+        for node, tokens in zip(nodes, token_counts, strict=True)
+        if node is not None
+    )
 
-        # Recursively resolve the final answer with the new chunks
-        new_answers = []
+    if not answers:
+        return "NOANSWER"
 
-        for i, chunk in enumerate(answer_chunks):
-            print(
-                f"\n--- Summarizing Splitted Answer Chunk {i+1}/{len(answer_chunks)} ---\n"
-            )
-            try:
-                # to prevent irritation, this complete_prmpt takes the prompt with the  tag,
-                # because the model needs it to respond properly
-                # but the single answers and respones are not passed with tags.
+    sa = "\n".join(answers)
+    complete_prompt = f"{finalising_instruction}\n{sa}"
+    print(complete_prompt)
 
-                complete_prmpt = f"""{finalising_instruction}{chunk}"""
-                print(complete_prmpt)
-                response = ""
-                prinatble_rsp = ""
+    return {
+        "prompt": complete_prompt,
+        "prefix": finalising_instruction,
+        "input_tokens": input_tokens,
+        "max_new_tokens": scale_max_new_tokens(budget, input_tokens),
+    }
 
-                streamed = pipe(
-                    complete_prmpt,
-                    max_new_tokens=max_generated_tokens,
-                    pad_token_id=tokenizer.pad_token_id,
-                    eos_token_id=tokenizer.eos_token_id,
-                )[-1]["generated_text"]
 
-                data = extract_and_validate_json_objects(streamed)
+def parse_final_answer(streamed: str, resolve_as_json=False):
+    """
+    Parse the generated output of the root into the final answer.
 
-                if len(data) == 0:
-                    print(streamed)
-                    raise Exception("No valid JSON objects found in the final answer.")
+    Only an explicit NOANSWER counts as no answer. Empty values are left out of the
+    text, they are the keys a constrained generation had to close before reaching
+    them, the rest of the object is kept.
 
-                data = data[-1]
+    Returns:
+        (dict | str): The final answer or "NOANSWER", raises if there is no valid JSON
+        or all of its values are empty.
+    """
+    data = extract_and_validate_json_objects(streamed)
 
-                for key, value in data.items():
-                    if "NOANSWER" in value or value.strip() == "":
-                        continue
+    if len(data) == 0:
+        print(streamed)
+        raise Exception(f"{NO_JSON_ERROR} in the final answer.")
 
-                    prinatble_rsp += f"\n{key}: {value}\n"
-                    response += f"\n{key}: {value}"
+    data = data[-1]
 
-                # important to append the response with tags,
-                # because it will be passed to this func with shortened answers,
-                # which can be prob handles through the first if statement above
-                if not response == "":
-                    print(f"{i+1})\n\n{prinatble_rsp}")
-                    new_answers.append(f"{response}")
+    response = ""
+    for key, value in data.items():
+        if "NOANSWER" in value:
+            print(key.upper(), "NO ANSWER FOUND")
+            return "NOANSWER"
 
-            except Exception as e:
-                print(f"Failed to process chunk {i+1}")
-                print(e)
-                return f"ERROR: Failed to process chunk {i+1} {str(e)}"
+        if value.strip() == "":
+            print(key.upper(), "IS EMPTY")
+            continue
 
-        # Recursive call with the new summarized answers
-        return (
-            resolve_the_final_answer(
-                new_answers, question, resolve_as_json=resolve_as_json
-            )
-            if len(new_answers)
-            else "NOANSWER"
+        response += f"\n{key}: {value}"
+
+    if response == "":
+        raise Exception("All values of the final answer are empty.")
+
+    return response if not resolve_as_json else data
+
+
+def resolve_the_final_answer(
+    answers: list[str],
+    question: str,
+    resolve_as_json=False,
+    options: dict | None = None,
+):
+    """
+    Resolve one final answer from the answers of the single text chunks.
+
+    Args:
+        answers (list[str]): The answers found in the text chunks.
+        question (str): The question the answers are responding to.
+        resolve_as_json (bool): Whether to return the final answer as dict or as text.
+        options (dict | None): The request options, e.g. "max_new_tokens".
+
+    Returns:
+        (dict | str): The final answer, "NOANSWER" or an "ERROR: ..." message.
+    """
+    root = plan_final_answer(answers, question, options)
+
+    if isinstance(root, str):
+        return root
+
+    try:
+        streamed, generated_tokens = engine.generate_from_prompt(
+            complete_prompt=root["prompt"],
+            max_new_tokens=root["max_new_tokens"],
+            prefix=root["prefix"],
+            json_keys=FINAL_ANSWER_KEYS,
+        )
+        record_outputs(
+            "questionary_final",
+            [root["input_tokens"]],
+            [root["max_new_tokens"]],
+            [generated_tokens],
         )
 
-    else:
-        # If all answers from the passed array, joined to one text, fits into this context window, it will generate the final answer
-        # but it resolves it as xml formatted response in case this funtion was called recursively,
-        # so to resolve a better human readable response, use the "remove_xmt_html_tags" utility.
-        try:
-            sa = summarized_answers.replace(section_marker, "\n")
-            finalising_instruction = f"{finalising_instruction}\n{sa}"
-            response = ""
-            prinatble_rsp = ""
-            print(finalising_instruction)
-            try:
+        return parse_final_answer(streamed, resolve_as_json)
 
-                streamed = pipe(
-                    finalising_instruction,
-                    max_new_tokens=max_generated_tokens,
-                    pad_token_id=tokenizer.pad_token_id,
-                    eos_token_id=tokenizer.eos_token_id,
-                )[-1]["generated_text"]
-
-            except IndexError:
-                print("List index out of range, while resolving the final answer.")
-                raise Exception(
-                    "List index out of range, while resolving the final answer."
-                )
+    except Exception as e:
+        print("Failed to generate the final answer")
+        print(e)
+        return f"ERROR: Failed to generate the final answer {str(e)}"
 
-            data = extract_and_validate_json_objects(streamed)
 
-            if len(data) == 0:
-                print(streamed)
-                raise Exception("No valid JSON objects found in the final answer.")
+def top_k_option(options: dict | None) -> int:
+    """
+    The chunks to keep per question, options["top_k"] or QUESTIONARY_TOP_K if the
+    option is not set or invalid.
+    """
+    value = (options or {}).get("top_k")
 
-            data = data[-1]
+    if value is None:
+        return settings.QUESTIONARY_TOP_K
 
-            for key, value in data.items():
-                if "NOANSWER" in value or value.strip() == "":
-                    print(key.upper(), "NO ANSWER FOUND")
-                    return "NOANSWER"
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        print(f"Invalid top_k option: {value}")
+        return settings.QUESTIONARY_TOP_K
 
-                prinatble_rsp += f"\n{key}: {value}\n"
-                response += f"\n{key}: {value}"
 
-            # it needs to return the response with tags,
-            # because the func is recursive,
-            # in case the ctx window tkns exceeds the max and returning the response with tags,
-            # makes it easier for the model to repsond properly
+def select_relevant_chunks(
+    index: BM25Index, question: str, top_k: int
+) -> list[tuple[int, float]]:
+    """
+    Rank the chunks against the question with bm25 and keep the top_k best.
 
-            return response if not resolve_as_json else data
+    Args:
+        index (BM25Index): The bm25 index of the text chunks.
+        question (str): The question to rank the chunks with.
+        top_k (int): The number of chunks to keep, 0 keeps all chunks.
 
-        except Exception as e:
-            print("Failed to generate the final answer")
-            print(e)
-            return f"ERROR: Failed to generate the final answer {str(e)}"
+    Returns:
+        list[tuple[int, float]]: (chunk index, retrieval score) pairs, in text order.
+    """
+    scores = index.score(question)
 
+    if top_k <= 0 or top_k >= len(scores):
+        return [(i, float(score)) for i, score in enumerate(scores)]
+
+    return index.top_k(question, top_k)
 
-def find_answer_in_text(question: str, text_context: str = ""):
-    pipe = llama.get_pipe()
-    tokenizer = llama.get_tokenizer()
 
-    json_structure = '{"Answer":"","Explanation":"","Text Excerpt":""}'
+def build_answer_instructions(question: str) -> str:
+    json_structure = empty_json_object(ANSWER_KEYS)
 
-    system_instructions = f"""
+    return f"""
     Prompt: Please answer the question: {question}, briefly and precisely. 
     Include a brief explanation of why you came to your answer and quote the relevant text excerpt from the context. 
     Do not include the question itself in your answer. 
@@ -235,17 +350,160 @@ def find_answer_in_text(question: str, text_context: str = ""):
     If you can answer the question based on the text content, follow this json structure for your answer: {json_structure}.
     """
 
-    # Berechne die Anzahl der Tokens in den Systemanweisungen
-    system_instructions_tokens = len(tokenizer.encode(system_instructions))
 
-    # Definiere die maximale Kontextgröße und die maximale Anzahl generierter Tokens
-    max_context_size = 2048
-    max_generated_tokens = 600  # Passe dies bei Bedarf an
+def finish_answer(
+    question: str,
+    answers: list[str],
+    json_answers: list[dict],
+    retrieval_scores: list[dict],
+    final,
+    options: dict | None = None,
+):
+    """
+    Turn the resolved final answer of one question into the response.
+
+    Args:
+        question (str): The question of the answers.
+        answers (list[str]): The answers found in the text chunks.
+        json_answers (list[dict]): The same answers as parsed JSON.
+        retrieval_scores (list[dict]): The retrieval scores of the selected chunks.
+        final (dict | str): The result of resolve_the_final_answer, None if there
+            was nothing to resolve (less than two answers).
+        options (dict | None): The request options, used for the retry.
+
+    Returns:
+        (dict | str): The answer with its metadata, or a message.
+    """
+    if len(answers) == 0:
+        print("No answers found in the text.")
+        return "It seems there is no answer in the text."
+
+    if len(answers) == 1:
+        print("\n\nOnly one answer found in the text.")
+        return {**json_answers[0], "Metadata": {"retrieval_scores": retrieval_scores}}
+
+    if final == "NOANSWER":
+        print(answers)
+        return "it seems there is no answer in the text."
+
+    # response errored out, code logic failed not the model
+    if isinstance(final, str) and final.startswith("ERROR"):
+        print("\n\nFailed to resolve the final answer:", final)
+        print("\n\nAnswers:", answers)
+
+        # constrained outputs are always valid JSON, generating them again would
+        # fail the same way. Other errors (e.g. the engine) are retried
+        if settings.LLM_CONSTRAINED_JSON and NO_JSON_ERROR in final:
+            return "ERROR: Failed to resolve the final answer!"
+
+        print("\n\nfailed to resolve final answer, retrying....")
+        final = resolve_the_final_answer(
+            answers, question, resolve_as_json=True, options=options
+        )
+
+        if not isinstance(final, dict):
+            print("\n\nFailed to resolve the final answer again..", answers)
+            return "ERROR: Failed to resolve the final answer!"
+
+        return {**final, "Metadata": {"retrieval_scores": retrieval_scores}}
+
+    if isinstance(final, dict):
+        print("\n\nFinal Answer:", final)
+        print("\n\n", answers, "\n\n")
+        return {**final, "Metadata": {"retrieval_scores": retrieval_scores}}
+
+    print("Something went wrong...", final)
+    return final
+
+
+def resolve_answers(
+    question: str,
+    answers: list[str],
+    json_answers: list[dict],
+    retrieval_scores: list[dict],
+    options: dict | None = None,
+):
+    """
+    Resolve the final answer of one question from the answers of its chunks.
+    """
+    print(f"\n{len(answers)} answers found in the text.\n")
+    if len(answers) > 0:
+        print("\n\n", answers, "\n\n")
 
-    # Berechne die maximale Anzahl von Tokens für die Eingabe
-    max_input_tokens = (
-        max_context_size - system_instructions_tokens - max_generated_tokens
+    final = (
+        resolve_the_final_answer(
+            answers, question, resolve_as_json=True, options=options
+        )
+        if len(answers) > 1
+        else None
+    )
+
+    return finish_answer(
+        question, answers, json_answers, retrieval_scores, final, options
+    )
+
+
+def parse_chunk_answer(streamed: str):
+    """
+    Parse the generated output of one (question, chunk) prompt.
+
+    Returns:
+        (tuple[str, dict] | None): The answer as text and as JSON, None if the
+        chunk does not answer the question.
+    """
+    data = extract_and_validate_json_objects(streamed)
+
+    if len(data) == 0:
+        return None
+
+    data = data[-1]
+
+    response = ""
+    for key, value in data.items():
+        if "NOANSWER" in value or value.strip() == "":
+            continue
+
+        response += f"\n{key}: {value}"
+
+    if response == "":
+        return None
+
+    return response, data
+
+
+def prepare_chunk_prompts(
+    questions: list[str], text_context: str, options: dict | None = None
+):
+    """
+    Chunk the text once and build the (question, chunk) prompts of all questions.
+
+    Args:
+        questions (list[str]): The questions to answer.
+        text_context (str): The text to answer the questions from.
+        options (dict | None): The request options, e.g. "top_k", "document_first" or "max_new_tokens".
+
+    Returns:
+        (dict | str): {"prompts", "prefixes", "prefix_cache", "selections", "input_tokens",
+        "max_new_tokens"} with the selected (chunk index, retrieval score) pairs per
+        question and the chunk tokens and generated tokens per prompt,
+        or an "ERROR: ..." message.
+    """
+    options = options or {}
+    tokenizer = llama.get_tokenizer()
+
+    instructions = [build_answer_instructions(question) for question in questions]
+
+    # Berechne die Anzahl der Tokens in den Systemanweisungen,
+    # die längste Anweisung bestimmt die Chunks für alle Fragen
+    system_instructions_tokens = max(
+        len(tokenizer.encode(system_instructions))
+        for system_instructions in instructions
+    )
+
+    budget = plan_stage(
+        "questionary_chunk", system_instructions_tokens, options, ANSWER_KEYS
     )
+    max_input_tokens = budget.max_input_tokens
 
     if max_input_tokens <= 0:
         print(
@@ -253,107 +511,436 @@ def find_answer_in_text(question: str, text_context: str = ""):
         )
         return "ERROR: The system instructions and the maximum generated tokens exceed the context window size."
 
-    answers = []
-    chunks = split_text_into_chunks(text_context, max_input_tokens, tokenizer=tokenizer)
+    if settings.DOCSTORE_ENABLED:
+        # sentence split, chunks and index are reused for every question on this text
+        chunks, index = docstore.get_chunks_and_index(
+            text_context, max_input_tokens, tokenizer=tokenizer
+        )
+    else:
+        chunks = split_text_into_chunks(
+            text_context, max_input_tokens, tokenizer=tokenizer
+        )
+        index = BM25Index(chunks)
+
     print(f"Total Chunks: {len(chunks)}")
-    json_answers = []
-    for i, chunk in enumerate(chunks):
-        print(f"\n--- Prüfe Chunk {i+1} ---\n", end="\n", flush=True)
-        try:
-            response = f""  # "@@@"" used to split the answers for the final evaluation at the right point, without destroying the answers logic
-            complete_prmpt = f"{system_instructions}\n{chunk}"
-            prinatble_rsp = f"\nResponse from text chunk {i+1}:\n\n"
 
-            streamed = pipe(
-                complete_prmpt,
-                max_new_tokens=max_generated_tokens,
-                pad_token_id=tokenizer.pad_token_id,
-                eos_token_id=tokenizer.eos_token_id,
-            )[-1]["generated_text"]
+    # only the chunks which match the question lexically are sent to the model
+    top_k = top_k_option(options)
 
-            data = extract_and_validate_json_objects(streamed)
+    # document first: the chunk is the cached prefix and the question instructions
+    # the suffix, so further questions on a known text only prefill the instructions.
+    # otherwise the instructions of a question are the cached prefix of its chunk prompts.
+    # both layouts batch the same way, the different prefixes of a batch are stacked
+    document_first = bool(
+        options.get("document_first", settings.QUESTIONARY_DOCUMENT_FIRST)
+    )
 
-            if len(data) == 0:
-                continue
+    selections = [select_relevant_chunks(index, question, top_k) for question in questions]
 
-            data = data[-1]
+    # only the selected chunks are counted, the generated tokens scale with them
+    selected_chunks = sorted({i for selected in selections for i, _ in selected})
+    chunk_tokens = dict(
+        zip(
+            selected_chunks,
+            count_tokens([chunks[i] for i in selected_chunks], tokenizer=tokenizer),
+            strict=True,
+        )
+    )
 
-            for key, value in data.items():
-                if "NOANSWER" in value or value.strip() == "":
-                    continue
+    prompts = []
+    prefixes = []
+    input_tokens = []
+    for selected, system_instructions in zip(selections, instructions, strict=True):
+        print(f"Selected {len(selected)} of {len(chunks)} chunks by retrieval score.")
+
+        for i, _ in selected:
+            if document_first:
+                prompts.append(f"{chunks[i]}\n{system_instructions}")
+                prefixes.append(chunks[i])
+            else:
+                prompts.append(f"{system_instructions}\n{chunks[i]}")
+                prefixes.append(system_instructions)
+            input_tokens.append(chunk_tokens[i])
+
+    return {
+        "prompts": prompts,
+        "prefixes": prefixes,
+        "prefix_cache": "document" if document_first else "instruction",
+        "selections": selections,
+        "input_tokens": input_tokens,
+        "max_new_tokens": [
+            scale_max_new_tokens(budget, tokens) for tokens in input_tokens
+        ],
+    }
+
+
+def retrieval_scores_of(selected: list[tuple[int, float]]) -> list[dict]:
+    return [{"chunk": i + 1, "score": round(score, 4)} for i, score in selected]
+
+
+def find_answers_in_text(
+    questions: list[str], text_context: str = "", options: dict | None = None
+) -> list:
+    """
+    Answer many questions about one text in one pass.
 
-                prinatble_rsp += f"\n{key}: {value}\n"
-                response += f"\n{key}: {value}"
+    The text is chunked and indexed once for all questions, the (question, chunk)
+    prompts of all questions are generated together and the final answers of the
+    questions are resolved at the same time.
+
+    Args:
+        questions (list[str]): The questions to answer.
+        text_context (str): The text to answer the questions from.
+        options (dict | None): The request options, e.g. "top_k", "document_first" or "max_new_tokens".
+
+    Returns:
+        list: One answer per question, in the format of find_answer_in_text.
+    """
+    prepared = prepare_chunk_prompts(questions, text_context, options)
+
+    if isinstance(prepared, str):
+        return [prepared] * len(questions)
+
+    prompts = prepared["prompts"]
+    selections = prepared["selections"]
+
+    print(f"\n--- Prüfe {len(prompts)} Chunks für {len(questions)} Fragen ---\n")
+
+    try:
+        outputs, generated_tokens = engine.generate_many_from_prompt(
+            complete_prompts=prompts,
+            max_new_tokens=prepared["max_new_tokens"],
+            prefixes=prepared["prefixes"],
+            prefix_cache=prepared["prefix_cache"],
+            # a chunk without answer is done as soon as the model says so
+            stop_strings=["NOANSWER"],
+            json_keys=ANSWER_KEYS,
+        )
+    except Exception as e:
+        print("Failed to run model on chunk")
+        print(e)
+        return [f"ERROR: Failed to run model on chunk {str(e)}"] * len(questions)
+
+    record_outputs(
+        "questionary_chunk",
+        prepared["input_tokens"],
+        prepared["max_new_tokens"],
+        generated_tokens,
+    )
 
-            if response == "":
+    results = [None] * len(questions)
+    pending = []
+    offset = 0
+
+    for q, selected in enumerate(selections):
+        question_outputs = outputs[offset : offset + len(selected)]
+        offset += len(selected)
+
+        answers = []
+        json_answers = []
+        for (i, _), streamed in zip(selected, question_outputs, strict=True):
+            if streamed is None:
+                print("Failed to run model on chunk")
+                results[q] = f"ERROR: Failed to run model on chunk {i+1}"
+                break
+
+            parsed = parse_chunk_answer(streamed)
+
+            if parsed is None:
                 continue
 
+            response, data = parsed
+            print(f"\nResponse from text chunk {i+1}:\n{response}\n")
             json_answers.append(data)
+            answers.append(response)
+
+        if results[q] is None:
+            pending.append((q, answers, json_answers, retrieval_scores_of(selected)))
+
+    # the reductions of the questions run at the same time, their generations
+    # are batched together by the engine
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(len(pending), settings.LLM_MAX_BATCH_SIZE))
+    ) as pool:
+        futures = {
+            q: pool.submit(
+                resolve_answers,
+                questions[q],
+                answers,
+                json_answers,
+                retrieval_scores,
+                options,
+            )
+            for q, answers, json_answers, retrieval_scores in pending
+        }
 
-            if not response == "":
-                print(prinatble_rsp)
-                answers.append(f"""{response}""")
+        for q, future in futures.items():
+            try:
+                results[q] = future.result()
+            except Exception as e:
+                print("Failed to resolve the final answer")
+                print(e)
+                results[q] = f"ERROR: Failed to resolve the final answer {str(e)}"
 
-        except Exception as e:
-            print("Failed to run model on chunk")
-            print(e)
-            return f"ERROR: Failed to run model on chunk {str(e)}"
+    return results
 
-    print(f"\n{len(answers)} answers found in the text.\n")
-    if len(answers) > 0:
-        print("\n\n", answers, "\n\n")
 
-    if len(answers) == 0:
-        print("No answers found in the text.")
-        return "It seems there is no answer in the text."
+def find_answer_in_text(
+    question: str, text_context: str = "", options: dict | None = None
+):
+    return find_answers_in_text([question], text_context, options)[0]
 
-    if len(answers) == 1:
-        print("\n\nOnly one answer found in the text.")
-        return json_answers[0]
 
-    final = resolve_the_final_answer(answers, question, resolve_as_json=True)
+def is_cacheable_answer(answer) -> bool:
+    # failures of the pipeline are retried, answers (and "no answer") are kept
+    return not (isinstance(answer, str) and answer.startswith("ERROR"))
 
-    if final == "NOANSWER":
-        print(answers)
-        return "it seems there is no answer in the text."
 
-    # response errored out, code logic failed not the model
-    if isinstance(final, str) and final.startswith("ERROR"):
-        print("\n\nFailed to resolve the final answer:", final)
-        print("\n\nAnswers:", answers)
-        print("\n\nfailed to resolve final answer, retrying....")
-        final = resolve_the_final_answer(answers, question, resolve_as_json=True)
+def cache_payload(text_context: str, options: dict | None, **inputs) -> dict:
+    # the cache flag itself does not change the result
+    options = {key: value for key, value in (options or {}).items() if key != "cache"}
+    return {"text": text_context, "options": options, **inputs}
 
-        if not isinstance(final, dict):
-            print("\n\nFailed to resolve the final answer again..", answers)
-            return "ERROR: Failed to resolve the final answer!"
 
-        return final
+def initiate(question: str, text_context: str = "", options: dict | None = None):
+    print("\n--- Initiating Questionary ---\n")
 
-    if isinstance(final, dict):
-        print("\n\nFinal Answer:", final)
-        print("\n\n", answers, "\n\n")
-        return final
+    if not text_context:
+        print("No text context provided.")
+        return "ERROR: No text context provided."
 
-    print("Something went wrong...", final)
-    return final
+    if not question:
+        print("No question provided.")
+        return "ERROR: No question provided."
 
+    key = result_key("questionary", cache_payload(text_context, options, question=question))
+    use_cache = use_result_cache(options)
 
-def initiate(question: str, text_context: str = ""):
-    print(f"\n--- Initiating Questionary ---\n")
+    if use_cache:
+        cached = result_cache.get(key)
+        if cached is not None:
+            print("Answer served from the result cache.")
+            return cached
+
+    def run():
+        rsp = find_answer_in_text(question, text_context, options)
+        print("\n--- Questionary Completed ---\n")
+        print(rsp)
+
+        if use_cache and is_cacheable_answer(rsp):
+            result_cache.put(key, rsp)
+
+        return rsp
+
+    return flights.do(key, run)
+
+
+def initiate_batch(
+    questions: list[str], text_context: str = "", options: dict | None = None
+):
+    print("\n--- Initiating Questionary Batch ---\n")
 
     if not text_context:
         print("No text context provided.")
         return "ERROR: No text context provided."
 
-    if not question:
+    if not questions or not all(questions):
         print("No question provided.")
         return "ERROR: No question provided."
 
-    rsp = find_answer_in_text(question, text_context)
-    print(f"\n--- Questionary Completed ---\n")
+    # cached per question, so a batch only generates the questions not seen before
+    use_cache = use_result_cache(options)
+    keys = [
+        result_key("questionary", cache_payload(text_context, options, question=question))
+        for question in questions
+    ]
+    rsp = [result_cache.get(key) if use_cache else None for key in keys]
+
+    missing = [i for i, answer in enumerate(rsp) if answer is None]
+    if len(missing) < len(questions):
+        print(f"{len(questions) - len(missing)} answers served from the result cache.")
+
+    if missing:
+        missing_questions = [questions[i] for i in missing]
+        batch_key = result_key(
+            "questionary_batch",
+            cache_payload(text_context, options, questions=missing_questions),
+        )
+        answers = flights.do(
+            batch_key,
+            lambda: find_answers_in_text(missing_questions, text_context, options),
+        )
+        for i, answer in zip(missing, answers, strict=True):
+            rsp[i] = answer
+            if use_cache and is_cacheable_answer(answer):
+                result_cache.put(keys[i], answer)
+
+    print("\n--- Questionary Batch Completed ---\n")
     print(rsp)
     return rsp
 
 
-__all__ = ["initiate"]
+def stream_the_final_answer(
+    answers: list[str], question: str, options: dict | None = None
+):
+    """
+    Resolve the final answer like resolve_the_final_answer, the root is streamed.
+
+    Yields:
+        dict: {"event": "token", "text"} while the root is generated.
+
+    Returns:
+        (dict | str): The final answer as dict, "NOANSWER" or an "ERROR: ..." message.
+    """
+    root = plan_final_answer(answers, question, options)
+
+    if isinstance(root, str):
+        return root
+
+    try:
+        streamed, generated_tokens = None, None
+        events = engine.stream_many_from_prompt(
+            complete_prompts=[root["prompt"]],
+            max_new_tokens=root["max_new_tokens"],
+            prefixes=[root["prefix"]],
+            json_keys=FINAL_ANSWER_KEYS,
+        )
+
+        for event in events:
+            if "output" in event:
+                streamed = event["output"]
+                generated_tokens = event["generated_tokens"]
+            else:
+                yield {"event": "token", "text": event["text"]}
+
+        if streamed is None:
+            raise Exception("The generation failed.")
+
+        record_outputs(
+            "questionary_final",
+            [root["input_tokens"]],
+            [root["max_new_tokens"]],
+            [generated_tokens],
+        )
+
+        return parse_final_answer(streamed, resolve_as_json=True)
+
+    except Exception as e:
+        print("Failed to generate the final answer")
+        print(e)
+        return f"ERROR: Failed to generate the final answer {str(e)}"
+
+
+def stream_answer(
+    question: str, text_context: str = "", options: dict | None = None
+) -> Iterator[dict]:
+    """
+    Answer the question and stream the progress as events.
+
+    Args:
+        question (str): The question to answer.
+        text_context (str): The text to answer the question from.
+        options (dict | None): The request options, e.g. "top_k" or "cache".
+
+    Yields:
+        dict: {"event": "chunks", "count"} with the number of selected chunks,
+        {"event": "chunk_token", "chunk", "text"} while a chunk is answered,
+        {"event": "chunk_answer", "chunk", "answer"} once a chunk is done (None without answer),
+        {"event": "token", "text"} for the final answer while it is generated and
+        {"event": "answer", "answer"} at the end, or {"event": "error", "error"}.
+    """
+    print("\n--- Initiating Questionary Stream ---\n")
+
+    if not text_context:
+        yield {"event": "error", "error": "ERROR: No text context provided."}
+        return
+
+    if not question:
+        yield {"event": "error", "error": "ERROR: No question provided."}
+        return
+
+    # the same key as initiate, streamed and blocking requests share their results
+    key = result_key("questionary", cache_payload(text_context, options, question=question))
+    use_cache = use_result_cache(options)
+
+    if use_cache:
+        cached = result_cache.get(key)
+        if cached is not None:
+            print("Answer served from the result cache.")
+            yield {"event": "answer", "answer": cached}
+            return
+
+    prepared = prepare_chunk_prompts([question], text_context, options)
+
+    if isinstance(prepared, str):
+        yield {"event": "error", "error": prepared}
+        return
+
+    selected = prepared["selections"][0]
+    yield {"event": "chunks", "count": len(selected)}
+
+    # the answers are resolved in the order of the text, not in the order they finish
+    parsed = [None] * len(selected)
+    events = engine.stream_many_from_prompt(
+        complete_prompts=prepared["prompts"],
+        max_new_tokens=prepared["max_new_tokens"],
+        prefixes=prepared["prefixes"],
+        prefix_cache=prepared["prefix_cache"],
+        stop_strings=["NOANSWER"],
+        json_keys=ANSWER_KEYS,
+    )
+
+    for event in events:
+        chunk = selected[event["index"]][0] + 1
+
+        if "output" not in event:
+            yield {"event": "chunk_token", "chunk": chunk, "text": event["text"]}
+            continue
+
+        if event["output"] is None:
+            yield {"event": "error", "error": f"ERROR: Failed to run model on chunk {chunk}"}
+            return
+
+        record_outputs(
+            "questionary_chunk",
+            [prepared["input_tokens"][event["index"]]],
+            [prepared["max_new_tokens"][event["index"]]],
+            [event["generated_tokens"]],
+        )
+        parsed[event["index"]] = parse_chunk_answer(event["output"])
+        answer = parsed[event["index"]]
+        yield {
+            "event": "chunk_answer",
+            "chunk": chunk,
+            "answer": answer[1] if answer is not None else None,
+        }
+
+    found = [answer for answer in parsed if answer is not None]
+    answers = [response for response, _ in found]
+    json_answers = [data for _, data in found]
+
+    final = None
+    if len(answers) > 1:
+        final = yield from stream_the_final_answer(answers, question, options)
+
+    rsp = finish_answer(
+        question,
+        answers,
+        json_answers,
+        retrieval_scores_of(selected),
+        final,
+        options,
+    )
+
+    if not is_cacheable_answer(rsp):
+        yield {"event": "error", "error": rsp}
+        return
+
+    if use_cache:
+        result_cache.put(key, rsp)
+
+    print("\n--- Questionary Stream Completed ---\n")
+    yield {"event": "answer", "answer": rsp}
+
+
+__all__ = ["initiate", "initiate_batch", "stream_answer"]
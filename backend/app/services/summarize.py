@@ -1,61 +1,264 @@
-from app.services.llms import llama, utils
+from collections.abc import Iterator
+
+from app.core.config import settings
+from app.services.budget import plan_stage, record_outputs, scale_max_new_tokens
+from app.services.engine import engine
+from app.services.json_stream import empty_json_object
+from app.services.llms import llama
+from app.utils.extractive import select_sentences
 from app.utils.general import (
+    concat_json_objects_by_keys,
+    count_tokens,
     extract_and_validate_json_objects,
+    pack_token_groups,
     split_text_into_chunks,
-    concat_json_objects_by_keys,
+    split_text_into_sentences,
+    split_text_into_token_chunks,
 )
+from app.utils.result_cache import (
+    result_cache,
+    result_key,
+    section_cache,
+    use_result_cache,
+)
+from app.utils.single_flight import flights
+
+SECTION_SUMMARY_KEYS = ["Title", "Summary"]
+FINAL_SUMMARY_KEYS = ["Title", "Final Summary"]
 
 
-def finalise_summarized_text(summarized_json: list[dict], title: str) -> dict | None:
+def join_summaries(summarized_json: list[dict]) -> str:
     """
-    Finalize the summarized text by joining the individual chunks.
+    Join the summary json objects to one text, one "key: value" line per filled key.
+    """
+    joined_text = ""
+    for data in summarized_json:
+        if not isinstance(data, dict):
+            continue
+        for key, value in data.items():
+            if value != "":
+                joined_text += f"{key}: {value}\n"
+
+    return joined_text
+
+
+def parse_summary(streamed: str | None) -> dict | None:
+    """
+    The summary json of one generated output, None if there is no valid one.
+    """
+    if streamed is None:
+        print("No response generated for the section.")
+        return None
+
+    data = extract_and_validate_json_objects(streamed)
+
+    if len(data) == 0:
+        print("No JSON object found in the response.")
+        print(streamed)
+        return None
+
+    data = concat_json_objects_by_keys(data)
+
+    if not data:
+        print("\n\nFailed to extract summarized text\n\n")
+        print(streamed)
+        return None
+
+    return data
+
+
+def section_key(messages: list[dict[str, str]], max_new_tokens: int) -> str:
+    # the messages hold the section text and the instructions of the prompt
+    return result_key(
+        "summarize_section", {"messages": messages, "max_new_tokens": max_new_tokens}
+    )
+
+
+def generate_summaries(
+    messages_list: list[list[dict[str, str]]],
+    max_new_tokens: list[int],
+    input_tokens: list[int],
+    batch_size: int = 0,
+    use_cache: bool = True,
+    json_keys: list[str] = SECTION_SUMMARY_KEYS,
+    stage: str = "summarize_section",
+) -> tuple[list[dict | None], int]:
+    """
+    Generate and parse the json summaries of many independent prompts.
+
+    The summaries are memoized by their prompt (the section text and the instructions)
+    and the generation settings, only prompts without a cached summary reach the model.
+    So an edited document only summarizes its changed sections again.
 
     Args:
-        summarized_texts (list[dict]): The list of summarized text chunks,
+        messages_list (list[list[dict[str, str]]]): One message list per summary.
+        max_new_tokens (list[int]): The maximum number of generated tokens of every summary.
+        input_tokens (list[int]): The tokens of the text of every summary, recorded with the outputs.
+        batch_size (int): The prompts submitted together, 0 submits all at once.
+        use_cache (bool): Look up and store the summaries in the section cache.
+        json_keys (list[str]): The response schema of the prompts.
+        stage (str): The budget stage the outputs are recorded for.
+
+    Returns:
+        tuple[list[dict | None], int]: The summaries in order (None if the summary
+        failed) and the number of generated prompts.
+    """
+    keys = [
+        section_key(messages, tokens)
+        for messages, tokens in zip(messages_list, max_new_tokens, strict=True)
+    ]
+    summaries = [section_cache.get(key) if use_cache else None for key in keys]
+
+    missing = [i for i, summary in enumerate(summaries) if summary is None]
+    if len(missing) < len(messages_list):
+        print(
+            f"{len(messages_list) - len(missing)} of {len(messages_list)} summaries served from the section cache."
+        )
+
+    batch_size = batch_size or len(missing) or 1
+
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start : start + batch_size]
+        print(
+            f"\n--- Summarizing Text Sections {start+1}-{start+len(batch)} of {len(missing)} ---\n"
+        )
+        try:
+            outputs, generated_tokens = engine.generate_many_from_messages(
+                messages_list=[messages_list[i] for i in batch],
+                max_new_tokens=[max_new_tokens[i] for i in batch],
+                json_keys=json_keys,
+            )
+        except Exception as e:
+            print(f"Failed to summarize sections {start+1}-{start+len(batch)}")
+            print(e)
+            continue
+
+        record_outputs(
+            stage,
+            [input_tokens[i] for i in batch],
+            [max_new_tokens[i] for i in batch],
+            generated_tokens,
+        )
+
+        for i, streamed in zip(batch, outputs, strict=True):
+            data = parse_summary(streamed)
+            summaries[i] = data
+
+            if data is not None and use_cache:
+                section_cache.put(keys[i], data)
+
+    return summaries, len(missing)
+
+
+def stream_summaries(
+    messages_list: list[list[dict[str, str]]],
+    max_new_tokens: list[int],
+    input_tokens: list[int],
+    use_cache: bool = True,
+    json_keys: list[str] = SECTION_SUMMARY_KEYS,
+) -> Iterator[tuple[int, dict | None, bool]]:
+    """
+    Like generate_summaries, but yields every summary as soon as it is done.
+
+    Yields:
+        tuple[int, dict | None, bool]: The index of the prompt, its summary (None if
+        the summary failed) and whether it was served from the section cache.
+    """
+    keys = [
+        section_key(messages, tokens)
+        for messages, tokens in zip(messages_list, max_new_tokens, strict=True)
+    ]
+    missing = []
+
+    for i, key in enumerate(keys):
+        data = section_cache.get(key) if use_cache else None
+        if data is None:
+            missing.append(i)
+        else:
+            yield i, data, True
+
+    if not missing:
+        return
+
+    print(f"\n--- Streaming {len(missing)} Text Sections ---\n")
+
+    events = engine.stream_many_from_messages(
+        messages_list=[messages_list[i] for i in missing],
+        max_new_tokens=[max_new_tokens[i] for i in missing],
+        json_keys=json_keys,
+    )
+
+    for event in events:
+        if "output" not in event:
+            continue
+
+        i = missing[event["index"]]
+        record_outputs(
+            "summarize_section",
+            [input_tokens[i]],
+            [max_new_tokens[i]],
+            [event["generated_tokens"]],
+        )
+        data = parse_summary(event["output"])
+
+        if data is not None and use_cache:
+            section_cache.put(keys[i], data)
+
+        yield i, data, False
+
+
+def reduce_summarized_text(
+    summarized_json: list[dict],
+    title: str,
+    fan_in: int = settings.SUMMARIZE_REDUCE_FAN_IN,
+    use_cache: bool = True,
+    options: dict | None = None,
+) -> dict | None:
+    """
+    Reduce the section summaries until they fit into the final prompt.
+
+    As long as the joined summaries dont fit into the final prompt, they are reduced
+    level by level: the summaries are grouped (at most fan_in per group and never more
+    tokens than one prompt allows), every group is summarized again and all groups of
+    one level are generated together in one batched step.
+
+    Args:
+        summarized_json (list[dict]): The list of summarized text chunks,
         title (str): The title of the original text.
-        return_json (bool): Whether to return the final summary as a JSON object or a string. Defaults to False.
+        fan_in (int): The maximum number of summaries merged into one summary per level.
+        use_cache (bool): Reuse the cached summaries of unchanged reduce groups.
+        options (dict | None): The request options, e.g. "max_new_tokens".
     Returns:
 
-        (dict): The finalized summarized text in a JSON object.
+        (dict): The "messages" of the final prompt, its "input_tokens" and "max_new_tokens",
+        the reduction "depth" and the number of generation "calls" so far.
 
-        (None): If the finalization fails.
+        (None): If the reduction fails.
     """
 
-    json_structure = '{"Title":"","Final Summary":""}'
+    json_structure = empty_json_object(FINAL_SUMMARY_KEYS)
 
     finalise_summarized_text_instructions = f"""
     Prompt: Analyse carefully the text summaries, each summarize a single text section of one large text with the title: {title}. Understand which informations are important and most relevant from each summary. Then validate your extracted informations carefully and generate, one final summary for the original text. It is absolutely important, that you use the same language as the title of the original text and that you follow this JSON structure for your answer: {json_structure}."""
 
-    result = llama.generate_chat_based_assistant(finalise_summarized_text_instructions)
-
-    if isinstance(result, str):
-        print(result)
-        raise Exception("Failed to load the summarization pipeline or tokenizer.")
+    tokenizer = llama.get_tokenizer()
 
-    model, tokenizer, messages = result
+    if not tokenizer:
+        raise Exception("Failed to load the summarization tokenizer.")
 
-    print("unpack summarized_json list dicts to one string...")
-    # join json objects to one string
-    joined_text = ""
-    for data in summarized_json:
-        if not isinstance(data, dict):
-            continue
-        for key, value in data.items():
-            if value != "":
-                joined_text += f"{key}: {value}\n"
+    # the model itself is owned by the engine, every call only sends its own messages
+    messages = [
+        {"role": "system", "content": finalise_summarized_text_instructions},
+    ]
 
     system_instructions_tokens = len(
         tokenizer.encode(finalise_summarized_text_instructions)
     )
 
-    # Define the maximum context size and maximum generated tokens
-    max_context_size = 2048
-    max_generated_tokens = 500  # Adjust as needed
-
-    # Calculate the maximum number of tokens for the input
-    max_input_tokens = (
-        max_context_size - system_instructions_tokens - max_generated_tokens
+    budget = plan_stage(
+        "summarize_reduce", system_instructions_tokens, options, FINAL_SUMMARY_KEYS
     )
+    max_input_tokens = budget.max_input_tokens
 
     if max_input_tokens <= 0:
         print(
@@ -63,164 +266,274 @@ def finalise_summarized_text(summarized_json: list[dict], title: str) -> dict |
         )
         return None
 
-    summary_tokens = len(tokenizer.encode(joined_text))
+    fan_in = max(2, fan_in)
+    depth = 0
+    calls = 0
+
+    print("unpack summarized_json list dicts to strings...")
+    # every summary is one part of the reduction, its tokens are counted once
+    parts = [join_summaries([data]) for data in summarized_json]
+    parts = [part for part in parts if part != ""]
+    part_tokens = count_tokens(parts, tokenizer=tokenizer)
 
-    final_answer = None
+    # the joined text is counted from the token counts of its parts, not encoded again
+    while sum(part_tokens) > max_input_tokens:
+        if depth >= settings.SUMMARIZE_REDUCE_MAX_DEPTH:
+            print(f"Summaries still exceed the context after {depth} reduce levels.")
+            return None
 
-    if summary_tokens > max_input_tokens:
+        depth += 1
         print(
-            "Summarized answers exceed the maximum input tokens, splitting into smaller chunks."
+            f"\n--- Reduce level {depth}: {len(parts)} summaries exceed the maximum input tokens ---\n"
         )
-        # Split the answers into smaller chunks
-        answer_chunks = split_text_into_chunks(
-            joined_text, max_input_tokens, tokenizer=tokenizer
+
+        # group the parts in order, oversized single parts are split into chunks
+        groups = []
+        for group in pack_token_groups(part_tokens, max_input_tokens, max_items=fan_in):
+            if len(group) == 1 and part_tokens[group[0]] > max_input_tokens:
+                groups.extend(
+                    split_text_into_chunks(
+                        parts[group[0]], max_input_tokens, tokenizer=tokenizer
+                    )
+                )
+            else:
+                groups.append("".join(parts[idx] for idx in group))
+
+        print(f"Summarizing {len(groups)} groups in one batched step...")
+
+        # every group may generate tokens in proportion to its own size
+        group_tokens = count_tokens(groups, tokenizer=tokenizer)
+
+        summaries, generated = generate_summaries(
+            [[*messages, {"role": "user", "content": group}] for group in groups],
+            max_new_tokens=[
+                scale_max_new_tokens(budget, tokens) for tokens in group_tokens
+            ],
+            input_tokens=group_tokens,
+            use_cache=use_cache,
+            json_keys=FINAL_SUMMARY_KEYS,
+            stage="summarize_reduce",
         )
+        calls += generated
 
-        # Recursively resolve the final answer with the new chunks
         new_summaries = []
-        for i, chunk in enumerate(answer_chunks):
-            print(f"\n--- Summarizing Summary Chunk {i+1} ---\n")
-            prompt = f"{finalise_summarized_text_instructions}{chunk}"
-            try:
-                print(f"Prompt tokens total: {len(tokenizer.encode(prompt))}\n")
+        for i, data in enumerate(summaries):
+            if data is None:
+                print(f"Failed to process chunk {i+1}")
+                continue
 
-                print(f"Max Generated Tokens: {max_generated_tokens}\n")
+            print(f"\nIntermediate Summary {depth}.{i+1}: {data}\n")
 
-                print(
-                    f"Context window size: {len(tokenizer.encode(prompt)) + max_generated_tokens}\n"
-                )
+            new_summaries.append(data)
+
+        parts = [join_summaries([data]) for data in new_summaries]
+        parts = [part for part in parts if part != ""]
+        part_tokens = count_tokens(parts, tokenizer=tokenizer)
 
-                if len(messages) > 1:
-                    messages[1] = {"role": "user", "content": chunk}
-                else:
-                    messages.append({"role": "user", "content": chunk})
+        if not parts:
+            print("Failed to summarize any group of the reduce level.")
+            return None
 
-                print(f"Messages: {messages}")
+    joined_text = "".join(parts)
+    max_generated_tokens = scale_max_new_tokens(budget, sum(part_tokens))
 
-                streamed = utils.generate_output_from_model(
-                    model=model,
-                    tokenizer=tokenizer,
-                    messages=messages,
-                    max_new_tokens=max_generated_tokens,
-                )
+    print(f"Prompt tokens total: {system_instructions_tokens + sum(part_tokens)}\n")
+    print(f"Max Generated Tokens: {max_generated_tokens}\n")
+
+    print(
+        f"Context window size: {system_instructions_tokens + sum(part_tokens) + max_generated_tokens}\n"
+    )
 
-                data = extract_and_validate_json_objects(streamed)
+    messages.append({"role": "user", "content": joined_text})
 
-                if len(data) == 0:
-                    print("No JSON object found in the response.")
-                    print(streamed)
-                    continue
+    print(f"Messages: {messages}")
 
-                data = concat_json_objects_by_keys(data)
+    return {
+        "messages": messages,
+        "input_tokens": sum(part_tokens),
+        "max_new_tokens": max_generated_tokens,
+        "depth": depth,
+        "calls": calls,
+    }
 
-                if not data:
-                    print(f"\n\nFailed to extract summarized text on chunk {i+1}\n\n")
-                    print(streamed)
-                    continue
 
-                print(f"\nIntermediate Summary {i+1}: {data}\n")
+def parse_final_summary(streamed: str | None, reduction: dict) -> dict | None:
+    """
+    The final summary json of the generated output, with the reduction in "Metadata".
+    """
+    try:
+        if streamed is None:
+            raise Exception("No response generated for the final summary.")
 
-                new_summaries.append(data)
+        print(streamed)
 
-            except Exception as e:
-                print(f"Failed to process chunk {i+1}")
-                print(e)
-                continue  # Proceed to the next chunk if an error occurs
+        data = extract_and_validate_json_objects(streamed)
 
-        # Recursive call with the new summarized answers
-        print(
-            f"\n\nRecursive call with the new summarized answers: {new_summaries}\n\n"
+        if len(data) == 0:
+            print("No JSON object found in the response.")
+            raise Exception("No JSON object found in the response.")
+
+        data = concat_json_objects_by_keys(data)
+
+        if not data:
+            e = "\n\nFailed to extract summary from text\n\n"
+            raise Exception(e)
+
+        depth = reduction["depth"]
+        calls = reduction["calls"] + 1
+
+        print(f"Reduction done with depth {depth} and {calls} generation calls.")
+
+        data["Metadata"] = {"reduce_depth": depth, "reduce_calls": calls}
+
+        return data
+
+    except Exception as e:
+        print("Failed to generate the final answer")
+        print(e)
+        return None
+
+
+def finalise_summarized_text(
+    summarized_json: list[dict],
+    title: str,
+    fan_in: int = settings.SUMMARIZE_REDUCE_FAN_IN,
+    use_cache: bool = True,
+    options: dict | None = None,
+) -> dict | None:
+    """
+    Finalize the summarized text by joining the individual chunks.
+
+    Args:
+        summarized_json (list[dict]): The list of summarized text chunks,
+        title (str): The title of the original text.
+        fan_in (int): The maximum number of summaries merged into one summary per level.
+        use_cache (bool): Reuse the cached summaries of unchanged reduce groups.
+        options (dict | None): The request options, e.g. "max_new_tokens".
+    Returns:
+
+        (dict): The finalized summarized text in a JSON object, with the reduction
+        depth and the number of generations in "Metadata".
+
+        (None): If the finalization fails.
+    """
+    reduction = reduce_summarized_text(
+        summarized_json, title, fan_in=fan_in, use_cache=use_cache, options=options
+    )
+
+    if reduction is None:
+        return None
+
+    try:
+        streamed, generated_tokens = engine.generate_from_messages(
+            messages=reduction["messages"],
+            max_new_tokens=reduction["max_new_tokens"],
+            json_keys=FINAL_SUMMARY_KEYS,
         )
-        finalized_summary = finalise_summarized_text(new_summaries, title)
+    except Exception as e:
+        print("Failed to generate the final answer")
+        print(e)
+        return None
 
-        if not finalized_summary:
-            print("Failed to finalize the summarized text.")
-            return None
+    record_outputs(
+        "summarize_reduce",
+        [reduction["input_tokens"]],
+        [reduction["max_new_tokens"]],
+        [generated_tokens],
+    )
 
-        return finalized_summary
+    return parse_final_summary(streamed, reduction)
 
-    else:
-        prompt = f"{finalise_summarized_text_instructions}{joined_text}"
-        try:
-            print(f"Prompt tokens total: {len(tokenizer.encode(prompt))}\n")
-            print(f"Max Generated Tokens: {max_generated_tokens}\n")
 
-            print(
-                f"Context window size: {len(tokenizer.encode(prompt)) + max_generated_tokens}\n"
-            )
+def compress_ratio(options: dict | None) -> float | None:
+    """
+    The share of tokens the extractive pre-compression keeps, None if it is disabled.
+    """
+    value = (options or {}).get("compress", settings.SUMMARIZE_COMPRESS)
 
-            if len(messages) > 1:
-                messages[1] = {"role": "user", "content": joined_text}
-            else:
-                messages.append({"role": "user", "content": joined_text})
+    if value is True:
+        value = settings.SUMMARIZE_COMPRESS_RATIO
 
-            print(f"Messages: {messages}")
+    if value is False or value is None:
+        return None
 
-            streamed = utils.generate_output_from_model(
-                model=model,
-                tokenizer=tokenizer,
-                messages=messages,
-                max_new_tokens=max_generated_tokens,
-            )
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        print(f"Invalid compress option: {value}")
+        return None
 
-            print(streamed)
+    return value if 0 < value < 1 else None
 
-            data = extract_and_validate_json_objects(streamed)
 
-            if len(data) == 0:
-                print("No JSON object found in the response.")
-                raise Exception("No JSON object found in the response.")
+def compress_text(
+    text: str, ratio: float, max_input_tokens: int, tokenizer
+) -> tuple[str, float]:
+    """
+    Keep the best ranked sentences of the text up to ratio of its tokens, in order.
 
-            data = concat_json_objects_by_keys(data)
+    Texts which fit into one section are not compressed, there is nothing to save.
 
-            if not data:
-                e = f"\n\nFailed to extract summary from text\n\n"
-                raise Exception(e)
+    Returns:
+        tuple[str, float]: The compressed text and the share of tokens it kept.
+    """
+    sentences, token_counts = split_text_into_sentences(text, tokenizer=tokenizer)
+    total_tokens = sum(token_counts)
 
-            return data
+    if total_tokens <= max_input_tokens:
+        return text, 1.0
 
-        except Exception as e:
-            print("Failed to generate the final answer")
-            print(e)
-            return None
+    kept = select_sentences(sentences, token_counts, ratio)
+    kept_tokens = sum(token_counts[i] for i in kept)
 
+    print(
+        f"Compressed the text from {len(sentences)} to {len(kept)} sentences ({kept_tokens} of {total_tokens} tokens)."
+    )
+
+    return " ".join(sentences[i] for i in kept), kept_tokens / total_tokens
 
-def summarize_text(text: str, title: str) -> dict | None:
+
+def prepare_sections(
+    text: str, options: dict | None = None
+) -> tuple[list[tuple[int, list[dict]]], list[int], list[int], float] | None:
     """
-    Summarize the input text using the model.
+    Split the text into sections and prepare the messages of every section.
 
     Args:
         text (str): The input text to summarize.
+        options (dict | None): The request options, e.g. "max_new_tokens" or "compress".
 
     Returns:
-        str: The summarized text.
+        tuple[list[tuple[int, list[dict]]], list[int], list[int], float]: The (section
+        index, messages) pairs, the input tokens and the maximum generated tokens of
+        every section and the compression ratio of the text, None if the text cant be split.
     """
-    system_instructions = """
-    Prompt: Understand and analyse the text carefully. Extract the informations which are most important and use them to summarize the text. It is very important, that you use the same language as the text. Follow this JSON structure for your answer: {"Title":"","Summary":""}."""
+    json_structure = empty_json_object(SECTION_SUMMARY_KEYS)
 
-    result = llama.generate_chat_based_assistant(system_instructions)
+    system_instructions = f"""
+    Prompt: Understand and analyse the text carefully. Extract the informations which are most important and use them to summarize the text. It is very important, that you use the same language as the text. Follow this JSON structure for your answer: {json_structure}."""
 
-    if isinstance(result, str):
-        print(result)
-        raise Exception("Failed to load the summarization pipeline or tokenizer.")
+    tokenizer = llama.get_tokenizer()
 
-    model, tokenizer, messages = result
+    if not tokenizer:
+        raise Exception("Failed to load the summarization tokenizer.")
 
-    print(f"Tokenize System Instructions...")
+    # the model itself is owned by the engine, every section gets its own messages
+    messages = [
+        {"role": "system", "content": system_instructions},
+    ]
 
-    system_instructions_tokens = len(tokenizer.encode(system_instructions))
-
-    # Define the maximum context size and maximum generated tokens
-    max_context_size = 1845
+    print("Tokenize System Instructions...")
 
-    max_generated_tokens = 300  # Adjust as needed
+    system_instructions_tokens = len(tokenizer.encode(system_instructions))
 
-    print(f"Calculate the maximum number of tokens for the input...")
+    print("Calculate the maximum number of tokens for the input...")
 
-    # Calculate the maximum number of tokens for the input
-    max_input_tokens = (
-        max_context_size - system_instructions_tokens - max_generated_tokens
+    budget = plan_stage(
+        "summarize_section", system_instructions_tokens, options, SECTION_SUMMARY_KEYS
     )
+    max_context_size = budget.context_tokens
+    max_input_tokens = budget.max_input_tokens
 
     if max_input_tokens <= 0:
         print(
@@ -228,102 +541,255 @@ def summarize_text(text: str, title: str) -> dict | None:
         )
         return None
 
+    # optionally only the most relevant sentences of a long text reach the model
+    compression_ratio = 1.0
+    ratio = compress_ratio(options)
+    if ratio is not None:
+        text, compression_ratio = compress_text(
+            text, ratio, max_input_tokens, tokenizer
+        )
+
     print(
         f"Max Input Tokens: {max_input_tokens}, split the text into sections based on that..."
     )
 
-    text_chunks = split_text_into_chunks(text, max_input_tokens, tokenizer=tokenizer)
+    # the text is encoded once, every chunk comes with its token ids
+    text_chunks = split_text_into_token_chunks(
+        text, max_input_tokens, tokenizer=tokenizer
+    )
 
     print(f"Text split into {len(text_chunks)} sections.")
 
-    summarized_json = []
+    # prepare the messages of all sections first, they dont depend on each other
+    # and are generated batched (map phase)
+    sections = []
+    input_tokens = []
+    max_new_tokens = []
 
-    for i, chunk in enumerate(text_chunks):
-        print(f"\n--- Summarizing Text Section {i+1} ---\n", end="\n")
-        try:
-            prompt = f"{system_instructions}{chunk}"
-
-            print(f"Prompt tokens total: {len(tokenizer.encode(prompt))}\n")
-
-            print(f"Max Generated Tokens: {max_generated_tokens}\n")
+    for i, (chunk, chunk_token_ids) in enumerate(text_chunks):
+        prompt_tokens = system_instructions_tokens + len(chunk_token_ids)
+        # a short tail section does not get the decode budget of a full one
+        max_generated_tokens = scale_max_new_tokens(budget, len(chunk_token_ids))
 
-            print(
-                f"Total context window size: {len(tokenizer.encode(prompt)) + max_generated_tokens}\n"
-            )
+        print(
+            f"Section {i+1} prompt tokens total: {prompt_tokens}, max generated tokens: {max_generated_tokens}"
+        )
 
-            if len(tokenizer.encode(prompt)) + max_generated_tokens > max_context_size:
-                print(f"Prompt tokens total exceeds the context window size.\n")
-                raise Exception("Prompt tokens total exceeds the context window size.")
+        if prompt_tokens + max_generated_tokens > max_context_size:
+            print("Prompt tokens total exceeds the context window size.\n")
+            print(f"Failed to summarize chunk {i+1}")
+            continue  # Proceed to the next chunk if the section is too long
 
-            if len(messages) > 1:
-                messages[1] = {"role": "user", "content": chunk}
+        sections.append((i, [*messages, {"role": "user", "content": chunk}]))
+        input_tokens.append(len(chunk_token_ids))
+        max_new_tokens.append(max_generated_tokens)
 
-            else:
-                messages.append({"role": "user", "content": chunk})
+    return sections, input_tokens, max_new_tokens, compression_ratio
 
-            summarized_text = utils.generate_output_from_model(
-                model=model,
-                tokenizer=tokenizer,
-                messages=messages,
-                max_new_tokens=max_generated_tokens,
-            )
 
-            print(
-                f"\n--------------- Summarized Text: --------------------\n{summarized_text}\n"
-            )
+def summarize_text(
+    text: str, title: str, use_cache: bool = True, options: dict | None = None
+) -> dict | None:
+    """
+    Summarize the input text using the model.
 
-            data = extract_and_validate_json_objects(summarized_text)
+    Args:
+        text (str): The input text to summarize.
+        title (str): The title of the input text.
+        use_cache (bool): Reuse the cached summaries of unchanged sections.
+        options (dict | None): The request options, e.g. "max_new_tokens" or "compress".
 
-            if len(data) == 0:
-                print("No JSON object found in the response.")
-                print(summarized_text)
-                raise Exception("No JSON object found in the response.")
+    Returns:
+        str: The summarized text.
+    """
+    prepared = prepare_sections(text, options)
 
-            data = concat_json_objects_by_keys(data)
+    if prepared is None:
+        return None
 
-            if not data:
-                print(f"\n\nFailed to extract summarized text on chunk {i+1}\n\n")
-                print(summarized_text)
-                continue
+    sections, input_tokens, max_new_tokens, compression_ratio = prepared
 
-            print(f"\nIntermediate Summary {i+1}: {data}\n")
+    summaries, generated = generate_summaries(
+        [section_messages for _, section_messages in sections],
+        max_new_tokens=max_new_tokens,
+        input_tokens=input_tokens,
+        batch_size=settings.SUMMARIZE_MAP_BATCH_SIZE,
+        use_cache=use_cache,
+    )
 
-            summarized_json.append(data)
+    summarized_json = []
 
-        except Exception as e:
+    for (i, _), data in zip(sections, summaries, strict=True):
+        if data is None:
             print(f"Failed to summarize chunk {i+1}")
-            print(e)
             continue  # Proceed to the next chunk if an error occurs
 
+        print(f"\nIntermediate Summary {i+1}: {data}\n")
+
+        summarized_json.append(data)
+
     print(summarized_json)
 
     # Finalize the summarized texts
-    print(f"Finalize the summarized texts...")
+    print("Finalize the summarized texts...")
 
-    summary = finalise_summarized_text(summarized_json, title)
+    summary = finalise_summarized_text(
+        summarized_json, title, use_cache=use_cache, options=options
+    )
+
+    if summary:
+        summary["Metadata"]["sections"] = len(sections)
+        summary["Metadata"]["cached_sections"] = len(sections) - generated
+        summary["Metadata"]["compression_ratio"] = round(compression_ratio, 4)
 
     print(f"Summarization done! Returning summary: \n\n{summary}")
 
     return summary
 
 
-def initiate(text: str, title: str) -> dict:
+def cache_payload(text: str, title: str, options: dict | None) -> dict:
+    # options which change the summary (e.g. "max_new_tokens") are part of the key
+    options = {key: value for key, value in (options or {}).items() if key != "cache"}
+    return {"text": text, "title": title, "options": options}
+
+
+def initiate(text: str, title: str, options: dict | None = None) -> dict:
     """
     Initiate the summarization process.
 
     Args:
         text (str): The input text to summarize.
         title (str): The title of the input text.
+        options (dict | None): The request options, e.g. "cache", "max_new_tokens" or "compress".
 
     Returns:
         dict: The summarized text.
     """
-    result = summarize_text(text, title)
+    # identical documents are served from the result cache
+    key = result_key("summarize", cache_payload(text, title, options))
+    use_cache = use_result_cache(options)
+
+    if use_cache:
+        cached = result_cache.get(key)
+        if cached is not None:
+            print("Summary served from the result cache.")
+            return cached
+
+    def run() -> dict:
+        result = summarize_text(text, title, use_cache=use_cache, options=options)
+
+        if not result:
+            return {"error": "Failed to summarize the text."}
+
+        if use_cache:
+            result_cache.put(key, result)
+
+        return result
+
+    return flights.do(key, run)
+
+
+def stream_summary(text: str, title: str, options: dict | None = None) -> Iterator[dict]:
+    """
+    Summarize the text and stream the progress as events.
+
+    Args:
+        text (str): The input text to summarize.
+        title (str): The title of the input text.
+        options (dict | None): The request options, e.g. "cache", "max_new_tokens" or "compress".
+
+    Yields:
+        dict: {"event": "sections", "count", "compression_ratio"} once the text is split,
+        {"event": "section", "index", "summary"} for every section as soon as it is done,
+        {"event": "token", "text"} for the final summary while it is generated and
+        {"event": "summary", "summary"} at the end, or {"event": "error", "error"}.
+    """
+    key = result_key("summarize", cache_payload(text, title, options))
+    use_cache = use_result_cache(options)
+
+    if use_cache:
+        cached = result_cache.get(key)
+        if cached is not None:
+            print("Summary served from the result cache.")
+            yield {"event": "summary", "summary": cached}
+            return
+
+    prepared = prepare_sections(text, options)
+
+    if prepared is None:
+        yield {"event": "error", "error": "Failed to summarize the text."}
+        return
+
+    sections, input_tokens, max_new_tokens, compression_ratio = prepared
+    yield {
+        "event": "sections",
+        "count": len(sections),
+        "compression_ratio": round(compression_ratio, 4),
+    }
+
+    # the section summaries are reduced in the order of the text
+    summaries = [None] * len(sections)
+    cached_sections = 0
+
+    for i, data, cached in stream_summaries(
+        [section_messages for _, section_messages in sections],
+        max_new_tokens=max_new_tokens,
+        input_tokens=input_tokens,
+        use_cache=use_cache,
+    ):
+        if data is None:
+            print(f"Failed to summarize chunk {sections[i][0]+1}")
+            continue
+
+        summaries[i] = data
+        cached_sections += int(cached)
+        yield {"event": "section", "index": sections[i][0], "summary": data}
+
+    summarized_json = [data for data in summaries if data is not None]
+
+    reduction = reduce_summarized_text(
+        summarized_json, title, use_cache=use_cache, options=options
+    )
+
+    if reduction is None:
+        yield {"event": "error", "error": "Failed to summarize the text."}
+        return
+
+    streamed, generated_tokens = None, None
+    events = engine.stream_many_from_messages(
+        messages_list=[reduction["messages"]],
+        max_new_tokens=reduction["max_new_tokens"],
+        json_keys=FINAL_SUMMARY_KEYS,
+    )
+
+    for event in events:
+        if "output" in event:
+            streamed = event["output"]
+            generated_tokens = event["generated_tokens"]
+        else:
+            yield {"event": "token", "text": event["text"]}
+
+    record_outputs(
+        "summarize_reduce",
+        [reduction["input_tokens"]],
+        [reduction["max_new_tokens"]],
+        [generated_tokens],
+    )
+
+    summary = parse_final_summary(streamed, reduction)
+
+    if not summary:
+        yield {"event": "error", "error": "Failed to summarize the text."}
+        return
+
+    summary["Metadata"]["sections"] = len(sections)
+    summary["Metadata"]["cached_sections"] = cached_sections
+    summary["Metadata"]["compression_ratio"] = round(compression_ratio, 4)
 
-    if not result:
-        return {"error": "Failed to summarize the text."}
+    if use_cache:
+        result_cache.put(key, summary)
 
-    return result
+    yield {"event": "summary", "summary": summary}
 
 
-__all__ = ["initiate"]
+__all__ = ["initiate", "stream_summary"]
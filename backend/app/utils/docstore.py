@@ -0,0 +1,238 @@
+# Persistent store for the preprocessing of documents.
+#
+# Clients often ask many questions about the same text. The sentence split, the
+# token counts per sentence, the chunk boundaries and the retrieval index only
+# depend on the text (and the tokenizer), so they are computed once, keyed by a
+# hash of the content and kept on disk: the metadata in sqlite, the arrays as
+# .npy files which are loaded memory mapped.
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from app.core.config import settings
+from app.utils.general import (
+    join_sentence_chunks,
+    pack_sentences_into_chunks,
+    split_text_into_sentences,
+)
+from app.utils.retrieval import BM25Index
+
+# bump when the way the sentences are counted or packed changes, the stored documents are not used anymore
+DOCUMENT_VERSION = 3
+
+
+def document_hash(text: str) -> str:
+    # the token counts depend on the tokenizer, so the model is part of the key
+    return hashlib.sha256(
+        f"{DOCUMENT_VERSION}\0{settings.LLM_MODEL_ID}\0{text}".encode()
+    ).hexdigest()
+
+
+class DocumentStore:
+    """
+    Content hash keyed store of the preprocessed documents.
+
+    Args:
+        path (str): The directory of the sqlite database and the array files.
+        max_documents (int): The number of documents kept, the least recently used are evicted.
+    """
+
+    def __init__(
+        self,
+        path: str = settings.DOCSTORE_PATH,
+        max_documents: int = settings.DOCSTORE_MAX_DOCUMENTS,
+    ):
+        self.path = path
+        self.max_documents = max_documents
+        self.__lock = threading.Lock()
+        self.__initiated = False
+
+    @contextmanager
+    def __connect(self):
+        conn = sqlite3.connect(os.path.join(self.path, "documents.sqlite3"), timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def __initiate(self):
+        if self.__initiated:
+            return
+
+        with self.__lock:
+            if self.__initiated:
+                return
+
+            os.makedirs(self.path, exist_ok=True)
+            with self.__connect() as conn:
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS documents (
+                        doc_hash TEXT PRIMARY KEY,
+                        sentences TEXT NOT NULL,
+                        last_used REAL NOT NULL
+                    )
+                    """
+                )
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS chunkings (
+                        doc_hash TEXT NOT NULL,
+                        max_input_tokens INTEGER NOT NULL,
+                        boundaries TEXT NOT NULL,
+                        vocabulary TEXT,
+                        PRIMARY KEY (doc_hash, max_input_tokens)
+                    )
+                    """
+                )
+            self.__initiated = True
+
+    def __document_dir(self, doc_hash: str) -> str:
+        return os.path.join(self.path, doc_hash[:2], doc_hash)
+
+    def __save_array(self, doc_hash: str, name: str, array: np.ndarray):
+        # written to a temp file first, concurrent readers never see half an array
+        directory = self.__document_dir(doc_hash)
+        os.makedirs(directory, exist_ok=True)
+        target = os.path.join(directory, f"{name}.npy")
+        temp = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp, "wb") as f:
+            np.save(f, array)
+        os.replace(temp, target)
+
+    def __load_array(self, doc_hash: str, name: str) -> np.ndarray:
+        return np.load(
+            os.path.join(self.__document_dir(doc_hash), f"{name}.npy"), mmap_mode="r"
+        )
+
+    def __evict(self, conn: sqlite3.Connection):
+        rows = conn.execute(
+            "SELECT doc_hash FROM documents ORDER BY last_used DESC LIMIT -1 OFFSET ?",
+            (self.max_documents,),
+        ).fetchall()
+
+        for (doc_hash,) in rows:
+            conn.execute("DELETE FROM documents WHERE doc_hash = ?", (doc_hash,))
+            conn.execute("DELETE FROM chunkings WHERE doc_hash = ?", (doc_hash,))
+            shutil.rmtree(self.__document_dir(doc_hash), ignore_errors=True)
+
+    def get_sentences(self, text: str, tokenizer=None) -> tuple[list[str], np.ndarray]:
+        """
+        The sentences of the text and their token counts, computed on the first call.
+        """
+        self.__initiate()
+        doc_hash = document_hash(text)
+
+        with self.__connect() as conn:
+            row = conn.execute(
+                "SELECT sentences FROM documents WHERE doc_hash = ?", (doc_hash,)
+            ).fetchone()
+
+            if row:
+                try:
+                    token_counts = self.__load_array(doc_hash, "token_counts")
+                    conn.execute(
+                        "UPDATE documents SET last_used = ? WHERE doc_hash = ?",
+                        (time.time(), doc_hash),
+                    )
+                    print(f"Document {doc_hash[:12]} loaded from the document store.")
+                    return json.loads(row[0]), token_counts
+                except FileNotFoundError:
+                    print(f"Document {doc_hash[:12]} is incomplete, preprocess again.")
+
+        sentences, token_counts = split_text_into_sentences(text, tokenizer=tokenizer)
+        token_counts = np.asarray(token_counts, dtype=np.int32)
+
+        self.__save_array(doc_hash, "token_counts", token_counts)
+
+        with self.__connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO documents (doc_hash, sentences, last_used) VALUES (?, ?, ?)",
+                (doc_hash, json.dumps(sentences), time.time()),
+            )
+            self.__evict(conn)
+
+        return sentences, token_counts
+
+    def get_chunks_and_index(
+        self, text: str, max_input_tokens: int, tokenizer=None
+    ) -> tuple[list[str], BM25Index]:
+        """
+        The chunks of the text for the given input budget and their bm25 index.
+
+        The chunk boundaries only need the stored token counts, the index arrays are
+        loaded memory mapped once they were built.
+        """
+        sentences, token_counts = self.get_sentences(text, tokenizer=tokenizer)
+        doc_hash = document_hash(text)
+        index_name = f"bm25_{max_input_tokens}"
+
+        with self.__connect() as conn:
+            row = conn.execute(
+                "SELECT boundaries, vocabulary FROM chunkings WHERE doc_hash = ? AND max_input_tokens = ?",
+                (doc_hash, max_input_tokens),
+            ).fetchone()
+
+        if row and row[1]:
+            try:
+                boundaries = [tuple(boundary) for boundary in json.loads(row[0])]
+                index = BM25Index.from_arrays(
+                    json.loads(row[1]),
+                    {
+                        name: self.__load_array(doc_hash, f"{index_name}_{name}")
+                        for name in [
+                            "term_offsets",
+                            "chunk_ids",
+                            "frequencies",
+                            "chunk_lengths",
+                        ]
+                    },
+                )
+                return join_sentence_chunks(
+                    sentences, boundaries, max_input_tokens, tokenizer=tokenizer
+                ), index
+            except FileNotFoundError:
+                print(f"Index of document {doc_hash[:12]} is incomplete, rebuild it.")
+
+        # the stored counts are the counts within a chunk, the first sentence of
+        # a chunk is counted without the space in front of it
+        boundaries = pack_sentences_into_chunks(
+            token_counts.tolist(),
+            max_input_tokens,
+            lambda idx: len(tokenizer.encode(sentences[idx], add_special_tokens=False)),
+        )
+        chunks = join_sentence_chunks(
+            sentences, boundaries, max_input_tokens, tokenizer=tokenizer
+        )
+        index = BM25Index(chunks)
+
+        for name, array in index.to_arrays().items():
+            self.__save_array(doc_hash, f"{index_name}_{name}", array)
+
+        with self.__connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO chunkings (doc_hash, max_input_tokens, boundaries, vocabulary) VALUES (?, ?, ?, ?)",
+                (
+                    doc_hash,
+                    max_input_tokens,
+                    json.dumps(boundaries),
+                    json.dumps(index.vocabulary),
+                ),
+            )
+
+        return chunks, index
+
+
+docstore = DocumentStore()
+
+__all__ = ["docstore", "document_hash"]
@@ -0,0 +1,135 @@
+# Extractive pre-compression of long texts before the summarize map phase.
+#
+# Most sentences of a very long text never make it into the final summary, but
+# every one of them is prefilled by the model. The sentences are ranked with
+# TextRank over their TF-IDF vectors and only the best ones (up to a ratio of the
+# tokens of the text) are kept, in the order of the text.
+#
+# The TF-IDF matrix X is kept sparse (coo layout in numpy arrays) and the
+# similarity matrix X @ X.T is never built: every TextRank iteration multiplies
+# with X and X.T, so the cost grows with the words of the text, not with the
+# square of its sentences.
+
+import numpy as np
+
+from app.utils.retrieval import tokenize_words
+
+
+def tfidf_vectors(
+    sentences: list[str],
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+    """
+    The l2 normalized TF-IDF vectors of the sentences, as sparse matrix.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray, int]: The rows (sentence ids),
+        columns (term ids) and values of the non zero entries and the number of terms.
+    """
+    vocabulary: dict[str, int] = {}
+    term_ids = []
+    sentence_ids = []
+
+    for sentence_id, sentence in enumerate(sentences):
+        words = tokenize_words(sentence)
+        term_ids.extend(vocabulary.setdefault(word, len(vocabulary)) for word in words)
+        sentence_ids.extend([sentence_id] * len(words))
+
+    term_ids = np.asarray(term_ids, dtype=np.int64)
+    sentence_ids = np.asarray(sentence_ids, dtype=np.int64)
+    size = max(len(sentences), 1)
+
+    # unique (sentence, term) pairs, their counts are the term frequencies
+    pairs, frequencies = np.unique(
+        sentence_ids * len(vocabulary) + term_ids, return_counts=True
+    )
+    rows = pairs // max(len(vocabulary), 1)
+    cols = pairs % max(len(vocabulary), 1)
+
+    document_frequencies = np.bincount(cols, minlength=len(vocabulary))
+    idf = np.log((1 + size) / (1 + document_frequencies)) + 1
+    values = frequencies * idf[cols]
+
+    norms = np.sqrt(np.bincount(rows, weights=values**2, minlength=len(sentences)))
+    values = values / np.maximum(norms[rows], 1e-12)
+
+    return rows, cols, values, len(vocabulary)
+
+
+def textrank_scores(
+    sentences: list[str],
+    damping: float = 0.85,
+    iterations: int = 50,
+    tolerance: float = 1e-6,
+) -> np.ndarray:
+    """
+    The TextRank score of every sentence, with the cosine similarity of the TF-IDF
+    vectors as edge weights.
+
+    Args:
+        sentences (list[str]): The sentences of the text.
+        damping (float): The damping factor of the random walk.
+        iterations (int): The maximum number of power iterations.
+        tolerance (float): Stop once the scores change less than this (l1).
+
+    Returns:
+        np.ndarray: One score per sentence.
+    """
+    count = len(sentences)
+    if count == 0:
+        return np.zeros(0)
+
+    rows, cols, values, terms = tfidf_vectors(sentences)
+
+    def similarity(vector: np.ndarray) -> np.ndarray:
+        # (X @ X.T - I) @ vector without the self similarity of the normalized rows
+        projected = np.bincount(cols, weights=values * vector[rows], minlength=terms)
+        result = np.bincount(rows, weights=values * projected[cols], minlength=count)
+        self_similarity = np.bincount(rows, weights=values**2, minlength=count)
+        return result - self_similarity * vector
+
+    # the summed edge weights of every sentence, sentences without edges keep (1 - d)
+    degrees = similarity(np.ones(count))
+    degrees = np.where(degrees > 1e-12, degrees, np.inf)
+
+    scores = np.ones(count)
+    for _ in range(iterations):
+        new_scores = (1 - damping) + damping * similarity(scores / degrees)
+        converged = np.abs(new_scores - scores).sum() < tolerance
+        scores = new_scores
+        if converged:
+            break
+
+    return scores
+
+
+def select_sentences(
+    sentences: list[str], token_counts: list[int], ratio: float
+) -> list[int]:
+    """
+    Keep the best ranked sentences up to ratio of the tokens of the text.
+
+    Args:
+        sentences (list[str]): The sentences of the text.
+        token_counts (list[int]): The token count of every sentence.
+        ratio (float): The share of the tokens to keep, between 0 and 1.
+
+    Returns:
+        list[int]: The indices of the kept sentences, in the order of the text.
+    """
+    if not sentences:
+        return []
+
+    token_counts = np.asarray(token_counts, dtype=np.int64)
+    target = ratio * token_counts.sum()
+
+    # best first, the first sentence of equal scores wins
+    order = np.argsort(-textrank_scores(sentences), kind="stable")
+    kept = order[np.cumsum(token_counts[order]) <= target]
+
+    if len(kept) == 0:
+        kept = order[:1]
+
+    return np.sort(kept).tolist()
+
+
+__all__ = ["select_sentences", "textrank_scores"]
@@ -1,4 +1,8 @@
-import nltk, json
+import json
+from collections.abc import Callable
+
+import nltk
+import numpy as np
 from bs4 import BeautifulSoup
 
 
@@ -40,31 +44,320 @@ def extract_and_validate_json_objects(input_string: str) -> list[dict]:
         raise Exception("Couldnt resolve json objects, due to crappy code from GPT!!!")
 
 
-def split_text_into_chunks(text, max_input_tokens, tokenizer=None):
+def encode_texts(texts: list[str], tokenizer=None) -> list[list[int]]:
+    """
+    Encode many texts in one batched tokenizer call, without special tokens.
+    """
+    if not texts:
+        return []
+
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if (
+        backend is not None
+        and hasattr(backend, "encode_batch_fast")
+        and backend.truncation is None
+        and backend.padding is None
+    ):
+        # the rust tokenizer encodes the batch in parallel, without offsets and
+        # without building the python encodings of the wrapper
+        return [
+            encoding.ids
+            for encoding in backend.encode_batch_fast(texts, add_special_tokens=False)
+        ]
+
+    return tokenizer(texts, add_special_tokens=False)["input_ids"]
+
+
+def count_tokens(texts: list[str], tokenizer=None) -> list[int]:
+    """
+    The token counts of many texts, without special tokens, in one batched call.
+    """
+    return [len(token_ids) for token_ids in encode_texts(texts, tokenizer=tokenizer)]
+
+
+def encode_sentences(sentences: list[str], tokenizer=None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Encode all sentences in one batched tokenizer call, as they are joined in a chunk.
+
+    Every sentence but the first is encoded with the space it is joined with, the
+    tokenizers dont merge tokens across a space in front of a word, so the tokens of
+    a joined chunk are the tokens of its sentences one after another.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The token ids of all sentences one after another
+        and the offsets of the sentences into them (one more than there are sentences).
+    """
+    encoded = encode_texts(
+        [f" {sentence}" if i else sentence for i, sentence in enumerate(sentences)],
+        tokenizer=tokenizer,
+    )
+
+    offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+    np.cumsum([len(token_ids) for token_ids in encoded], out=offsets[1:])
+    token_ids = np.fromiter(
+        (token_id for sentence_ids in encoded for token_id in sentence_ids),
+        dtype=np.int64,
+        count=int(offsets[-1]),
+    )
+
+    return token_ids, offsets
+
+
+def split_text_into_sentences(text, tokenizer=None) -> tuple[list[str], list[int]]:
+    """
+    Split the text into sentences and count the tokens of every sentence.
+
+    Returns:
+        tuple[list[str], list[int]]: The sentences and their token counts.
+    """
     sentences = nltk.sent_tokenize(text)
-    chunks = []
-    current_chunk = ""
+    _, offsets = encode_sentences(sentences, tokenizer=tokenizer)
+    return sentences, np.diff(offsets).tolist()
+
+
+def pack_sentences_into_chunks(
+    token_counts: list[int],
+    max_input_tokens: int,
+    first_token_count: Callable[[int], int] | None = None,
+) -> list[tuple[int, int]]:
+    """
+    Pack consecutive sentences into chunks of at most max_input_tokens.
+
+    Every chunk takes sentences in order as long as the next one fits, which gives
+    the fewest chunks possible without reordering the sentences. A sentence which is
+    too long on its own becomes a chunk of its own (see split_token_ids), there are
+    no empty chunks.
+
+    Args:
+        token_counts (list[int]): The token count of every sentence within a chunk.
+        max_input_tokens (int): The maximum tokens of one chunk.
+        first_token_count (Callable | None): The token count of a sentence which starts a chunk, if it differs.
+
+    Returns:
+        list[tuple[int, int]]: The (start, end) sentence index range of every chunk.
+    """
+    boundaries = []
+    start = 0
     current_tokens = 0
+
+    for idx, sentence_tokens in enumerate(token_counts):
+        if idx > start and current_tokens + sentence_tokens > max_input_tokens:
+            boundaries.append((start, idx))
+            start = idx
+
+        if idx == start:
+            current_tokens = (
+                first_token_count(idx) if first_token_count else sentence_tokens
+            )
+        else:
+            current_tokens += sentence_tokens
+
+    if start < len(token_counts):
+        boundaries.append((start, len(token_counts)))
+
+    return boundaries
+
+
+def split_token_ids(
+    token_ids: list[int], max_tokens: int, tokenizer
+) -> list[tuple[str, list[int]]]:
+    """
+    Hard split token ids which dont fit into max_tokens into pieces of at most max_tokens.
+
+    A piece never ends within a character which is split over several tokens.
+
+    Returns:
+        list[tuple[str, list[int]]]: The text and the token ids of every piece.
+    """
+    max_tokens = max(1, max_tokens)
+    pieces = []
+    start = 0
+
+    while start < len(token_ids):
+        end = min(start + max_tokens, len(token_ids))
+        text = tokenizer.decode(token_ids[start:end])
+
+        while end < len(token_ids) and end - start > 1 and text.endswith("\ufffd"):
+            end -= 1
+            text = tokenizer.decode(token_ids[start:end])
+
+        pieces.append((text, token_ids[start:end]))
+        start = end
+
+    return pieces
+
+
+def join_sentence_chunks(
+    sentences: list[str],
+    boundaries: list[tuple[int, int]],
+    max_input_tokens: int | None = None,
+    tokenizer=None,
+) -> list[str]:
+    """
+    Join the sentences of every chunk.
+
+    With a tokenizer, a chunk of one sentence which exceeds max_input_tokens is
+    split into several chunks at token boundaries.
+    """
+    chunks = []
+    for start, end in boundaries:
+        chunk = " ".join(sentences[start:end]).strip()
+
+        if tokenizer is not None and end - start == 1:
+            token_ids = tokenizer.encode(chunk, add_special_tokens=False)
+            if len(token_ids) > max_input_tokens:
+                chunks.extend(
+                    piece
+                    for piece, _ in split_token_ids(token_ids, max_input_tokens, tokenizer)
+                )
+                continue
+
+        chunks.append(chunk)
+
+    return chunks
+
+
+def split_text_into_token_chunks(
+    text, max_input_tokens, tokenizer=None
+) -> list[tuple[str, list[int]]]:
+    """
+    Split the text into chunks of whole sentences which fit into max_input_tokens.
+
+    The sentences are encoded once in one batched call, the chunks are packed from
+    their token counts and the token ids of a chunk are a slice of the encoded
+    sentences, so callers can count the tokens of a chunk without encoding it again.
+
+    Returns:
+        list[tuple[str, list[int]]]: The text and the token ids of every chunk.
+    """
     addtnl_string = ""
     addtnl_string_tokens = len(tokenizer.encode(addtnl_string))
     max_input_tokens -= addtnl_string_tokens
 
-    for sentence in sentences:
-        sentence_tokens = len(tokenizer.encode(sentence))
-        if current_tokens + sentence_tokens <= max_input_tokens:
-            current_chunk += " " + sentence
-            current_tokens += sentence_tokens
-        else:
-            chunks.append(f"""{current_chunk.strip()}""")
-            current_chunk = sentence
-            current_tokens = sentence_tokens
+    sentences = nltk.sent_tokenize(text)
+    if not sentences:
+        # empty or whitespace only text
+        return []
+
+    token_ids, offsets = encode_sentences(sentences, tokenizer=tokenizer)
+
+    # the first sentence of a chunk has no space in front of it, only these
+    # sentences are encoded again
+    first_token_ids = {0: token_ids[offsets[0] : offsets[1]].tolist()}
+
+    def first_token_count(idx: int) -> int:
+        if idx not in first_token_ids:
+            first_token_ids[idx] = tokenizer.encode(
+                sentences[idx], add_special_tokens=False
+            )
+        return len(first_token_ids[idx])
 
-    if current_chunk:
-        chunks.append(f"""{current_chunk.strip()}""")
+    boundaries = pack_sentences_into_chunks(
+        np.diff(offsets).tolist(), max_input_tokens, first_token_count
+    )
+
+    chunks = []
+    # without a tokenizer every boundary is joined to exactly one chunk
+    for chunk, (start, end) in zip(
+        join_sentence_chunks(sentences, boundaries), boundaries, strict=True
+    ):
+        chunk_token_ids = (
+            first_token_ids[start] + token_ids[offsets[start + 1] : offsets[end]].tolist()
+        )
+
+        # only a single sentence can exceed the budget, it is split at token boundaries
+        if len(chunk_token_ids) > max_input_tokens:
+            chunks.extend(split_token_ids(chunk_token_ids, max_input_tokens, tokenizer))
+        else:
+            chunks.append((chunk, chunk_token_ids))
 
     return chunks
 
 
+def split_text_into_chunks(text, max_input_tokens, tokenizer=None):
+    return [
+        chunk
+        for chunk, _ in split_text_into_token_chunks(
+            text, max_input_tokens, tokenizer=tokenizer
+        )
+    ]
+
+
+def pack_token_groups(
+    token_counts: list[int], max_tokens: int, max_items: int | None = None
+) -> list[list[int]]:
+    """
+    Group consecutive items so every group stays within a token budget.
+
+    Args:
+        token_counts (list[int]): The token count of every item, in order.
+        max_tokens (int): The maximum sum of token counts per group.
+        max_items (int | None): The maximum number of items per group (fan-in).
+
+    Returns:
+        list[list[int]]: The item indices of every group, items that exceed max_tokens
+        on their own are returned as single item groups.
+    """
+    groups = []
+    group = []
+    group_tokens = 0
+
+    for idx, tokens in enumerate(token_counts):
+        is_full = max_items is not None and len(group) >= max_items
+        if group and (is_full or group_tokens + tokens > max_tokens):
+            groups.append(group)
+            group, group_tokens = [], 0
+
+        group.append(idx)
+        group_tokens += tokens
+
+    if group:
+        groups.append(group)
+
+    return groups
+
+
+def plan_merge_tree(
+    token_counts: list[int], max_input_tokens: int, output_tokens: int
+) -> list[list[list[int]]]:
+    """
+    Plan the whole reduction of the answers up front.
+
+    Every level groups the nodes of the previous level in order, so each group fits
+    into one prompt. Merged nodes are estimated with output_tokens (the generation
+    budget), single nodes which are already small enough are passed through as they are.
+    The last level always has a single group, the root.
+
+    Args:
+        token_counts (list[int]): The token counts of the leaves (the answers).
+        max_input_tokens (int): The maximum input tokens of one prompt.
+        output_tokens (int): The upper bound of tokens of one generated node.
+
+    Returns:
+        list[list[list[int]]]: Per level the groups, as indices into the previous level.
+    """
+    levels = []
+    sizes = list(token_counts)
+
+    while sum(sizes) > max_input_tokens:
+        groups = pack_token_groups(sizes, max_input_tokens)
+        new_sizes = [
+            sizes[group[0]]
+            if len(group) == 1 and sizes[group[0]] <= output_tokens
+            else output_tokens
+            for group in groups
+        ]
+
+        if new_sizes == sizes:
+            raise Exception("The answers can not be merged within the context window.")
+
+        levels.append(groups)
+        sizes = new_sizes
+
+    levels.append([list(range(len(sizes)))])
+    return levels
+
+
 def remove_html_xml_tags(input_string: str) -> str:
     if not isinstance(input_string, str):
         print('Got Non String passed to remove_html_xml_tags, rtrn ""')
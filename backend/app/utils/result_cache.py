@@ -0,0 +1,246 @@
+# Cache of complete summarize and questionary results.
+#
+# The same payloads are posted again and again (retries, several clients on one
+# document). Results are keyed by a hash of the normalized input, the model and
+# the settings which change the generations. Every api worker keeps the recent
+# results in memory, with RESULT_CACHE_PATH set they are also kept in a sqlite
+# database which all workers share.
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from app.core.config import settings
+from app.services.budget import context_tokens
+
+# bump when the prompts change, so results of the old prompts are not served anymore
+RESULT_CACHE_VERSION = 1
+
+
+def normalize_text(text: str) -> str:
+    # line endings and runs of whitespace dont change the meaning of a text
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def normalize_value(value):
+    # strings are normalized wherever they are, e.g. the questions of a batch or
+    # the messages of a prompt. The order of lists is kept, the answers follow it
+    if isinstance(value, str):
+        return normalize_text(value)
+    if isinstance(value, list | tuple):
+        return [normalize_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: normalize_value(item) for key, item in value.items()}
+    return value
+
+
+def generation_settings() -> dict:
+    """
+    The settings which change the result of a request.
+    """
+    return {
+        "version": RESULT_CACHE_VERSION,
+        "model": settings.LLM_MODEL_ID,
+        "dtype": settings.LLM_TORCH_DTYPE,
+        "constrained_json": settings.LLM_CONSTRAINED_JSON,
+        # the chunks of the texts depend on it
+        "context_tokens": context_tokens(),
+        "compress": settings.SUMMARIZE_COMPRESS,
+        "compress_ratio": settings.SUMMARIZE_COMPRESS_RATIO,
+        "reduce_fan_in": settings.SUMMARIZE_REDUCE_FAN_IN,
+        "reduce_max_depth": settings.SUMMARIZE_REDUCE_MAX_DEPTH,
+        "top_k": settings.QUESTIONARY_TOP_K,
+        "document_first": settings.QUESTIONARY_DOCUMENT_FIRST,
+    }
+
+
+def result_key(namespace: str, payload: dict) -> str:
+    """
+    Content hash of one request.
+
+    Args:
+        namespace (str): The service, e.g. "summarize".
+        payload (dict): The inputs of the request, strings are normalized, also
+            within lists and dicts.
+
+    Returns:
+        str: The key of the result.
+    """
+    normalized = normalize_value(payload)
+    content = json.dumps(
+        {
+            "namespace": namespace,
+            "settings": generation_settings(),
+            "payload": normalized,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def use_result_cache(options: dict | None) -> bool:
+    return (
+        settings.RESULT_CACHE_ENABLED
+        and (options or {}).get("cache", True) is not False
+    )
+
+
+class ResultCache:
+    """
+    In memory LRU of results with an optional sqlite tier, both with a ttl.
+
+    Args:
+        max_entries (int): The number of results kept in memory.
+        ttl (int): Seconds a result is served from the cache.
+        path (str): The directory of the sqlite database, empty for memory only.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = settings.RESULT_CACHE_MAX_ENTRIES,
+        ttl: int = settings.RESULT_CACHE_TTL,
+        path: str = settings.RESULT_CACHE_PATH,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.__entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__initiated = False
+        self.__counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+
+    @contextmanager
+    def __connect(self):
+        conn = sqlite3.connect(os.path.join(self.path, "results.sqlite3"), timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def __initiate(self) -> bool:
+        if not self.path:
+            return False
+
+        if self.__initiated:
+            return True
+
+        with self.__lock:
+            if not self.__initiated:
+                os.makedirs(self.path, exist_ok=True)
+                with self.__connect() as conn:
+                    conn.execute(
+                        """
+                        CREATE TABLE IF NOT EXISTS results (
+                            result_key TEXT PRIMARY KEY,
+                            result TEXT NOT NULL,
+                            expires_at REAL NOT NULL
+                        )
+                        """
+                    )
+                self.__initiated = True
+
+        return True
+
+    def __count(self, counter: str):
+        with self.__lock:
+            self.__counters[counter] += 1
+
+    def __remember(self, key: str, expires_at: float, value: str):
+        with self.__lock:
+            self.__entries[key] = (expires_at, value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+    def get(self, key: str):
+        """
+        The cached result of the key, None if there is none or it expired.
+        """
+        now = time.time()
+
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self.__entries[key]
+                entry = None
+            if entry is not None:
+                self.__entries.move_to_end(key)
+
+        if entry is not None:
+            self.__count("memory_hits")
+            # stored serialized, callers can modify the result they get back
+            return json.loads(entry[1])
+
+        if self.__initiate():
+            try:
+                with self.__connect() as conn:
+                    row = conn.execute(
+                        "SELECT result, expires_at FROM results WHERE result_key = ? AND expires_at > ?",
+                        (key, now),
+                    ).fetchone()
+            except sqlite3.Error as e:
+                print(f"Failed to read the result cache: {e}")
+                row = None
+
+            if row:
+                self.__count("disk_hits")
+                self.__remember(key, row[1], row[0])
+                return json.loads(row[0])
+
+        self.__count("misses")
+        return None
+
+    def put(self, key: str, value):
+        serialized = json.dumps(value, ensure_ascii=False)
+        expires_at = time.time() + self.ttl
+
+        self.__remember(key, expires_at, serialized)
+        self.__count("stores")
+
+        if not self.__initiate():
+            return
+
+        try:
+            with self.__connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO results (result_key, result, expires_at) VALUES (?, ?, ?)",
+                    (key, serialized, expires_at),
+                )
+                conn.execute(
+                    "DELETE FROM results WHERE expires_at <= ?", (time.time(),)
+                )
+        except sqlite3.Error as e:
+            print(f"Failed to write the result cache: {e}")
+
+    def stats(self) -> dict:
+        with self.__lock:
+            counters = dict(self.__counters)
+            entries = len(self.__entries)
+
+        hits = counters["memory_hits"] + counters["disk_hits"]
+        lookups = hits + counters["misses"]
+
+        return {
+            **counters,
+            "hits": hits,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "memory_entries": entries,
+            "disk_enabled": bool(self.path),
+        }
+
+
+result_cache = ResultCache()
+# intermediate summaries of the summarize pipeline, see summarize.generate_summaries
+section_cache = ResultCache(max_entries=settings.SUMMARIZE_SECTION_CACHE_MAX_ENTRIES)
+
+__all__ = ["result_cache", "section_cache", "result_key", "use_result_cache"]
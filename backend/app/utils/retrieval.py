@@ -0,0 +1,167 @@
+import re
+
+import numpy as np
+
+word_pattern = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize_words(text: str) -> list[str]:
+    """
+    Lowercased word tokens for the lexical retrieval, no stemming or stopwords.
+    """
+    return word_pattern.findall(text.lower())
+
+
+class BM25Index:
+    """
+    Okapi BM25 index over the chunks of one text.
+
+    The term frequencies are kept as sparse postings per term (csr layout:
+    term_offsets, chunk_ids, frequencies), so a query only touches the postings
+    of its own terms and the arrays can be stored and memory mapped as they are.
+
+    Args:
+        chunks (list[str]): The text chunks to index.
+        k1 (float): Term frequency saturation.
+        b (float): Length normalisation.
+    """
+
+    def __init__(self, chunks: list[str], k1: float = 1.5, b: float = 0.75):
+        vocabulary: dict[str, int] = {}
+        term_ids = []
+        chunk_ids = []
+
+        for chunk_id, chunk in enumerate(chunks):
+            words = tokenize_words(chunk)
+            term_ids.extend(
+                vocabulary.setdefault(word, len(vocabulary)) for word in words
+            )
+            chunk_ids.extend([chunk_id] * len(words))
+
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+
+        # unique (term, chunk) pairs sorted by term, their counts are the frequencies
+        pairs, frequencies = np.unique(
+            term_ids * max(len(chunks), 1) + chunk_ids, return_counts=True
+        )
+        pair_terms = pairs // max(len(chunks), 1)
+
+        term_offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(pair_terms, minlength=len(vocabulary)), out=term_offsets[1:]
+        )
+
+        chunk_lengths = np.bincount(chunk_ids, minlength=len(chunks))
+
+        self.__setup(
+            vocabulary=vocabulary,
+            term_offsets=term_offsets,
+            chunk_ids=(pairs % max(len(chunks), 1)).astype(np.int32),
+            frequencies=frequencies.astype(np.float32),
+            chunk_lengths=chunk_lengths.astype(np.float32),
+            k1=k1,
+            b=b,
+        )
+
+    @classmethod
+    def from_arrays(
+        cls,
+        vocabulary: dict[str, int],
+        arrays: dict[str, np.ndarray],
+        k1: float = 1.5,
+        b: float = 0.75,
+    ) -> "BM25Index":
+        """
+        Restore an index from its vocabulary and the arrays returned by to_arrays,
+        the arrays can be memory mapped.
+        """
+        index = cls.__new__(cls)
+        index.__setup(vocabulary=vocabulary, k1=k1, b=b, **arrays)
+        return index
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        return {
+            "term_offsets": self.term_offsets,
+            "chunk_ids": self.chunk_ids,
+            "frequencies": self.frequencies,
+            "chunk_lengths": self.chunk_lengths,
+        }
+
+    def __setup(
+        self,
+        vocabulary: dict[str, int],
+        term_offsets: np.ndarray,
+        chunk_ids: np.ndarray,
+        frequencies: np.ndarray,
+        chunk_lengths: np.ndarray,
+        k1: float,
+        b: float,
+    ):
+        self.k1 = k1
+        self.b = b
+        self.vocabulary = vocabulary
+        self.term_offsets = term_offsets
+        self.chunk_ids = chunk_ids
+        self.frequencies = frequencies
+        self.chunk_lengths = chunk_lengths
+
+        chunk_count = len(chunk_lengths)
+        average_length = float(chunk_lengths.mean()) if chunk_count else 0.0
+
+        document_frequencies = np.diff(term_offsets)
+        self.idf = np.log(
+            1
+            + (chunk_count - document_frequencies + 0.5) / (document_frequencies + 0.5)
+        ).astype(np.float32)
+
+        # per chunk part of the bm25 denominator, independent of the query
+        self.length_norm = (
+            k1 * (1 - b + b * chunk_lengths / max(average_length, 1.0))
+        ).astype(np.float32)
+
+    def score(self, query: str) -> np.ndarray:
+        """
+        Score every chunk against the query.
+
+        Returns:
+            np.ndarray: One bm25 score per chunk, in chunk order.
+        """
+        scores = np.zeros(len(self.chunk_lengths), dtype=np.float32)
+
+        for word in set(tokenize_words(query)):
+            term_id = self.vocabulary.get(word)
+            if term_id is None:
+                continue
+
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            chunk_ids = self.chunk_ids[start:end]
+            tf = self.frequencies[start:end]
+
+            scores[chunk_ids] += (
+                self.idf[term_id]
+                * tf
+                * (self.k1 + 1)
+                / (tf + self.length_norm[chunk_ids])
+            )
+
+        return scores
+
+    def top_k(self, query: str, k: int) -> list[tuple[int, float]]:
+        """
+        The k best matching chunks for the query.
+
+        Returns:
+            list[tuple[int, float]]: (chunk index, score) pairs, in chunk order.
+        """
+        scores = self.score(query)
+        k = min(k, len(scores))
+
+        if k <= 0:
+            return []
+
+        best = np.argsort(-scores, kind="stable")[:k]
+        return [(int(idx), float(scores[idx])) for idx in sorted(best)]
+
+
+__all__ = ["BM25Index"]
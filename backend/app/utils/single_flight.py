@@ -0,0 +1,69 @@
+# Coalescing of identical requests which are in flight at the same time.
+#
+# Retries and fan-out from upstream services post the same document several
+# times at once. The first request with a key runs the pipeline, every further
+# request with that key waits for it and gets a copy of its result. Across the
+# api workers the identical generations are coalesced by the batcher of the
+# inference engine.
+
+import copy
+import threading
+from collections.abc import Callable
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    Runs one call per key at a time, concurrent callers of the key share its result.
+    """
+
+    def __init__(self):
+        self.__calls: dict[str, Future] = {}
+        self.__lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key: str, fn: Callable):
+        """
+        Run fn, or wait for the call of the key which is already running.
+
+        Args:
+            key (str): The content hash of the call.
+            fn (Callable): The call, without arguments.
+
+        Returns:
+            The result of fn, exceptions of fn are raised for every caller.
+        """
+        with self.__lock:
+            future = self.__calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.__calls[key] = future
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            print(f"Waiting for the identical request {key[:12]} in flight...")
+            # every caller gets its own copy, the results are modified before returning
+            return copy.deepcopy(future.result())
+
+        try:
+            result = fn()
+            future.set_result(copy.deepcopy(result))
+            return result
+        except BaseException as e:
+            # the waiting callers get the error as well, none of them is left hanging
+            future.set_exception(e)
+            raise
+        finally:
+            with self.__lock:
+                self.__calls.pop(key, None)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {"in_flight": len(self.__calls), "coalesced": self.coalesced}
+
+
+flights = SingleFlight()
+
+__all__ = ["flights", "SingleFlight"]
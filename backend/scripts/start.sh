@@ -0,0 +1,28 @@
+#!/usr/bin/env bash
+
+set -e
+set -x
+
+# The inference engine owns the model, the api workers only send generations to it
+# through a unix socket (see app/services/engine.py). Only set here, so commands
+# which run the api on their own (e.g. the dev override) keep the model in process
+export LLM_ENGINE_MODE=${LLM_ENGINE_MODE:-remote}
+
+if [ "${LLM_ENGINE_MODE}" != "remote" ]; then
+    exec fastapi run --workers ${API_WORKERS:-4} app/main.py
+fi
+
+# the socket messages are pickled, so the engine only accepts connections with a
+# shared secret, generated here unless given (not traced, it would end up in the logs)
+set +x
+export LLM_ENGINE_AUTHKEY=${LLM_ENGINE_AUTHKEY:-$(python -c 'import secrets; print(secrets.token_hex(32))')}
+set -x
+
+python -m app.services.engine &
+fastapi run --workers ${API_WORKERS:-4} app/main.py &
+
+# the container exits (and is restarted) with whichever process dies first
+trap 'kill $(jobs -p) 2>/dev/null' EXIT
+set +e
+wait -n
+exit $?
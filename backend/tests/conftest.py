@@ -0,0 +1,93 @@
+import os
+import re
+import sys
+import types
+
+import pytest
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+# the settings need the cors origins, the engine a shared secret
+os.environ.setdefault("BACKEND_CORS_ORIGINS", "http://localhost")
+os.environ.setdefault("LLM_ENGINE_AUTHKEY", "test-authkey")
+os.environ.setdefault("LLM_ENGINE_CONNECT_TIMEOUT", "10")
+
+# app.services.llms loads the tokenizer (and the weights) when it is imported, the
+# tests replace it with a module without a model, single tests patch what they use
+llms = types.ModuleType("app.services.llms")
+llms.llama = types.SimpleNamespace(
+    get_pipe=lambda: None,
+    get_chat_tokenizer=lambda: None,
+    get_config=lambda: None,
+)
+llms.utils = None
+sys.modules["app.services.llms"] = llms
+
+CORPUS = [
+    "The quick brown fox jumps over the lazy dog.",
+    "A tokenizer splits a text into tokens. Sentences are packed into chunks!",
+    'Every prompt asks for one object: {"Title":"","Summary":""}',
+]
+
+
+@pytest.fixture(scope="session")
+def tokenizer() -> PreTrainedTokenizerFast:
+    """
+    A small byte level BPE tokenizer, trained in memory so no model is downloaded.
+    """
+    backend = Tokenizer(models.BPE(unk_token="[UNK]"))
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=400,
+        special_tokens=["<s>", "</s>", "<pad>", "[UNK]"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    backend.train_from_iterator(CORPUS * 20, trainer)
+
+    return PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        bos_token="<s>",
+        eos_token="</s>",
+        pad_token="<pad>",
+        unk_token="[UNK]",
+    )
+
+
+@pytest.fixture(scope="session")
+def model(tokenizer) -> LlamaForCausalLM:
+    """
+    A randomly initialized llama with two tiny layers and greedy decoding.
+    """
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=512,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    model = LlamaForCausalLM(config).eval()
+    model.generation_config.do_sample = False
+
+    return model
+
+
+@pytest.fixture
+def sentence_split(monkeypatch):
+    """
+    Split sentences at end marks instead of with the punkt model of nltk.
+    """
+    from app.utils import general
+
+    monkeypatch.setattr(
+        general.nltk,
+        "sent_tokenize",
+        lambda text: [s for s in re.split(r"(?<=[.!?])\s+", text) if s.strip()],
+    )
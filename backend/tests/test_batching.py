@@ -0,0 +1,179 @@
+import json
+import threading
+
+import pytest
+import torch
+
+from app.core.config import settings
+from app.services.batching import DynamicBatcher
+from app.services.json_stream import empty_json_object
+
+PROMPTS = [
+    "The quick brown fox jumps over the lazy dog.",
+    "A tokenizer splits a text",
+    "Sentences are packed into chunks!",
+]
+
+
+def reference(model, input_ids: list[int], max_new_tokens: int, eos_token_id: int):
+    """
+    The tokens of a plain generate call of a single prompt, without the eos token.
+    """
+    output = model.generate(
+        input_ids=torch.tensor([input_ids]),
+        max_new_tokens=max_new_tokens,
+        pad_token_id=eos_token_id,
+        eos_token_id=[eos_token_id],
+    )
+    generated = output[0, len(input_ids) :].tolist()
+
+    return (
+        generated[: generated.index(eos_token_id)]
+        if eos_token_id in generated
+        else generated
+    )
+
+
+@pytest.fixture
+def batcher(model, tokenizer):
+    # the requests submitted right after each other end up in one batch
+    return DynamicBatcher(
+        model, tokenizer.pad_token_id, max_batch_size=8, max_wait_ms=200
+    )
+
+
+def test_rows_stop_on_their_own(model, tokenizer, batcher):
+    eos = tokenizer.eos_token_id
+    prompts = [tokenizer.encode(prompt) for prompt in PROMPTS]
+    long_output = reference(model, prompts[2], 12, eos)
+    assert len(long_output) == 12
+
+    # one row stops at its budget and one at a stop string, the last row runs on
+    short = batcher.submit(prompts[0], 2, [eos])
+    stopped = batcher.submit(
+        prompts[1],
+        12,
+        [eos],
+        stop_strings=[tokenizer.decode(reference(model, prompts[1], 1, eos))],
+        decode=tokenizer.decode,
+    )
+    long = batcher.submit(prompts[2], 12, [eos])
+
+    assert short.result() == reference(model, prompts[0], 2, eos)
+    assert len(stopped.result()) == 1
+    assert long.result() == long_output
+
+
+def test_rows_stop_at_their_own_eos_tokens(model, tokenizer, batcher):
+    eos = tokenizer.eos_token_id
+    prompts = [tokenizer.encode(prompt) for prompt in PROMPTS[:2]]
+    outputs = [reference(model, input_ids, 8, eos) for input_ids in prompts]
+
+    # the first token of the second row is an eos token of the first row only
+    first = batcher.submit(prompts[0], 8, [eos, outputs[1][0]])
+    second = batcher.submit(prompts[1], 8, [eos])
+
+    assert outputs[1][0] not in first.result()
+    assert second.result() == outputs[1]
+
+
+def test_identical_requests_share_one_future(tokenizer, batcher):
+    input_ids = tokenizer.encode(PROMPTS[0])
+    eos = [tokenizer.eos_token_id]
+
+    first = batcher.submit(input_ids, 4, eos)
+    second = batcher.submit(input_ids, 4, eos)
+    other = batcher.submit(input_ids, 5, eos)
+    streamed = batcher.submit(input_ids, 4, eos, on_tokens=lambda tokens: None)
+
+    assert second is first
+    assert other is not first and streamed is not first
+    assert batcher.coalesced == 1
+    assert streamed.result() == first.result() == other.result()[:4]
+
+    # finished requests are not shared any more
+    again = batcher.submit(input_ids, 4, eos)
+    assert again is not first
+    assert again.result() == first.result()
+
+
+def test_concurrent_identical_requests(tokenizer, batcher):
+    input_ids = tokenizer.encode(PROMPTS[1])
+    futures = []
+
+    def submit():
+        futures.append(batcher.submit(input_ids, 6, [tokenizer.eos_token_id]))
+
+    threads = [threading.Thread(target=submit) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len({id(future) for future in futures}) == 1
+    assert batcher.coalesced == 3
+    assert len(futures[0].result()) <= 6
+
+
+def test_mixed_cached_prefixes_match_plain_generate(
+    model, tokenizer, batcher, monkeypatch
+):
+    monkeypatch.setattr(settings, "LLM_PREFIX_CACHE_MIN_TOKENS", 4)
+    eos = tokenizer.eos_token_id
+    instructions = [
+        "A tokenizer splits a text into tokens. Sentences are packed into chunks!",
+        "The quick brown fox jumps over the lazy dog.",
+    ]
+    # rows with a long, a short and no cached prefix, left padded to one batch
+    cases = [
+        (instructions[0], " The quick brown fox", 6),
+        (instructions[0], " Every prompt asks for one object:", 10),
+        (instructions[1], " A", 4),
+        (None, "Sentences are packed into chunks!", 8),
+        (None, "The", 5),
+    ]
+
+    requests = []
+    for prefix, suffix, max_new_tokens in cases:
+        input_ids = tokenizer.encode((prefix or "") + suffix)
+        prefix_length = len(tokenizer.encode(prefix)) if prefix else 0
+        assert input_ids[:prefix_length] == tokenizer.encode(prefix or "")
+        requests.append((input_ids, prefix_length, max_new_tokens))
+
+    expected = [reference(model, input_ids, n, eos) for input_ids, _, n in requests]
+
+    # the first round fills the prefix cache, the second one reuses it
+    for _ in range(2):
+        futures = [
+            batcher.submit(input_ids, n, [eos], prefix_length=prefix_length)
+            for input_ids, prefix_length, n in requests
+        ]
+        assert [future.result() for future in futures] == expected
+
+    stats = batcher.prefix_caches["instruction"].stats()
+    assert stats["entries"] == 2
+    assert stats["hits"] >= 2
+
+
+@pytest.mark.parametrize("slack", [1, 40])
+def test_constrained_rows_follow_the_schema(model, tokenizer, batcher, slack):
+    keys = ["Title", "Summary"]
+    # the floor of the budgets, a token for every character of the empty object
+    max_new_tokens = len(empty_json_object(keys)) + slack
+    eos = tokenizer.eos_token_id
+
+    constrained = batcher.submit(
+        tokenizer.encode(PROMPTS[0]),
+        max_new_tokens,
+        [eos],
+        stop_at_json_end=True,
+        json_keys=keys,
+        decode=tokenizer.decode,
+    )
+    free = batcher.submit(tokenizer.encode(PROMPTS[1]), 8, [eos])
+
+    output = tokenizer.decode(constrained.result())
+    assert list(json.loads(output)) == keys
+    assert len(constrained.result()) <= max_new_tokens
+    # the unconstrained row of the same batch is not masked
+    assert free.result() == reference(model, tokenizer.encode(PROMPTS[1]), 8, eos)
@@ -0,0 +1,101 @@
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import budget, kv_cache
+from app.services.json_stream import empty_json_object
+from app.utils import result_cache
+
+SECTION_KEYS = ["Title", "Summary"]
+ANSWER_KEYS = ["Answer", "Explanation", "Text Excerpt"]
+
+
+@pytest.fixture
+def context(monkeypatch):
+    monkeypatch.setattr(budget, "context_tokens", lambda: 4096)
+    monkeypatch.setattr(budget, "prompt_overhead_tokens", lambda: 30)
+
+
+@pytest.mark.usefixtures("context")
+@pytest.mark.parametrize("keys", [SECTION_KEYS, ANSWER_KEYS])
+@pytest.mark.parametrize("options", [None, {"max_new_tokens": 1}])
+def test_plan_stage_fits_the_empty_schema(keys, options):
+    floor = len(empty_json_object(keys)) + 1
+    stage = budget.plan_stage("questionary_chunk", 100, options, json_keys=keys)
+
+    assert stage.min_new_tokens == floor
+    assert stage.max_new_tokens >= floor
+    # a short input never scales below the floor either
+    assert budget.scale_max_new_tokens(stage, 0) >= floor
+
+
+@pytest.mark.usefixtures("context")
+def test_plan_stage_counts_the_template_only_for_chat_prompts():
+    chat = budget.plan_stage("summarize_section", 100)
+    raw = budget.plan_stage("questionary_chunk", 100)
+
+    assert chat.context_tokens == raw.context_tokens == 4096
+    assert chat.max_input_tokens == 4096 - 30 - 100 - 300
+    assert raw.max_input_tokens == 4096 - 100 - 600
+
+
+@pytest.mark.usefixtures("context")
+def test_scale_max_new_tokens():
+    stage = budget.plan_stage("questionary_chunk", 100)
+
+    # (96, 0.5) of the stage, capped by its budget
+    assert budget.scale_max_new_tokens(stage, 0) == 96
+    assert budget.scale_max_new_tokens(stage, 200) == 196
+    assert budget.scale_max_new_tokens(stage, 10000) == stage.max_new_tokens == 600
+
+    fixed = budget.plan_stage("questionary_chunk", 100, {"max_new_tokens": 50})
+    assert not fixed.scaled
+    assert budget.scale_max_new_tokens(fixed, 10000) == 50
+
+
+def test_record_outputs_keeps_the_generated_counts(monkeypatch):
+    stats = budget.GenerationStats()
+    monkeypatch.setattr(budget, "generation_stats", stats)
+
+    budget.record_outputs(
+        "questionary_chunk", [100, 200, 300], [100, 100, 100], [95, None, 40]
+    )
+    budget.record_outputs("questionary_chunk", [100], [100], [None])
+
+    # the failed generations are skipped
+    assert stats.stats()["questionary_chunk"] == {
+        "calls": 2,
+        "input_tokens": 400,
+        "budgeted_tokens": 200,
+        "generated_tokens": 135,
+        "near_budget": 1,
+        "utilization": 0.675,
+    }
+
+
+@pytest.mark.parametrize(
+    "positions, max_context, memory, expected",
+    [
+        # the memory cap is rounded down to a power of two
+        (131072, 0, 20000, 16384),
+        (131072, 0, 16383, 8192),
+        (131072, 6000, 20000, 6000),
+        (4096, 0, 20000, 4096),
+        # a small device still gets the default context
+        (131072, 0, 100, kv_cache.DEFAULT_CONTEXT_TOKENS),
+        # the config does not describe the attention layers
+        (None, 0, 0, kv_cache.DEFAULT_CONTEXT_TOKENS),
+    ],
+)
+def test_model_context_tokens(monkeypatch, positions, max_context, memory, expected):
+    monkeypatch.setattr(kv_cache.settings, "LLM_MAX_CONTEXT_TOKENS", max_context)
+    monkeypatch.setattr(kv_cache, "memory_context_tokens", lambda config: memory)
+    config = SimpleNamespace(max_position_embeddings=positions)
+
+    assert kv_cache.model_context_tokens(config) == expected
+
+
+def test_generation_settings_include_the_context(monkeypatch):
+    monkeypatch.setattr(result_cache, "context_tokens", lambda: 4096)
+
+    assert result_cache.generation_settings()["context_tokens"] == 4096
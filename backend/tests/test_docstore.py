@@ -0,0 +1,118 @@
+import itertools
+import os
+
+import numpy as np
+import pytest
+
+from app.utils import docstore as docstore_module
+from app.utils.docstore import DocumentStore, document_hash
+
+TEXTS = [
+    "The quick brown fox jumps over the lazy dog. A tokenizer splits a text.",
+    "Sentences are packed into chunks! The lazy dog sleeps.",
+    "Every prompt asks for one object. The quick brown fox.",
+]
+
+pytestmark = pytest.mark.usefixtures("sentence_split")
+
+
+@pytest.fixture
+def splits(monkeypatch):
+    """
+    The texts which were split (and counted) instead of loaded from the store.
+    """
+    split = docstore_module.split_text_into_sentences
+    calls = []
+
+    def counting_split(text, tokenizer=None):
+        calls.append(text)
+        return split(text, tokenizer=tokenizer)
+
+    monkeypatch.setattr(docstore_module, "split_text_into_sentences", counting_split)
+    # every write and use of a document is a later point in time
+    clock = itertools.count(1)
+    monkeypatch.setattr(docstore_module.time, "time", lambda: float(next(clock)))
+
+    return calls
+
+
+def test_documents_are_preprocessed_once(tmp_path, tokenizer, splits):
+    store = DocumentStore(str(tmp_path))
+
+    sentences, token_counts = store.get_sentences(TEXTS[0], tokenizer=tokenizer)
+    again, again_counts = store.get_sentences(TEXTS[0], tokenizer=tokenizer)
+
+    assert (
+        sentences
+        == again
+        == [
+            "The quick brown fox jumps over the lazy dog.",
+            "A tokenizer splits a text.",
+        ]
+    )
+    np.testing.assert_array_equal(token_counts, again_counts)
+    assert splits == [TEXTS[0]]
+
+    # a new store on the same directory (e.g. another worker) loads it as well
+    DocumentStore(str(tmp_path)).get_sentences(TEXTS[0], tokenizer=tokenizer)
+    assert splits == [TEXTS[0]]
+
+
+def test_chunks_and_index_are_stored_per_budget(tmp_path, tokenizer, splits):
+    store = DocumentStore(str(tmp_path))
+
+    chunks, index = store.get_chunks_and_index(TEXTS[0], 12, tokenizer=tokenizer)
+    loaded, loaded_index = store.get_chunks_and_index(TEXTS[0], 12, tokenizer=tokenizer)
+    whole, _ = store.get_chunks_and_index(TEXTS[0], 1000, tokenizer=tokenizer)
+
+    assert loaded == chunks and len(chunks) == 2
+    assert whole == [TEXTS[0]]
+    np.testing.assert_allclose(loaded_index.score("fox"), index.score("fox"))
+    assert splits == [TEXTS[0]]
+
+
+def test_new_version_preprocesses_again(tmp_path, tokenizer, splits, monkeypatch):
+    store = DocumentStore(str(tmp_path))
+    old_hash = document_hash(TEXTS[0])
+    store.get_sentences(TEXTS[0], tokenizer=tokenizer)
+
+    monkeypatch.setattr(
+        docstore_module, "DOCUMENT_VERSION", docstore_module.DOCUMENT_VERSION + 1
+    )
+    assert document_hash(TEXTS[0]) != old_hash
+    store.get_sentences(TEXTS[0], tokenizer=tokenizer)
+
+    monkeypatch.setattr(docstore_module.settings, "LLM_MODEL_ID", "another/model")
+    store.get_sentences(TEXTS[0], tokenizer=tokenizer)
+
+    assert splits == [TEXTS[0]] * 3
+
+
+def test_least_recently_used_documents_are_evicted(tmp_path, tokenizer, splits):
+    store = DocumentStore(str(tmp_path), max_documents=2)
+
+    store.get_sentences(TEXTS[0], tokenizer=tokenizer)
+    store.get_sentences(TEXTS[1], tokenizer=tokenizer)
+    # the first document is used again, the second is the least recently used one
+    store.get_sentences(TEXTS[0], tokenizer=tokenizer)
+    store.get_sentences(TEXTS[2], tokenizer=tokenizer)
+
+    evicted = document_hash(TEXTS[1])
+    assert not os.path.exists(tmp_path / evicted[:2] / evicted)
+
+    store.get_sentences(TEXTS[0], tokenizer=tokenizer)
+    store.get_sentences(TEXTS[1], tokenizer=tokenizer)
+
+    assert splits == [TEXTS[0], TEXTS[1], TEXTS[2], TEXTS[1]]
+
+
+def test_incomplete_documents_are_preprocessed_again(tmp_path, tokenizer, splits):
+    store = DocumentStore(str(tmp_path))
+    store.get_sentences(TEXTS[0], tokenizer=tokenizer)
+
+    doc_hash = document_hash(TEXTS[0])
+    os.remove(tmp_path / doc_hash[:2] / doc_hash / "token_counts.npy")
+    sentences, _ = store.get_sentences(TEXTS[0], tokenizer=tokenizer)
+
+    assert len(sentences) == 2
+    assert splits == [TEXTS[0], TEXTS[0]]
@@ -0,0 +1,83 @@
+import os
+import stat
+import threading
+from multiprocessing.connection import AuthenticationError, Client
+
+import pytest
+
+from app.services import engine as engine_module
+from app.services.engine import InferenceClient, InferenceServer, engine_authkey
+
+
+class FakeEngine:
+    def context_tokens(self):
+        return 4096
+
+    def generate_from_prompt(self, complete_prompt, **kwargs):
+        return complete_prompt.upper()
+
+    def generate_many_from_prompt(self, complete_prompts, **kwargs):
+        raise ValueError("no model")
+
+    def stream_many_from_prompt(self, complete_prompts, **kwargs):
+        for idx, prompt in enumerate(complete_prompts):
+            yield {"index": idx, "output": prompt}
+
+
+@pytest.fixture
+def address(tmp_path):
+    address = str(tmp_path / "engine.sock")
+    server = InferenceServer(address)
+    server.engine = FakeEngine()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return address
+
+
+def test_call_and_stream(address):
+    client = InferenceClient(address)
+
+    assert client.generate_from_prompt("a prompt") == "A PROMPT"
+    assert list(client.stream_many_from_prompt(["a", "b"])) == [
+        {"index": 0, "output": "a"},
+        {"index": 1, "output": "b"},
+    ]
+    # the connection is kept per thread
+    assert client.generate_from_prompt("again") == "AGAIN"
+    assert client.context_tokens() == 4096
+
+
+def test_errors_are_raised_on_the_client(address):
+    client = InferenceClient(address)
+
+    with pytest.raises(Exception, match="no model"):
+        client.generate_many_from_prompt(["a"])
+    with pytest.raises(Exception, match="Unknown operation"):
+        client._InferenceClient__call("get_model")
+    # the connection is still usable after an error
+    assert client.generate_from_prompt("ok") == "OK"
+
+
+def test_reconnect_after_a_lost_connection(address):
+    client = InferenceClient(address)
+    assert client.generate_from_prompt("first") == "FIRST"
+
+    # e.g. the engine restarted, the next call opens a new connection once
+    client._InferenceClient__local.conn.close()
+
+    assert client.generate_from_prompt("second") == "SECOND"
+
+
+def test_socket_is_private_and_authenticated(address):
+    InferenceClient(address).generate_from_prompt("wait for the socket")
+
+    assert stat.S_IMODE(os.stat(address).st_mode) == 0o600
+    with pytest.raises(AuthenticationError):
+        Client(address, family="AF_UNIX", authkey=b"wrong")
+
+
+def test_authkey_is_required(monkeypatch):
+    monkeypatch.setattr(engine_module.settings, "LLM_ENGINE_AUTHKEY", "")
+
+    with pytest.raises(Exception, match="LLM_ENGINE_AUTHKEY"):
+        engine_authkey()
@@ -0,0 +1,42 @@
+import numpy as np
+
+from app.utils.extractive import select_sentences, textrank_scores
+
+SENTENCES = [
+    "The fox runs through the forest.",
+    "The fox hunts in the forest at night.",
+    "Stock prices fell on Monday.",
+    "In the forest the fox hides from the hunters.",
+]
+
+
+def test_textrank_prefers_central_sentences():
+    scores = textrank_scores(SENTENCES)
+
+    assert scores.shape == (len(SENTENCES),)
+    # the unrelated sentence has no edges and keeps the base score
+    assert scores[2] == min(scores)
+    assert np.isclose(scores[2], 1 - 0.85)
+
+
+def test_textrank_without_sentences():
+    assert textrank_scores([]).shape == (0,)
+
+
+def test_select_sentences_keeps_the_text_order_within_the_ratio():
+    token_counts = [10, 10, 10, 10]
+    kept = select_sentences(SENTENCES, token_counts, 0.5)
+
+    assert kept == sorted(kept)
+    assert sum(token_counts[i] for i in kept) <= 0.5 * sum(token_counts)
+    assert 2 not in kept
+
+
+def test_select_sentences_keeps_at_least_one_sentence():
+    # the best sentence alone is over the ratio
+    assert len(select_sentences(SENTENCES, [100, 100, 100, 100], 0.1)) == 1
+
+
+def test_select_sentences_single_and_empty():
+    assert select_sentences(["Only one sentence."], [5], 0.5) == [0]
+    assert select_sentences([], [], 0.5) == []
@@ -0,0 +1,127 @@
+from itertools import pairwise
+
+import pytest
+
+from app.utils.general import (
+    encode_texts,
+    pack_sentences_into_chunks,
+    pack_token_groups,
+    plan_merge_tree,
+    split_text_into_chunks,
+    split_text_into_token_chunks,
+    split_token_ids,
+)
+
+TEXT = (
+    "The quick brown fox jumps over the lazy dog. "
+    "A tokenizer splits a text into tokens. "
+    "Sentences are packed into chunks! "
+    "The quick brown fox jumps over the lazy dog."
+)
+
+
+def test_pack_token_groups_fan_in():
+    assert pack_token_groups([2, 2, 2, 2, 2], 5) == [[0, 1], [2, 3], [4]]
+    assert pack_token_groups([1, 1, 1, 1, 1], 100, max_items=2) == [[0, 1], [2, 3], [4]]
+    assert pack_token_groups([9, 1], 5) == [[0], [1]]
+
+
+def test_plan_merge_tree_fits_into_the_root():
+    assert plan_merge_tree([10, 20, 30], 100, 50) == [[[0, 1, 2]]]
+
+
+def test_plan_merge_tree_levels():
+    levels = plan_merge_tree([20, 90, 50, 40, 40], 100, 30)
+
+    # merged groups are estimated with the output tokens, small single nodes pass through
+    assert levels == [[[0], [1], [2, 3], [4]], [[0, 1, 2], [3]], [[0, 1]]]
+    for previous, level in pairwise(levels):
+        assert sorted(idx for group in level for idx in group) == list(
+            range(len(previous))
+        )
+
+
+def test_plan_merge_tree_without_progress():
+    with pytest.raises(Exception, match="can not be merged"):
+        plan_merge_tree([80, 80], 100, 90)
+
+
+def test_encode_texts_matches_single_calls(tokenizer):
+    texts = ["The quick brown fox.", "", " Sentences are packed!"]
+
+    assert encode_texts(texts, tokenizer=tokenizer) == [
+        tokenizer.encode(text, add_special_tokens=False) for text in texts
+    ]
+    assert encode_texts([], tokenizer=tokenizer) == []
+
+
+@pytest.mark.usefixtures("sentence_split")
+@pytest.mark.parametrize("text", ["", "   ", "\n\t "])
+def test_split_text_without_sentences(tokenizer, text):
+    assert split_text_into_token_chunks(text, 20, tokenizer=tokenizer) == []
+    assert split_text_into_chunks(text, 20, tokenizer=tokenizer) == []
+
+
+@pytest.mark.usefixtures("sentence_split")
+def test_split_text_chunks_fit_and_keep_the_text(tokenizer):
+    max_tokens = 24
+    chunks = split_text_into_token_chunks(TEXT, max_tokens, tokenizer=tokenizer)
+
+    assert len(chunks) > 1
+    assert " ".join(chunk for chunk, _ in chunks) == TEXT
+    assert split_text_into_chunks(TEXT, max_tokens, tokenizer=tokenizer) == [
+        chunk for chunk, _ in chunks
+    ]
+    for chunk, token_ids in chunks:
+        assert 0 < len(token_ids) <= max_tokens
+        # the ids are the ones of the chunk encoded on its own
+        assert token_ids == tokenizer.encode(chunk, add_special_tokens=False)
+
+
+def test_pack_sentences_fills_chunks_in_order():
+    assert pack_sentences_into_chunks([3, 3, 3, 3], 6) == [(0, 2), (2, 4)]
+    assert pack_sentences_into_chunks([3, 4, 3], 6) == [(0, 1), (1, 2), (2, 3)]
+    assert pack_sentences_into_chunks([], 6) == []
+
+
+def test_pack_sentences_counts_the_first_sentence_of_a_chunk():
+    # the first sentence of a chunk is one token shorter (no space in front of it)
+    boundaries = pack_sentences_into_chunks([4, 4, 4], 7, lambda idx: 3)
+
+    assert boundaries == [(0, 2), (2, 3)]
+
+
+def test_pack_sentences_keeps_a_sentence_over_budget_alone():
+    assert pack_sentences_into_chunks([2, 10, 2], 5) == [(0, 1), (1, 2), (2, 3)]
+
+
+def test_split_token_ids_hard_split(tokenizer):
+    token_ids = tokenizer.encode("naïve café über " * 4, add_special_tokens=False)
+    pieces = split_token_ids(token_ids, 3, tokenizer)
+
+    assert len(pieces) > 1
+    assert [token_id for _, piece_ids in pieces for token_id in piece_ids] == token_ids
+    assert all(0 < len(piece_ids) <= 3 for _, piece_ids in pieces)
+    # no piece but the last ends within a character split over several tokens
+    assert not any(text.endswith("�") for text, _ in pieces[:-1])
+
+
+@pytest.mark.usefixtures("sentence_split")
+def test_split_text_single_sentence_over_budget(tokenizer):
+    sentence = (
+        "The quick brown fox jumps over the lazy dog and over the lazy cat again."
+    )
+    max_tokens = 10
+    chunks = split_text_into_token_chunks(
+        f"Sentences are packed. {sentence} Sentences are packed.",
+        max_tokens,
+        tokenizer=tokenizer,
+    )
+    token_ids = tokenizer.encode(sentence, add_special_tokens=False)
+
+    assert len(token_ids) > max_tokens
+    assert chunks[0][0] == "Sentences are packed."
+    assert chunks[-1][0] == "Sentences are packed."
+    # the long sentence is split at token boundaries, nothing is lost
+    assert [t for _, ids in chunks[1:-1] for t in ids] == token_ids
+    assert all(len(ids) <= max_tokens for _, ids in chunks)
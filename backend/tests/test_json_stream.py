@@ -0,0 +1,174 @@
+import json
+
+import torch
+
+from app.services.json_stream import (
+    JSON_ESCAPES,
+    JsonObjectTracker,
+    JsonSchemaGrammar,
+    TokenMasks,
+    empty_json_object,
+)
+from app.utils.general import extract_and_validate_json_objects
+
+KEYS = ["Title", "Summary"]
+
+# a fake vocabulary: special token, literal pieces of the schema and value text
+TOKEN_TEXTS = [
+    "",
+    "{",
+    '{"',
+    "Title",
+    "Summary",
+    '":"',
+    '","',
+    '"}',
+    "ab",
+    "c",
+    '"',
+    "\\",
+    "n",
+    "}",
+]
+EOS_TOKEN_ID = 0
+
+
+def advance_all(grammar: JsonSchemaGrammar, pieces: list[str]):
+    state = grammar.initial_state
+    for piece in pieces:
+        state = grammar.advance(state, piece)
+        if state is None:
+            return None
+    return state
+
+
+def allowed_texts(mask: torch.Tensor | None) -> set[str]:
+    if mask is None:
+        return set()
+    return {TOKEN_TEXTS[i] for i in mask.nonzero().flatten().tolist()}
+
+
+def test_tracker_closes_at_the_end_of_the_first_object():
+    tracker = JsonObjectTracker()
+
+    assert not tracker.feed('Sure: {"Title":"a } b",')
+    assert not tracker.feed('"Summary":"c \\" {"')
+    assert tracker.feed("} trailing {")
+
+
+def test_tracker_nested_objects():
+    tracker = JsonObjectTracker()
+
+    assert not tracker.feed('{"a":{"b":"}"}')
+    assert tracker.feed("}")
+
+
+def test_tracker_truncated_object_stays_open():
+    tracker = JsonObjectTracker()
+
+    assert not tracker.feed('{"Title":"a","Summary":"unfinished')
+    assert not tracker.closed
+
+
+def test_truncated_objects_are_skipped_when_parsing():
+    assert extract_and_validate_json_objects('{"Title":"a","Summ') == []
+    assert extract_and_validate_json_objects('x {"a":"b"} y {"a":"c"') == [{"a": "b"}]
+
+
+def test_empty_json_object():
+    assert empty_json_object(KEYS) == '{"Title":"","Summary":""}'
+
+
+def test_grammar_accepts_the_schema():
+    grammar = JsonSchemaGrammar(KEYS)
+    pieces = ['{"Title":"', "a \\n b", '","Summary":"', "c", '"}']
+    state = advance_all(grammar, pieces)
+
+    assert state is not None
+    assert grammar.is_complete(state)
+    assert list(json.loads("".join(pieces))) == KEYS
+
+
+def test_grammar_rejects_other_keys_and_text_after_the_object():
+    grammar = JsonSchemaGrammar(KEYS)
+
+    assert advance_all(grammar, ['{"Other":"']) is None
+    assert advance_all(grammar, ['{"Title":"a","Summary":"b"}', " "]) is None
+    assert advance_all(grammar, ['{"Title":"\\x']) is None
+
+
+def test_grammar_remaining_literal_of_a_truncated_object():
+    grammar = JsonSchemaGrammar(KEYS)
+    state = advance_all(grammar, ['{"Title":"some value'])
+
+    assert not grammar.is_complete(state)
+    # the rest of the object with an empty summary
+    assert grammar.remaining_literal(state) == len('","Summary":""}')
+    assert grammar.remaining_literal(grammar.initial_state) == len(
+        empty_json_object(KEYS)
+    )
+
+
+def test_masks_follow_the_literal_parts():
+    grammar = JsonSchemaGrammar(KEYS)
+    masks = TokenMasks(TOKEN_TEXTS, [EOS_TOKEN_ID])
+    size = len(TOKEN_TEXTS)
+
+    assert allowed_texts(masks.mask(grammar, grammar.initial_state, size, "cpu")) == {
+        "{",
+        '{"',
+    }
+
+    state = advance_all(grammar, ['{"'])
+    assert allowed_texts(masks.mask(grammar, state, size, "cpu")) == {"Title"}
+
+
+def test_masks_inside_a_value():
+    grammar = JsonSchemaGrammar(KEYS)
+    masks = TokenMasks(TOKEN_TEXTS, [EOS_TOKEN_ID])
+    size = len(TOKEN_TEXTS)
+    state = advance_all(grammar, ['{"Title":"', "ab"])
+
+    allowed = allowed_texts(masks.mask(grammar, state, size, "cpu"))
+    assert {"ab", "c", "n", "\\", "}", '","', '"'} <= allowed
+    assert '"}' not in allowed
+
+    # after a backslash only the tokens which finish the escape
+    escaped = grammar.advance(state, "\\")
+    allowed = allowed_texts(masks.mask(grammar, escaped, size, "cpu"))
+    assert {"n", "\\", '"'} <= allowed
+    assert all(text[0] in JSON_ESCAPES for text in allowed)
+
+
+def test_masks_close_a_truncated_object():
+    grammar = JsonSchemaGrammar(KEYS)
+    masks = TokenMasks(TOKEN_TEXTS, [EOS_TOKEN_ID])
+    size = len(TOKEN_TEXTS)
+
+    # closing only allows the literal rest, the values are not extended
+    state = advance_all(grammar, ['{"Title":"', "ab"])
+    assert allowed_texts(masks.mask(grammar, state, size, "cpu", close=True)) == {
+        '","',
+        '"',
+    }
+
+    state = advance_all(grammar, ['{"Title":"ab","Summary":"'])
+    assert allowed_texts(masks.mask(grammar, state, size, "cpu", close=True)) == {
+        '"}',
+        '"',
+    }
+
+    # an open escape has to be finished before the value can be closed
+    state = advance_all(grammar, ['{"Title":"', "\\"])
+    allowed = allowed_texts(masks.mask(grammar, state, size, "cpu", close=True))
+    assert "n" in allowed
+    assert all(text[0] in JSON_ESCAPES for text in allowed)
+
+
+def test_masks_allow_only_eos_after_the_object():
+    grammar = JsonSchemaGrammar(KEYS)
+    masks = TokenMasks(TOKEN_TEXTS, [EOS_TOKEN_ID])
+    state = advance_all(grammar, ['{"Title":"a","Summary":"b"}'])
+
+    mask = masks.mask(grammar, state, len(TOKEN_TEXTS), "cpu")
+    assert mask.nonzero().flatten().tolist() == [EOS_TOKEN_ID]
@@ -0,0 +1,116 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from app.utils import result_cache as result_cache_module
+from app.utils.result_cache import ResultCache, result_key
+
+PAYLOAD = {
+    "text": "The quick brown fox.\r\nThe lazy dog.",
+    "options": {"top_k": 2, "max_new_tokens": 100},
+    "questions": ["Where is the fox?", "What does the dog do?"],
+}
+
+
+def test_result_key_normalizes_the_payload():
+    key = result_key("questionary", PAYLOAD)
+
+    assert key == result_key(
+        "questionary",
+        {
+            "questions": [" Where is  the fox?", "What does the dog do?\n"],
+            "options": {"max_new_tokens": 100, "top_k": 2},
+            "text": "The quick brown fox. The lazy dog.",
+        },
+    )
+    # nfd and nfc form of the same text
+    assert result_key("summarize", {"text": "cafe\u0301"}) == result_key(
+        "summarize", {"text": "caf\u00e9"}
+    )
+
+
+@pytest.mark.parametrize(
+    "namespace, payload",
+    [
+        ("summarize", PAYLOAD),
+        ("questionary", {**PAYLOAD, "text": "The quick brown fox."}),
+        ("questionary", {**PAYLOAD, "options": {"top_k": 3, "max_new_tokens": 100}}),
+        # the answers of a batch follow the order of the questions
+        ("questionary", {**PAYLOAD, "questions": PAYLOAD["questions"][::-1]}),
+    ],
+)
+def test_result_key_changes_with_the_request(namespace, payload):
+    assert result_key(namespace, payload) != result_key("questionary", PAYLOAD)
+
+
+def test_result_key_changes_with_the_settings(monkeypatch):
+    key = result_key("questionary", PAYLOAD)
+    monkeypatch.setattr(result_cache_module.settings, "LLM_MODEL_ID", "another/model")
+
+    assert result_key("questionary", PAYLOAD) != key
+
+
+def test_result_key_is_stable_across_processes():
+    # another interpreter with another hash seed, as a second api worker
+    script = (
+        "import conftest, json, sys\n"
+        "from app.utils.result_cache import result_key\n"
+        "print(result_key('questionary', json.loads(sys.argv[1])))\n"
+    )
+    backend = os.path.dirname(os.path.dirname(__file__))
+    output = subprocess.run(
+        [sys.executable, "-c", script, json.dumps(PAYLOAD)],
+        cwd=backend,
+        env={
+            **os.environ,
+            "PYTHONHASHSEED": "1",
+            "PYTHONPATH": f"{backend}:{backend}/tests",
+        },
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+
+    assert output.splitlines()[-1] == result_key("questionary", PAYLOAD)
+
+
+def test_memory_cache_is_a_lru_with_a_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(result_cache_module.time, "time", lambda: now[0])
+    cache = ResultCache(max_entries=2, ttl=60, path="")
+
+    cache.put("a", {"answer": 1})
+    cache.put("b", {"answer": 2})
+    assert cache.get("a") == {"answer": 1}
+    cache.put("c", {"answer": 3})
+
+    # b was the least recently used one
+    assert cache.get("b") is None
+    assert cache.get("c") == {"answer": 3}
+
+    now[0] += 61
+    assert cache.get("a") is None
+    assert cache.stats()["memory_entries"] == 1
+
+
+def test_results_are_copies():
+    cache = ResultCache(path="")
+    cache.put("a", {"answers": ["fox"]})
+    cache.get("a")["answers"].append("dog")
+
+    assert cache.get("a") == {"answers": ["fox"]}
+
+
+def test_disk_cache_is_shared(tmp_path):
+    ResultCache(path=str(tmp_path)).put("a", ["fox", None])
+    other = ResultCache(path=str(tmp_path))
+
+    assert other.get("a") == ["fox", None]
+    assert other.get("b") is None
+
+    stats = other.stats()
+    assert stats["disk_hits"] == 1 and stats["misses"] == 1
+    assert stats["hit_rate"] == 0.5
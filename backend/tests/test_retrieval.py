@@ -0,0 +1,70 @@
+import numpy as np
+
+from app.services.questionary import select_relevant_chunks, top_k_option
+from app.utils.retrieval import BM25Index, tokenize_words
+
+CHUNKS = [
+    "The quick brown fox jumps over the lazy dog.",
+    "Budgets of the context window and the generated tokens.",
+    "A fox, a fox and another fox in the garden.",
+    "Nothing relevant here at all.",
+]
+
+
+def test_tokenize_words():
+    assert tokenize_words("The Fox, the fox's den!") == [
+        "the",
+        "fox",
+        "the",
+        "fox",
+        "s",
+        "den",
+    ]
+
+
+def test_score_ranks_matching_chunks():
+    index = BM25Index(CHUNKS)
+    scores = index.score("Where is the fox?")
+
+    assert scores.shape == (len(CHUNKS),)
+    # more occurrences of the query term score higher, chunks without it score 0
+    assert scores[2] > scores[0] > 0
+    assert scores[3] == 0
+
+
+def test_unknown_query_scores_zero():
+    index = BM25Index(CHUNKS)
+
+    assert not index.score("elephant").any()
+
+
+def test_top_k_in_chunk_order():
+    index = BM25Index(CHUNKS)
+
+    assert [i for i, _ in index.top_k("fox window", 2)] == [1, 2]
+    assert index.top_k("fox", 0) == []
+    assert len(index.top_k("fox", 10)) == len(CHUNKS)
+
+
+def test_round_trip_through_arrays():
+    index = BM25Index(CHUNKS)
+    restored = BM25Index.from_arrays(index.vocabulary, index.to_arrays())
+
+    np.testing.assert_allclose(restored.score("lazy fox"), index.score("lazy fox"))
+
+
+def test_empty_index():
+    index = BM25Index([])
+
+    assert index.score("fox").shape == (0,)
+    assert index.top_k("fox", 3) == []
+
+
+def test_top_k_keeps_all_chunks_by_default():
+    index = BM25Index(CHUNKS)
+
+    assert top_k_option(None) == 0
+    assert top_k_option({"top_k": "2"}) == 2
+    assert top_k_option({"top_k": "all"}) == 0
+    assert [i for i, _ in select_relevant_chunks(index, "fox", 0)] == [0, 1, 2, 3]
+    assert [i for i, _ in select_relevant_chunks(index, "fox", 1)] == [2]
@@ -0,0 +1,78 @@
+import threading
+import time
+
+import pytest
+
+from app.utils.single_flight import SingleFlight
+
+
+def run_with_followers(flights: SingleFlight, leader_fn, followers: int = 3):
+    """
+    Run leader_fn under one key while the followers wait for it.
+
+    Returns:
+        The result or the exception of the leader and of every follower.
+    """
+    started = threading.Event()
+    release = threading.Event()
+    outcomes = {}
+
+    def leader_call():
+        started.set()
+        release.wait(5)
+        return leader_fn()
+
+    def call(name, fn):
+        try:
+            outcomes[name] = flights.do("key", fn)
+        except BaseException as e:
+            outcomes[name] = e
+
+    threads = [threading.Thread(target=call, args=("leader", leader_call), daemon=True)]
+    threads[0].start()
+    started.wait(5)
+
+    for i in range(followers):
+        thread = threading.Thread(
+            target=call, args=(i, lambda: "not the leader"), daemon=True
+        )
+        thread.start()
+        threads.append(thread)
+
+    # every follower is waiting for the leader before it finishes
+    deadline = time.monotonic() + 5
+    while flights.coalesced < followers and time.monotonic() < deadline:
+        time.sleep(0.01)
+    release.set()
+
+    for thread in threads:
+        thread.join(5)
+
+    return outcomes
+
+
+def test_followers_share_the_result():
+    flights = SingleFlight()
+    outcomes = run_with_followers(flights, lambda: {"answers": ["fox"]})
+
+    assert flights.coalesced == 3
+    assert all(outcome == {"answers": ["fox"]} for outcome in outcomes.values())
+    # every caller has its own copy
+    assert len({id(outcome) for outcome in outcomes.values()}) == 4
+
+
+@pytest.mark.parametrize("error", [ValueError("model failed"), KeyboardInterrupt()])
+def test_errors_are_raised_for_every_waiter(error):
+    flights = SingleFlight()
+
+    def fail():
+        raise error
+
+    outcomes = run_with_followers(flights, fail)
+
+    assert len(outcomes) == 4
+    assert all(outcome is error for outcome in outcomes.values())
+    assert flights.stats() == {"in_flight": 0, "coalesced": 3}
+
+    # a failed call is not remembered, the next call runs again
+    assert flights.do("key", lambda: "retried") == "retried"
@@ -0,0 +1,66 @@
+import pytest
+
+from app.services import summarize
+from app.utils.result_cache import ResultCache
+
+
+class FakeEngine:
+    def __init__(self):
+        self.prompts = []
+        self.recorded = []
+
+    def generate_many_from_messages(self, messages_list, max_new_tokens, json_keys):
+        self.prompts.extend(messages[-1]["content"] for messages in messages_list)
+        outputs = [
+            f'{{"Title": "t", "Summary": "{messages[-1]["content"]}"}}'
+            for messages in messages_list
+        ]
+        # the batcher counts the generated tokens of every output
+        return outputs, [len(messages[-1]["content"]) for messages in messages_list]
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    engine = FakeEngine()
+    monkeypatch.setattr(summarize, "engine", engine)
+    monkeypatch.setattr(summarize, "section_cache", ResultCache(path=""))
+    monkeypatch.setattr(
+        summarize, "record_outputs", lambda *args: engine.recorded.append(args)
+    )
+
+    return engine
+
+
+def summaries_of(sections: list[str]):
+    messages_list = [[{"role": "user", "content": section}] for section in sections]
+    return summarize.generate_summaries(
+        messages_list,
+        max_new_tokens=[50] * len(sections),
+        input_tokens=[10] * len(sections),
+    )
+
+
+def test_only_changed_sections_are_summarized_again(engine):
+    summaries, generated = summaries_of(["first", "second", "third"])
+    assert generated == 3
+    assert [summary["Summary"] for summary in summaries] == ["first", "second", "third"]
+
+    summaries, generated = summaries_of(["first", "edited", "third"])
+
+    assert generated == 1
+    assert engine.prompts == ["first", "second", "third", "edited"]
+    assert [summary["Summary"] for summary in summaries] == ["first", "edited", "third"]
+    # the counts of the engine are recorded, not the tokens of the outputs
+    assert [args[3] for args in engine.recorded] == [[5, 6, 5], [6]]
+
+
+def test_section_key_depends_on_the_prompt_and_budget():
+    messages = [{"role": "user", "content": "A section."}]
+
+    assert summarize.section_key(messages, 50) == summarize.section_key(
+        [{"role": "user", "content": "A section.\n"}], 50
+    )
+    assert summarize.section_key(messages, 50) != summarize.section_key(messages, 60)
+    assert summarize.section_key(messages, 50) != summarize.section_key(
+        [{"role": "user", "content": "Another section."}], 50
+    )